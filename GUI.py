@@ -1,17 +1,189 @@
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
+import contextlib
 import os
+import queue
 import sys
 import platform
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image, ImageTk  # Required for image handling
+import estimator
+import jobarrays
+import jobcache
+import pipeline
+import preflight
+import preview
+import printserver
 import uploader
+from checkpoint import Checkpoint
+from jobfile import JobFile
+
+UI_REFRESH_MS = 100  # How often print status and progress are redrawn
+PREVIEW_TOLERANCE_PX = 0.5  # How far the drawn toolpath may be from the real one (pixels)
+PREVIEW_BATCH = 2000  # Polylines drawn per event loop turn, so big layers do not freeze the window
+PREVIEW_MARGIN_PX = 10
+POSITION_CHECK_MS = 30000  # How often the displayed position is checked against the firmware's (M114)
+
+class PrintWorker(threading.Thread):
+    """
+    Sends a print job from a background thread so the Tk event loop never blocks.
+    
+    Everything the UI needs to know is put on `updates` as (kind, ...) tuples:
+        ('progress', percent, line, seconds_left, file_line)  after each line is sent
+                                     (file_line: 0-based line of the file)
+        ('done', stats)              when the whole file has been sent
+        ('stopped', stats)           when the job was stopped early
+        ('error', message)           when the job could not be sent
+    """
+    
+    def __init__(self, file_path, updates, control, resume=False):
+        super().__init__(daemon=True)
+        self.file_path = file_path
+        self.updates = updates
+        self.control = control
+        self.resume = resume  # Carry on from the checkpoint of an earlier run (see checkpoint.py)
+        self.estimate = None  # estimator.TimeEstimate of the job, progress is by predicted time
+    
+    def run(self):
+        try:
+            if not uploader.is_connected() and not uploader.connect_arduino():
+                self.updates.put(('error', "Could not connect to the printer"))
+                return
+            
+            pipeline_stats = pipeline.PipelineStats()
+            # Compiled when the preview was loaded
+            with JobFile(self.file_path) as job, \
+                    (jobcache.open_job(self.file_path) if uploader.JOB_CACHE else contextlib.nullcontext()) as compiled:
+                checkpoint = (Checkpoint.load(job) if self.resume else None) or Checkpoint(job)
+                for gcode in checkpoint.preamble():
+                    uploader.send_gcode(gcode)
+                if compiled is not None:
+                    self.estimate = estimator.estimate(compiled.arrays()).starting_at(checkpoint.line)
+                    lines = compiled.lines(checkpoint.line)
+                else:
+                    self.estimate = estimator.estimate_file(self.file_path).starting_at(checkpoint.line)
+                    lines = checkpoint.lines()
+                lines = pipeline.preprocess(lines, stats=pipeline_stats, start=checkpoint.state,
+                                            source=checkpoint.lines() if compiled is not None else None)
+                try:
+                    stats = uploader.stream_lines(lines, self.estimate, self.report_progress, self.control,
+                                                  on_ack=checkpoint.acknowledged)
+                finally:
+                    checkpoint.save()  # Kept if the job was stopped or failed, removed below if it finished
+                if not stats['stopped']:
+                    checkpoint.remove()
+            
+            uploader.print_throughput(stats)
+            print(pipeline_stats.summary())
+            self.updates.put(('stopped' if stats['stopped'] else 'done', stats))
+        except Exception as e:
+            print(f"Print job failed: {e}")
+            self.updates.put(('error', str(e)))
+    
+    def report_progress(self, current_line, percent, line):
+        self.updates.put(('progress', percent, line, self.estimate.remaining(current_line),
+                          self.estimate.first_line + current_line - 1))
+
+class ServerPrintWorker(threading.Thread):
+    """
+    Hands a print job to the print server (printserver.py) instead of sending
+    it from this process, and follows it there from a background thread. Puts
+    the same updates on `updates` as PrintWorker, and keeps the position of
+    the last progress event in `position`.
+    """
+    
+    def __init__(self, client, file_path, updates, control, resume=False):
+        super().__init__(daemon=True)
+        self.client = client
+        self.file_path = file_path
+        self.updates = updates
+        self.control = control
+        self.resume = resume
+        self.position = None
+    
+    def run(self):
+        try:
+            # Listening before the job exists, so nothing is missed
+            with self.client.events() as events:
+                # The GUI has checked the file already (and asked about it)
+                job = self.client.submit(self.file_path, resume=self.resume, preflight=False)
+                self.control.started(job['id'])
+                for event in events:
+                    if event['event'] == 'progress' and event['job'] == job['id']:
+                        self.position = event['position']
+                        self.updates.put(('progress', event['percent'], event['line'], event['remaining'],
+                                          event['file_line']))
+                    elif event['event'] == 'job' and event['job']['id'] == job['id']:
+                        job = event['job']
+                        if job['state'] in printserver.FINISHED:
+                            break
+                else:
+                    raise IOError("The print server stopped")
+            if job['state'] == printserver.FAILED:
+                self.updates.put(('error', job['error']))
+            else:
+                self.updates.put(('done' if job['state'] == printserver.DONE else 'stopped', job['stats']))
+        except (OSError, RuntimeError) as e:
+            self.updates.put(('error', str(e)))
+
+class ServerJobControl:
+    """Pauses, resumes and stops a job on the print server, like uploader.JobControl does one sent from here"""
+    
+    def __init__(self, client):
+        self.client = client
+        self.job_id = None
+        self.stopped = False
+    
+    def started(self, job_id):
+        self.job_id = job_id
+        if self.stopped:  # Stop was pressed before the server had it
+            self.client.cancel(job_id)
+    
+    def pause(self):
+        if self.job_id is None:
+            raise RuntimeError("The print server has not taken the job yet")
+        self.client.pause(self.job_id)
+    
+    def resume(self):
+        self.client.resume(self.job_id)
+    
+    def stop(self):
+        self.stopped = True
+        if self.job_id is not None:
+            self.client.cancel(self.job_id)
+
+class PreviewLoader(threading.Thread):
+    """
+    Parses a G-code file on a background thread, once for both the preview
+    and the preflight checks (and the print, from the job cache). Puts ('loaded', path, (toolpath, report))
+    (preview.Toolpath, preflight.PreflightReport) or ('error', path, message) on `updates`.
+    """
+    
+    def __init__(self, file_path, updates):
+        super().__init__(daemon=True)
+        self.file_path = file_path
+        self.updates = updates
+    
+    def run(self):
+        try:
+            if uploader.JOB_CACHE:
+                with jobcache.open_job(self.file_path) as compiled:
+                    job = compiled.arrays()
+            else:
+                job = jobarrays.load(self.file_path)
+            states = jobarrays.replay(job)
+            result = (preview.toolpath(job, states), preflight.validate(job, states, self.file_path))
+            self.updates.put(('loaded', self.file_path, result))
+        except Exception as e:
+            self.updates.put(('error', self.file_path, str(e)))
 
 class PrinterControlGUI:
     def __init__(self, root):
         self.filePath = ''
         self.root = root
         self.root.title("CeraTech")
-        self.root.geometry("900x900")
+        self.root.geometry("1400x900")
         self.root.configure(bg='#f0f0f0')  # Main window background
         
         # Platform detection
@@ -42,7 +214,39 @@ class PrinterControlGUI:
         self.printer_status = tk.StringVar(value="Ready")
         self.print_progress = tk.DoubleVar(value=0)
         
+        # Print job state ("Ready", "Printing" or "Paused"), the worker sending it
+        # and the queue the worker reports back on
+        self.print_state = "Ready"
+        self.print_worker = None
+        self.job_control = None
+        self.print_updates = queue.Queue()
+        
+        # Toolpath of the selected file (preview.Toolpath, None while it loads),
+        # the queue PreviewLoader reports on and the layer drawing in progress
+        self.toolpath = None
+        self.preflight_report = None  # preflight.PreflightReport of the selected file, None while it loads
+        self.preview_updates = queue.Queue()
+        self.preview_drawing = None  # after() id of the next batch of polylines
+        self.preview_view = None  # (scale, offset_x, offset_y) from mm to canvas pixels
+        self.preview_layer = tk.IntVar(value=0)
+        self.preview_info = tk.StringVar(value="No file selected")
+        
+        # Position the firmware has reached, from the commands it acknowledged (uploader.machine_position)
+        self.machine_position = tk.StringVar(value="Position: not connected")
+        self.position_check = None  # Thread asking the firmware with M114
+        
+        # A running print server (printserver.py) has the printer: jobs, jogs and
+        # the position go through it, on server_calls so Tk never waits on the socket
+        self.server = printserver.running()
+        self.server_calls = ThreadPoolExecutor(1) if self.server else None
+        self.server_position = None  # From the last status or progress event
+        if self.server:
+            self.printer_status.set("Ready (print server)")
+            self.check_server_position()
+        
         self.setup_ui()
+        self.root.after(UI_REFRESH_MS, self.refresh_position)
+        self.root.after(POSITION_CHECK_MS, self.check_position)
         
     def setup_logo(self):
         """Setup logo with cross-platform file handling"""
@@ -147,6 +351,9 @@ class PrinterControlGUI:
             sys.exit(0)
         
     def setup_ui(self):
+        # Toolpath preview, on the right of everything else
+        self.setup_preview()
+        
         # Main title
         title_label = tk.Label(
             self.root, 
@@ -219,6 +426,14 @@ class PrinterControlGUI:
         )
         status_label.pack(side='left', padx=(5, 0))
         
+        tk.Label(
+            status_frame,
+            textvariable=self.machine_position,
+            font=self.get_font('Arial', 10),
+            fg='#666',
+            bg='white'
+        ).pack(side='right')
+        
         # Progress bar
         tk.Label(
             control_frame, 
@@ -339,6 +554,34 @@ class PrinterControlGUI:
         move_btn.grid(row=3, columnspan=2, pady=(10, 5))
 
 
+    def setup_preview(self):
+        """Canvas with the XY toolpath of one layer and a slider to pick the layer"""
+        preview_frame = ttk.LabelFrame(self.root, text="Toolpath Preview", padding="10")
+        preview_frame.pack(side='right', fill='both', expand=True, padx=(0, 20), pady=10)
+        
+        tk.Label(
+            preview_frame,
+            textvariable=self.preview_info,
+            font=self.get_font('Arial', 9),
+            fg='#666'
+        ).pack(anchor='w')
+        
+        self.layer_slider = tk.Scale(
+            preview_frame,
+            variable=self.preview_layer,
+            from_=0,
+            to=0,
+            orient='horizontal',
+            showvalue=False,
+            command=lambda _: self.draw_layer()
+        )
+        self.layer_slider.pack(fill='x')
+        
+        self.preview_canvas = tk.Canvas(preview_frame, bg='white', highlightthickness=0)
+        self.preview_canvas.pack(fill='both', expand=True, pady=(5, 0))
+        self.preview_canvas.bind('<Configure>', lambda _: self.draw_layer())
+
+
 # --------------
 # Functions that actually do stuff
 # --------------
@@ -372,12 +615,104 @@ class PrinterControlGUI:
             
             # Store full path for actual use
             self.filePath = filename
+            self.load_preview(filename)
             
             messagebox.showinfo(
                 "File Uploaded", 
                 f"Successfully loaded: {file_basename}"
             )
     
+    
+    def load_preview(self, file_path):
+        """Parse the file for the preview on a background thread (see poll_preview_updates)"""
+        self.toolpath = None
+        self.preflight_report = None
+        self.preview_canvas.delete('all')
+        self.preview_info.set("Loading preview...")
+        PreviewLoader(file_path, self.preview_updates).start()
+        self.root.after(UI_REFRESH_MS, self.poll_preview_updates)
+    
+    def poll_preview_updates(self):
+        """Show the toolpath once PreviewLoader has parsed it"""
+        try:
+            kind, file_path, result = self.preview_updates.get_nowait()
+        except queue.Empty:
+            self.root.after(UI_REFRESH_MS, self.poll_preview_updates)
+            return
+        if file_path != self.filePath:
+            self.root.after(UI_REFRESH_MS, self.poll_preview_updates)  # A file picked since, still loading
+            return
+        if kind == 'error':
+            self.preview_info.set(f"No preview: {result}")
+            return
+        self.toolpath, self.preflight_report = result
+        self.layer_slider.configure(to=max(self.toolpath.layers - 1, 0))
+        self.preview_layer.set(0)
+        self.draw_layer()
+    
+    def draw_layer(self):
+        """
+        Draw the selected layer, scaled to fit the canvas. The toolpath is
+        thinned out to PREVIEW_TOLERANCE_PX (and cached by the toolpath), and
+        drawn PREVIEW_BATCH polylines at a time so the window stays responsive.
+        """
+        canvas = self.preview_canvas
+        if self.preview_drawing is not None:
+            self.root.after_cancel(self.preview_drawing)
+            self.preview_drawing = None
+        canvas.delete('all')
+        toolpath = self.toolpath
+        if toolpath is None or not toolpath.layers:
+            if toolpath is not None:
+                self.preview_info.set("No moves in this file")
+            return
+        
+        layer = self.preview_layer.get()
+        self.preview_info.set(f"Layer {layer + 1} of {toolpath.layers} (Z {toolpath.layer_z[layer]:.2f} mm), "
+                              f"{len(toolpath)} moves")
+        
+        min_x, min_y, max_x, max_y = toolpath.bounds
+        width = max(canvas.winfo_width() - 2 * PREVIEW_MARGIN_PX, 1)
+        height = max(canvas.winfo_height() - 2 * PREVIEW_MARGIN_PX, 1)
+        scale = min(width / max(max_x - min_x, 1e-6), height / max(max_y - min_y, 1e-6))
+        # Y goes up on the printer and down on the canvas
+        self.preview_view = (scale, PREVIEW_MARGIN_PX - min_x * scale, PREVIEW_MARGIN_PX + max_y * scale)
+        polylines = toolpath.layer_polylines(layer, PREVIEW_TOLERANCE_PX / scale)
+        self.draw_polylines(polylines, 0)
+    
+    def draw_polylines(self, polylines, first):
+        """Draw the next PREVIEW_BATCH polylines of a layer from `first` on, and schedule the rest"""
+        scale, offset_x, offset_y = self.preview_view
+        for xy, extruding in polylines[first:first + PREVIEW_BATCH]:
+            coords = (xy * (scale, -scale) + (offset_x, offset_y)).ravel().tolist()
+            if len(coords) == 2:
+                coords += coords  # A move that is shorter than the tolerance
+            self.preview_canvas.create_line(
+                *coords,
+                fill='#2196F3' if extruding else '#cccccc',
+                width=1
+            )
+        if first + PREVIEW_BATCH < len(polylines):
+            self.preview_drawing = self.root.after(1, self.draw_polylines, polylines, first + PREVIEW_BATCH)
+        else:
+            self.preview_drawing = None
+            self.preview_canvas.tag_raise('nozzle')
+    
+    def show_nozzle(self, file_line):
+        """Mark where the printer is once `file_line` has run, going to its layer if needed"""
+        if self.toolpath is None or self.preview_view is None:
+            return
+        located = self.toolpath.locate(file_line)
+        if located is None:
+            return
+        x, y, layer = located
+        if layer != self.preview_layer.get():
+            self.preview_layer.set(layer)
+            self.draw_layer()
+        scale, offset_x, offset_y = self.preview_view
+        cx, cy = x * scale + offset_x, offset_y - y * scale
+        self.preview_canvas.delete('nozzle')
+        self.preview_canvas.create_oval(cx - 4, cy - 4, cx + 4, cy + 4, fill='#F44336', outline='', tags='nozzle')
    
     def start_print(self):
         """Start the print job"""
@@ -385,94 +720,184 @@ class PrinterControlGUI:
             messagebox.showwarning("No File", "Please upload a file first!")
             return
             
-        if self.printer_status.get() == "Printing":
+        if self.print_state != "Ready":
             messagebox.showinfo("Already Printing", "Print job is already in progress!")
             return
+        
+        if not os.path.exists(self.filePath):
+            messagebox.showerror("File Error", f"Could not read the file: {self.filePath}")
+            return
+        
+        if uploader.PREFLIGHT:
+            # Checked while the preview loaded, unless it has not finished yet
+            report = self.preflight_report or preflight.validate_file(self.filePath)
+            if not report.ok and not messagebox.askyesno(
+                "Preflight Check",
+                f"{report.summary()}\n\nThe printer will report these lines as errors. Print anyway?"
+            ):
+                return
             
+        resume = False
+        with JobFile(self.filePath) as job:
+            checkpoint = Checkpoint.load(job)
+        if checkpoint is not None:
+            answer = messagebox.askyesnocancel(
+                "Resume Print",
+                f"This file was stopped at line {checkpoint.line + 1}. Resume from there?\n"
+                "(No starts again from the beginning)"
+            )
+            if answer is None:
+                return
+            resume = answer
+        
+        self.print_state = "Printing"
         self.printer_status.set("Printing")
         self.print_progress.set(0)
+        
+        if self.server:
+            self.job_control = ServerJobControl(self.server)
+            self.print_worker = ServerPrintWorker(self.server, self.filePath, self.print_updates, self.job_control,
+                                                  resume)
+        else:
+            # Pausing sends M18 and resuming M17, from the worker once the lines in flight are done
+            self.job_control = uploader.JobControl(
+                on_pause=lambda: uploader.send_gcode('M18'),
+                on_resume=lambda: uploader.send_gcode('M17')
+            )
+            self.print_worker = PrintWorker(self.filePath, self.print_updates, self.job_control, resume)
+        self.print_worker.start()
+        self.root.after(UI_REFRESH_MS, self.poll_print_updates)
         messagebox.showinfo("Print Started", "Print job has been started!")
+    
+    def poll_print_updates(self):
+        """Apply what the print worker reported since the last refresh"""
+        latest_progress = None
+        finished = None
         
-        try:
-            with open(self.filePath, 'r') as f:
-                lines = f.readlines()
-        except Exception as e:
-            print(f"Error reading file: {e}")
-            messagebox.showerror("File Error", f"Could not read the file: {str(e)}")
-            self.printer_status.set("Ready")
-            return
-
-        def send_lines(index=0):
-            if index < len(lines) and self.printer_status.get() == "Printing":
-                line = lines[index].strip()
-                if line:
-                    try:
-                        uploader.send_gcode(line)
-                        self.printer_status.set(f"Sending: {line}")
-                    except Exception as e:
-                        print(f"Failed to send line: {line}, Error: {e}")
-                        self.printer_status.set("Error sending G-code")
-                        return
-                self.print_progress.set((index + 1) / len(lines) * 100)
-                self.root.after(500, lambda: send_lines(index + 1))
+        while True:
+            try:
+                update = self.print_updates.get_nowait()
+            except queue.Empty:
+                break
+            if update[0] == 'progress':
+                latest_progress = update  # Only the newest one is drawn
             else:
-                if self.print_progress.get() >= 100:
-                    self.printer_status.set("Complete")
-                    messagebox.showinfo("Print Complete", "Print job finished successfully!")
-
-            # Start sending lines
-            send_lines()
-
+                finished = update
+        
+        if latest_progress and isinstance(self.print_worker, ServerPrintWorker):
+            self.server_position = self.print_worker.position
+        if latest_progress and self.print_state == "Printing":
+            _, percent, line, seconds_left, file_line = latest_progress
+            self.print_progress.set(percent)
+            self.printer_status.set(f"Printing ({estimator.format_duration(seconds_left)} left): {line}")
+            self.show_nozzle(file_line)
+        
+        if finished is None:
+            self.root.after(UI_REFRESH_MS, self.poll_print_updates)
+            return
+        
+        self.print_worker = None
+        self.job_control = None
+        self.print_state = "Ready"
+        kind = finished[0]
+        if kind == 'done':
+            self.print_progress.set(100)
+            self.printer_status.set("Complete")
+            messagebox.showinfo("Print Complete", "Print job finished successfully!")
+        elif kind == 'stopped':
+            self.print_progress.set(0)
+            self.printer_status.set("Ready")
+        else:
+            self.printer_status.set("Error sending G-code")
+            messagebox.showerror("Print Error", finished[1])
+        
+    def refresh_position(self):
+        """Show the position the host keeps for the firmware, no round trip needed"""
+        position = self.server_position if self.server else uploader.machine_position()
+        if position is None:
+            self.machine_position.set("Position: not connected")
+        else:
+            self.machine_position.set("X {:.2f}  Y {:.2f}  Z {:.2f}  E {:.2f}".format(*position))
+        self.root.after(UI_REFRESH_MS, self.refresh_position)
+    
+    def check_position(self):
+        """Now and then, ask the firmware (M114) on a background thread in case the displayed position drifted"""
+        if self.server:
+            self.check_server_position()
+        elif uploader.is_connected() and (self.position_check is None or not self.position_check.is_alive()):
+            self.position_check = threading.Thread(target=uploader.check_position, daemon=True)
+            self.position_check.start()
+        self.root.after(POSITION_CHECK_MS, self.check_position)
+    
+    def check_server_position(self):
+        """Ask the print server where the printer is, on a background thread"""
+        def ask():
+            self.server_position = self.server.status()['printer']['position']
+        self.server_calls.submit(ask)
         
     def pause_print(self):
         """Pause the current print"""
-        if self.printer_status.get() == "Printing":
-            uploader.send_gcode('M18')
+        try:
+            if self.print_state == "Printing":
+                self.job_control.pause()
+            elif self.print_state == "Paused":
+                self.job_control.resume()
+        except (RuntimeError, OSError) as e:  # From the print server (the job may still be queued there)
+            messagebox.showerror("Print Error", str(e))
+            return
+        if self.print_state == "Printing":
+            self.print_state = "Paused"
             self.printer_status.set("Paused")
             messagebox.showinfo("Print Paused", "Print job has been paused.")
-        elif self.printer_status.get() == "Paused":
-            uploader.send_gcode('M17')
+        elif self.print_state == "Paused":
+            self.print_state = "Printing"
             self.printer_status.set("Printing")
             messagebox.showinfo("Print Resumed", "Print job has been resumed.")
-            self.simulate_print_progress()  # Resume progress simulation
             
     def stop_print(self):
         """Stop the current print"""
-        if self.printer_status.get() in ["Printing", "Paused"]:
+        if self.print_state in ["Printing", "Paused"]:
             result = messagebox.askyesno("Confirm Stop", "Are you sure you want to stop the print job?")
-            if result:
-                self.printer_status.set("Ready")
-                self.print_progress.set(0)
+            if result and self.job_control is not None:
+                try:
+                    self.job_control.stop()
+                except (RuntimeError, OSError) as e:
+                    messagebox.showerror("Print Error", str(e))
+                    return
+                self.print_state = "Stopping"
+                self.printer_status.set("Stopping")
                 messagebox.showinfo("Print Stopped", "Print job has been stopped.")
     
     def execute_relative_move(self):
-        """ Send relative movement command based on entered offsets"""
+        """Jog by the entered offsets, without waiting for the printer (see poll_jog)"""
         try:
             x = float(self.x_offset.get())
             y = float(self.y_offset.get())
             z = float(self.z_offset.get())
-            
-            # Example: Send G-code for relative movement
-            gcode = f"G91\nG1 X{x} Y{y} Z{z}\nG90"  # Switch to relative, move, then back to absolute
-            print(f"Sending G-code: {gcode}")  # Replace with your actual serial comms
-            
-            # Optional: Update status
-            self.printer_status.set(f"Moved: X{x} Y{y} Z{z}")
         except ValueError:
             messagebox.showerror("Error", "Invalid offset values (must be numbers)")
+            return
         
-                    
-        def simulate_print_progress(self):
-            """Simulate print progress for demo purposes"""
-            if self.printer_status.get() == "Printing" and self.print_progress.get() < 100:
-                current_progress = self.print_progress.get()
-                self.print_progress.set(current_progress + 1)
-                if current_progress + 1 >= 100:
-                    self.printer_status.set("Complete")
-                    messagebox.showinfo("Print Complete", "Print job finished successfully!")
-                else:
-                    # Continue progress simulation
-                    self.root.after(1000, self.simulate_print_progress)
+        # Clicks in quick succession are added up into one move by the uploader
+        jog = self.server_calls.submit(self.server.jog, x, y, z) if self.server else uploader.jog(x, y, z, wait=False)
+        if jog is None:
+            messagebox.showwarning("Not Connected", "Connect to the printer first (start a print).")
+            return
+        self.root.after(UI_REFRESH_MS, self.poll_jog, jog)
+    
+    def poll_jog(self, jog):
+        """Show how a jog went once the printer has answered it"""
+        if not jog.done():
+            self.root.after(UI_REFRESH_MS, self.poll_jog, jog)
+            return
+        try:
+            x, y, z = jog.result()
+        except (ValueError, RuntimeError, TimeoutError, IOError) as e:
+            messagebox.showerror("Jog Error", str(e))
+            return
+        self.printer_status.set(f"Moved: X{x:g} Y{y:g} Z{z:g}")
+        if self.server:
+            self.check_server_position()
 
 def main():
     root = tk.Tk()
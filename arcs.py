@@ -0,0 +1,182 @@
+import numpy as np
+
+from gcode import AXES, STEPS_PER_MM, format_number, to_float
+
+# ---------------------
+# ARCS
+# firmware.ino only runs straight G0/G1 moves, so G2 (clockwise) and G3
+# (counter-clockwise) arcs in the XY plane are cut into G1 chords on this
+# side. The centre is given relative to the start (I, J) or by the radius
+# (R, negative for the long way round); Z and E go along linearly, so
+# helices work and the extrusion is spread over the chords by length.
+#
+# Every arc gets as few chords as keep the path within ARC_TOLERANCE of
+# the true arc, but the firmware cannot get closer than half a motor step
+# and no chord is made shorter than a step:
+#
+#     start, end = np.array([[0, 0, 0, 0]]), np.array([[10, 0, 0, 1]])
+#     points, arc = chords(start, end, np.array([[5, 0]]), np.array([True]))
+#     # points: X, Y, Z, E at the end of each chord, arc: which arc it belongs to
+# ---------------------
+
+ARC_COMMANDS = ('G2', 'G3')  # Clockwise, counter-clockwise
+ARC_WORDS = ('I', 'J', 'R')
+ARC_TOLERANCE = 0.01  # mm the chords may stray from the arc
+RESOLUTION = 1 / STEPS_PER_MM  # mm per motor step
+
+
+def arc_command(gcode):
+    """
+    Which arc a cleaned line is: 'G2', 'G3', or None for anything else
+    (G28 and the like included, so 'G2' must not be followed by a digit)
+    """
+    if gcode[:2] in ARC_COMMANDS and not gcode[2:3].isdigit():
+        return gcode[:2]
+    return None
+
+
+def parse_arc(gcode):
+    """
+    Read the words of a cleaned G2/G3 line like parseMove() reads G0/G1
+    (the first two characters dropped, split on single spaces, later words
+    win over earlier ones with the same letter).
+
+    Returns:
+        dict: Letter -> value for the X, Y, Z, E, F, I, J and R words that were given
+    """
+    words = {}
+    for token in gcode[2:].strip().split(' '):
+        code = token[:1]
+        if code and code in 'XYZEFIJR':
+            words[code] = to_float(token[1:])
+    return words
+
+
+def centre_offsets(start, end, radius, clockwise):
+    """
+    I, J for arcs given by their radius (R): the centre lies on the side
+    of the chord that makes the arc turn the right way, and on the far
+    side for a negative radius (the arc longer than half a circle)
+
+    Args:
+        start, end: float64 (arcs, 2) XY
+        radius: float64 (arcs,)
+        clockwise: bool (arcs,)
+
+    Returns:
+        float64 (arcs, 2)
+    """
+    delta = end - start
+    distance = np.hypot(delta[:, 0], delta[:, 1])
+    # Further apart than the diameter: the centre is taken as the middle of the chord
+    height = np.sqrt(np.maximum(radius ** 2 - (distance / 2) ** 2, 0))
+    side = np.where(clockwise ^ (radius < 0), -1.0, 1.0)
+    normal = np.column_stack((-delta[:, 1], delta[:, 0])) / np.where(distance > 0, distance, 1)[:, None]
+    return delta / 2 + (side * height)[:, None] * normal
+
+
+def chords(start, end, offset, clockwise, tolerance=ARC_TOLERANCE):
+    """
+    Cut arcs into chords.
+
+    Args:
+        start, end: float64 (arcs, 4) X, Y, Z, E at each end
+        offset: float64 (arcs, 2) the centre relative to the start (I, J)
+        clockwise: bool (arcs,) G2 rather than G3
+        tolerance (float): mm the chords may stray from the arc
+
+    Returns:
+        tuple: (points, arc), points float64 (chords, 4) X, Y, Z, E at the end
+            of each chord in order (the last chord of an arc ends exactly at
+            its end), arc int64 (chords,) the arc each chord belongs to
+    """
+    centre = start[:, :2] + offset
+    radius = np.hypot(offset[:, 0], offset[:, 1])
+    end_offset = end[:, :2] - centre
+    first = np.arctan2(-offset[:, 1], -offset[:, 0])
+    last = np.arctan2(end_offset[:, 1], end_offset[:, 0])
+    sweep = np.where(clockwise, -((first - last) % (2 * np.pi)), (last - first) % (2 * np.pi))
+    full = (end[:, :2] == start[:, :2]).all(axis=1) & (radius > 0)  # Back where it started: a whole circle
+    sweep[full] = np.where(clockwise[full], -2 * np.pi, 2 * np.pi)
+
+    # A chord spanning `step` radians strays r * (1 - cos(step / 2)) from the arc
+    deviation = max(tolerance, RESOLUTION / 2)
+    step = 2 * np.arccos(np.clip(1 - deviation / np.where(radius > 0, radius, 1), -1, 1))
+    count = np.ceil(np.abs(sweep) / step)
+    count = np.minimum(count, np.floor(np.abs(sweep) * radius / RESOLUTION))  # No chord shorter than a step
+    count = np.maximum(count, 1).astype(np.int64)
+
+    arc = np.repeat(np.arange(len(start)), count)
+    chord_end = np.arange(len(arc)) - np.repeat(np.cumsum(count) - count, count) + 1
+    t = chord_end / count[arc]
+    angle = first[arc] + sweep[arc] * t
+    chord_radius = radius[arc] + (np.hypot(end_offset[:, 0], end_offset[:, 1]) - radius)[arc] * t
+    points = start[arc] + (end - start)[arc] * t[:, None]  # Z and E
+    points[:, 0] = centre[arc, 0] + chord_radius * np.cos(angle)
+    points[:, 1] = centre[arc, 1] + chord_radius * np.sin(angle)
+    last = t == 1
+    points[last] = end[arc[last]]  # Exactly
+    return points, arc
+
+
+def job_chords(job, states, tolerance=ARC_TOLERANCE):
+    """
+    The chords of every arc in a parsed job (see jobarrays.load / jobarrays.replay)
+
+    Returns:
+        tuple: (start, end, row), start and end float64 (chords, 4) X, Y, Z, E,
+            row int64 (chords,) the line of the file each chord comes from
+    """
+    rows = np.flatnonzero(job.is_arc())
+    before, after = states.before()[rows], states.position[rows]
+    words = job.words[rows]
+    offset = np.nan_to_num(words[:, 5:7])
+    clockwise = job.is_command('G2')[rows]
+    by_radius = np.isnan(words[:, 5:7]).all(axis=1) & ~np.isnan(words[:, 7])
+    offset[by_radius] = centre_offsets(before[by_radius, :2], after[by_radius, :2], words[by_radius, 7],
+                                       clockwise[by_radius])
+    points, arc = chords(before, after, offset, clockwise, tolerance)
+    start = np.empty_like(points)
+    start[1:] = points[:-1]
+    firsts = np.flatnonzero(np.diff(arc, prepend=-1))
+    start[firsts] = before[arc[firsts]]
+    return start, points, rows[arc]
+
+
+def expand(gcode, state, tolerance=ARC_TOLERANCE, precision=3):
+    """
+    The G1 chords of one cleaned G2/G3 line, for firmware in `state`
+    (gcode.MachineState, before the arc). They move in the same positioning
+    and extrusion modes, with X/Y on every chord, Z and E only if the arc
+    has them, and F on the first one.
+
+    Returns:
+        list: G1 lines
+    """
+    words = parse_arc(gcode)
+    start = np.array(state.coord)
+    end = start.copy()
+    for axis, code in enumerate(AXES):
+        if code in words:
+            absolute = state.absolute_extrusion if code == 'E' else state.absolute_positioning
+            end[axis] = words[code] if absolute else start[axis] + words[code]
+    clockwise = np.array([gcode[:2] == 'G2'])
+    if 'I' in words or 'J' in words or 'R' not in words:
+        offset = np.array([[words.get('I', 0.0), words.get('J', 0.0)]])
+    else:
+        offset = centre_offsets(start[None, :2], end[None, :2], np.array([words['R']]), clockwise)
+    points, _ = chords(start[None], end[None], offset, clockwise, tolerance)
+
+    codes = [axis for axis, code in enumerate(AXES) if axis < 2 or code in words]
+    relative = [not (state.absolute_extrusion if axis == 3 else state.absolute_positioning) for axis in range(4)]
+    # Relative moves are written as steps between the rounded points, so they add up to the whole move
+    rounded = np.round(points - start, precision)
+    steps = np.diff(rounded, axis=0, prepend=np.zeros((1, 4)))
+    lines = []
+    for i in range(len(points)):
+        line = ['G1'] + [AXES[axis] + format_number(steps[i, axis] if relative[axis] else points[i, axis], precision)
+                         for axis in codes]
+        if i == 0 and 'F' in words:
+            line.append('F' + format_number(words['F'], precision))
+        lines.append(' '.join(line))
+    return lines
@@ -0,0 +1,423 @@
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from array import array
+from collections import deque
+
+import binproto
+import portfinder
+import uploader
+
+# ---------------------
+# BENCHMARKS FOR THE HOST -> FIRMWARE PIPELINE
+# Each case runs in a fresh process against a fresh virtual printer
+# (emulator.py), so CPU time and peak memory belong to that case alone.
+#
+#     python benchmark.py                      # default suite
+#     python benchmark.py --segments 1000000   # add a million-segment job
+#     python benchmark.py --compare old.json new.json
+#     python benchmark.py --rates 115200 250000 500000 1000000 --mode binary --noise 1000000:1e-4
+#     python benchmark.py --record run.jsonl --port /dev/ttyUSB0 --job Gcode.txt
+#     python benchmark.py --replay run.jsonl
+# ---------------------
+
+JOB_DIR = 'bench_jobs'
+RESULTS_DIR = 'bench_results'
+DEFAULT_SEGMENTS = [1000, 10000]
+MODES = ['stream', 'blocking', 'send_gcode', 'binary']  # binary = stream with the binary protocol
+NOISY_ACK_TIMEOUT = 10  # Seconds to wait for "OK" with --noise (a corrupted text line can lose its "OK" for good)
+
+
+# ---------------------
+# SYNTHETIC JOBS
+# ---------------------
+
+def generate_job(segments, directory=JOB_DIR):
+    """
+    Write a job of `segments` short extruding moves that zig-zag inside the
+    print area (and stay inside the E limit). Reuses the file if it exists.
+
+    Returns:
+        str: Path of the job file
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"zigzag_{segments}.gcode")
+    if os.path.exists(path):
+        return path
+
+    e_per_segment = 90.0 / segments
+    with open(path, 'w') as f:
+        f.write("G90\nM82\nG92 X0 Y0 Z0 E0\nG1 Z0.2 F300\nG1 X10 Y10 F1500\n")
+        x, y, e = 10.0, 10.0, 0.0
+        step = 0.5
+        for i in range(segments):
+            x += step
+            if x > 120 or x < 10:
+                step = -step
+                x += 2 * step
+                y = 10 + (y - 10 + 0.5) % 110
+            e += e_per_segment
+            f.write(f"G1 X{x:.2f} Y{y:.2f} E{e:.5f}\n")
+        f.write("G1 Z5 F300\nM18\n")
+    return path
+
+
+# ---------------------
+# SERIAL WRAPPERS
+# ---------------------
+
+class RecordingSerial:
+    """
+    Wraps an open serial port (see uploader.attach), timestamps every write
+    and every line read, and matches each "OK" with the oldest unacknowledged
+    write to measure per-line round-trip latency. Binary records count as
+    one write each and their one-byte acknowledgement as an "OK".
+    Optionally saves a transcript (JSON lines).
+    """
+
+    def __init__(self, port, transcript=None):
+        self._port = port
+        self._transcript = open(transcript, 'w') if transcript else None
+        self._pending = deque()  # Write time of each line that has not seen its "OK"
+        self._line = bytearray()
+        self.latencies = array('d')
+
+    def __getattr__(self, name):
+        return getattr(self._port, name)
+
+    def _log(self, direction, data, now):
+        if self._transcript:
+            self._transcript.write(json.dumps({'t': now, 'dir': direction, 'data': data}) + '\n')
+
+    def write(self, data):
+        now = time.perf_counter()
+        if data[:1] == bytes([binproto.SYNC]):
+            self._pending.append(now)
+            self._log('tx', data.hex(), now)
+        else:
+            for line in data.decode().splitlines():
+                self._pending.append(now)
+                self._log('tx', line, now)
+        return self._port.write(data)
+
+    def _received(self, line, now):
+        self._log('rx', line, now)
+        if line == "OK" and self._pending:
+            self.latencies.append(now - self._pending.popleft())
+
+    def read(self, size=1):
+        raw = self._port.read(size)
+        now = time.perf_counter()
+        for byte in raw:
+            if byte in (binproto.REPLY_ACK, binproto.REPLY_BOUNDS):
+                self._received("OK", now)
+            elif byte == 0x0A:
+                self._received(self._line.decode(errors='replace').strip(), now)
+                self._line.clear()
+            else:
+                self._line.append(byte)
+        return raw
+
+    def close(self):
+        if self._transcript:
+            self._transcript.close()
+            self._transcript = None
+        self._port.close()
+
+
+class ReplaySerial:
+    """
+    Serial port stand-in that plays back a recorded transcript: every line
+    written gets the responses that followed the matching line in the
+    recording, with the same delays.
+    """
+
+    def __init__(self, transcript):
+        self._replies = deque()  # One [(delay, line), ...] list per recorded write
+        last_tx = None
+        with open(transcript) as f:
+            for entry in map(json.loads, f):
+                if entry['dir'] == 'tx':
+                    last_tx = entry['t']
+                    self._replies.append([])
+                elif last_tx is not None:
+                    self._replies[-1].append((entry['t'] - last_tx, entry['data']))
+        self._incoming = deque()  # (due time, line)
+        self._buffer = bytearray()  # Bytes of lines that are due but not read yet
+        self.is_open = True
+
+    def _collect_due(self):
+        now = time.perf_counter()
+        while self._incoming and self._incoming[0][0] <= now:
+            self._buffer += (self._incoming.popleft()[1] + '\n').encode()
+
+    @property
+    def in_waiting(self):
+        self._collect_due()
+        return len(self._buffer)
+
+    def write(self, data):
+        now = time.perf_counter()
+        for _ in data.decode().splitlines():
+            replies = self._replies.popleft() if self._replies else [(0, "OK")]
+            for delay, line in replies:
+                # Replies never overtake those of an earlier line
+                due = max(now + delay, self._incoming[-1][0] if self._incoming else 0)
+                self._incoming.append((due, line))
+        return len(data)
+
+    def read(self, size=1):
+        self._collect_due()
+        if not self._buffer:
+            if not self._incoming:
+                time.sleep(0.01)  # Behave like a read timeout instead of spinning
+                return b''
+            time.sleep(max(0, self._incoming[0][0] - time.perf_counter()))
+            self._collect_due()
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def close(self):
+        self.is_open = False
+
+
+# ---------------------
+# RUNNING A CASE
+# ---------------------
+
+def start_emulator(baudrate, motion, noise=()):
+    """Start emulator.py in its own process. Returns (process, port)."""
+    cmd = [sys.executable, '-u', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'emulator.py')]
+    if baudrate:
+        cmd += ['--baud', str(baudrate)]
+    if motion:
+        cmd.append('--motion')
+    for item in noise:
+        cmd += ['--noise', item]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    port = proc.stdout.readline().strip().rsplit(' ', 1)[-1]
+    return proc, port
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if platform.system() == 'Darwin' else peak / 1024
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, round(p / 100 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def _run_case(job, mode, port, transcript, replay, results, rate, noisy):
+    """Body of the child process for one case"""
+    baudrate = None
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        if replay:
+            recorder = RecordingSerial(ReplaySerial(replay), transcript)
+        else:
+            uploader.PORT = port
+            uploader.RESET_ON_CONNECT = False  # Nothing to reset, ping the emulator straight away
+            uploader.BINARY_PROTOCOL = mode == 'binary'
+            uploader.FAST_BAUDRATES = (rate,) if rate else ()
+            if noisy:
+                uploader.ACK_TIMEOUT = NOISY_ACK_TIMEOUT
+            portfinder.CACHE_PATH = None  # Emulators come and go, keep them out of the real cache
+            if not uploader.connect_arduino():
+                results.put({'error': f"could not connect to {port}"})
+                return
+            baudrate = uploader.connection.baudrate
+            recorder = RecordingSerial(uploader.detach(), transcript)
+        uploader.attach(recorder)
+        counters = uploader.connection.metrics.counters
+
+        call_latencies = array('d')
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+
+        if mode == 'send_gcode':
+            with open(job) as f:
+                for line in f:
+                    t = time.perf_counter()
+                    if uploader.send_gcode(line) is not None:
+                        call_latencies.append(time.perf_counter() - t)
+            uploader.close_connection()
+        else:
+            uploader.start_print(job, stream=(mode != 'blocking'))
+
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+
+    latencies = sorted(call_latencies if mode == 'send_gcode' else recorder.latencies)
+    lines = len(latencies)
+    results.put({
+        'lines': lines,
+        'wall_s': wall,
+        'cpu_s': cpu,
+        'lines_per_s': lines / wall if wall else None,
+        'latency_ms': {f"p{p}": (percentile(latencies, p) or 0) * 1000 for p in (50, 90, 99, 100)},
+        'peak_rss_mb': peak_rss_mb(),
+        'baudrate': baudrate,
+        # Lines the firmware rejected, complained about or never answered
+        'error_rate': (counters['naks'] + counters['errors'] + counters['timeouts']) / max(counters['lines'], 1),
+        'resent': counters['resent'],
+    })
+
+
+def run_case(job, mode, baudrate=115200, motion=False, transcript=None, replay=None, rate=None, noise=()):
+    """
+    Run one job through one send mode in a fresh process.
+
+    Args:
+        rate (int): Baud rate to negotiate up to after connecting (None stays at
+            uploader.BAUDRATE). The emulator's throttle follows it.
+        noise: 'BAUD:CHANCE' corruption for the emulator (see emulator.py --noise)
+
+    Returns:
+        dict: lines, wall_s, cpu_s, lines_per_s, latency_ms percentiles, peak_rss_mb,
+            the baud rate negotiated, error_rate per line sent and records resent
+    """
+    emulator_proc = port = None
+    if not replay:
+        emulator_proc, port = start_emulator(baudrate, motion, noise)
+
+    results = multiprocessing.Queue()
+    child = multiprocessing.Process(target=_run_case,
+                                    args=(job, mode, port, transcript, replay, results, rate, bool(noise)))
+    child.start()
+    result = results.get()
+    child.join()
+
+    if emulator_proc:
+        emulator_proc.terminate()
+        emulator_proc.wait()
+
+    result.update({'job': os.path.basename(job), 'mode': mode})
+    return result
+
+
+# ---------------------
+# RESULTS
+# ---------------------
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def save_results(cases, baudrate, directory=RESULTS_DIR):
+    """Write the results to <directory>/<commit>.json and return the path"""
+    os.makedirs(directory, exist_ok=True)
+    commit = git_commit()
+    path = os.path.join(directory, f"{commit}.json")
+    with open(path, 'w') as f:
+        json.dump({
+            'commit': commit,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'baudrate': baudrate,
+            'cases': cases,
+        }, f, indent=2)
+    return path
+
+
+def print_case(case):
+    if 'error' in case:
+        print(f"{case['job']:<24} {case['mode']:<11} ERROR: {case['error']}")
+        return
+    lat = case['latency_ms']
+    baud = f"{case['baudrate']:>8} baud  " if case.get('baudrate') else ''
+    print(f"{case['job']:<24} {case['mode']:<11} {baud}{case['lines']:>8} lines  "
+          f"{case['lines_per_s']:>9.1f} lines/s  "
+          f"p50 {lat['p50']:.2f} ms  p99 {lat['p99']:.2f} ms  "
+          f"errors {case.get('error_rate', 0):.2%}  "
+          f"cpu {case['cpu_s']:.2f} s  rss {case['peak_rss_mb']:.1f} MB")
+
+
+def compare(old_path, new_path):
+    """Print the lines/sec and CPU change of every case found in both files"""
+    def key(case, results):
+        return case['job'], case['mode'], case.get('baudrate') or results['baudrate']
+
+    with open(old_path) as f:
+        results = json.load(f)
+        old = {key(c, results): c for c in results['cases']}
+    with open(new_path) as f:
+        results = json.load(f)
+    for case in results['cases']:
+        before = old.get(key(case, results))
+        if not before or 'error' in case or 'error' in before:
+            continue
+        speed = (case['lines_per_s'] / before['lines_per_s'] - 1) * 100
+        cpu = (case['cpu_s'] / before['cpu_s'] - 1) * 100 if before['cpu_s'] else 0
+        print(f"{case['job']:<24} {case['mode']:<11} {key(case, results)[2] or '':>8} "
+              f"lines/s {speed:+.1f}%  cpu {cpu:+.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark uploader.py against a virtual printer")
+    parser.add_argument('--segments', type=int, nargs='*', default=DEFAULT_SEGMENTS,
+                        help="sizes of the synthetic jobs to generate")
+    parser.add_argument('--job', action='append', help="benchmark this G-code file (repeatable)")
+    parser.add_argument('--mode', choices=MODES, action='append', help="send modes to run (default: all)")
+    parser.add_argument('--baud', type=int, default=115200, help="baud rate the emulator throttles to (0 = off)")
+    parser.add_argument('--motion', action='store_true', help="let the emulator sleep for each move")
+    parser.add_argument('--rates', type=int, nargs='+', metavar='BAUD',
+                        help="run every case once per baud rate, negotiated up from --baud after connecting")
+    parser.add_argument('--noise', action='append', default=[], metavar='BAUD:CHANCE',
+                        help="have the emulator corrupt this fraction of the bytes it receives at a rate "
+                             "(repeatable, best with --mode binary)")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="compare two result files")
+    parser.add_argument('--record', metavar='TRANSCRIPT', help="record a transcript while printing --job")
+    parser.add_argument('--port', help="with --record: real serial port to print on")
+    parser.add_argument('--replay', metavar='TRANSCRIPT', help="replay a recorded transcript")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    if args.record:
+        # Talk to the real printer in this process
+        job = (args.job or ['Gcode.txt'])[0]
+        if args.port:
+            uploader.PORT = args.port
+        if uploader.connect_arduino():
+            uploader.attach(RecordingSerial(uploader.detach(), args.record))
+            uploader.start_print(job)
+            print(f"Transcript saved to {args.record}")
+        return
+
+    if args.replay:
+        case = run_case(args.job[0] if args.job else 'Gcode.txt', 'stream', replay=args.replay)
+        print_case(case)
+        return
+
+    jobs = args.job or ['Gcode.txt'] + [generate_job(n) for n in args.segments]
+    cases = []
+    for job in jobs:
+        for mode in args.mode or MODES:
+            for rate in args.rates or [None]:
+                case = run_case(job, mode, args.baud, args.motion, rate=rate, noise=args.noise)
+                print_case(case)
+                cases.append(case)
+    print(f"Results saved to {save_results(cases, args.baud)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+import struct
+
+from gcode import AXES, MOVE_COMMANDS, clean, command_of, parse_move, to_int
+
+# ---------------------
+# BINARY MOTION PROTOCOL
+# Opt-in alternative to sending G-code text (see uploader.enable_binary_mode).
+# The host sends "M990" as text; firmware that supports it answers "BINARY"
+# before its "OK" and from then on reads fixed-size records:
+#
+#   byte  0      SYNC (0xA5)
+#   byte  1      opcode (OP_*)
+#   byte  2      presence mask (bit 0..4 = X, Y, Z, E, F given)
+#   byte  3      sequence number (wraps at 256)
+#   bytes 4-19   X, Y, Z, E as int32 micrometres
+#   bytes 20-21  F as uint16 mm/min
+#   bytes 22-23  CRC-16/CCITT of bytes 0-21
+#
+# All fields are little endian. Every record gets a one-byte reply once it
+# has run: REPLY_ACK, or REPLY_BOUNDS if the move was out of bounds. A
+# record that cannot be run is answered with two bytes, REPLY_NAK (CRC
+# error) or REPLY_CAN (not the sequence number expected, because an earlier
+# record was rejected), followed by the sequence number the firmware expects
+# next. The host then sends everything from that record on again.
+# M114 and progress reports are still sent as text lines.
+# ---------------------
+
+SYNC = 0xA5
+RECORD = struct.Struct('<BBBBiiiiH')
+RECORD_SIZE = RECORD.size + 2  # + CRC
+
+OP_MOVE = 1           # G0 / G1
+OP_ABSOLUTE = 2       # G90
+OP_RELATIVE = 3       # G91
+OP_ABSOLUTE_E = 4     # M82
+OP_RELATIVE_E = 5     # M83
+OP_SET_POSITION = 6   # G92
+OP_HOME = 7           # G28
+OP_MOTORS_ON = 8      # M17
+OP_MOTORS_OFF = 9     # M18
+OP_REPORT = 10        # M114
+OP_SET_LINES = 11     # M100, line count in the X field (not scaled)
+OP_TEXT_MODE = 0x7F   # Go back to G-code text
+
+COMMAND_OPCODES = {
+    'G0': OP_MOVE, 'G1': OP_MOVE, 'G90': OP_ABSOLUTE, 'G91': OP_RELATIVE,
+    'M82': OP_ABSOLUTE_E, 'M83': OP_RELATIVE_E, 'G92': OP_SET_POSITION, 'G28': OP_HOME,
+    'M17': OP_MOTORS_ON, 'M18': OP_MOTORS_OFF, 'M114': OP_REPORT, 'M100': OP_SET_LINES,
+}
+
+REPLY_ACK = 0x06
+REPLY_BOUNDS = 0x07
+REPLY_NAK = 0x15
+REPLY_CAN = 0x18
+
+FIXED_POINT = 1000  # Units per mm
+MAX_FEEDRATE_FIELD = 0xFFFF
+
+
+def crc16(data, crc=0xFFFF):
+    """CRC-16/CCITT-FALSE (polynomial 0x1021), the same loop as crc16() in firmware.ino"""
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+            crc &= 0xFFFF
+    return crc
+
+
+def pack(opcode, seq, values=None):
+    """
+    Build one record.
+
+    Args:
+        opcode (int): One of OP_*
+        seq (int): Sequence number (only the low 8 bits are sent)
+        values (dict): Letter -> value for the X, Y, Z, E and F fields that are given
+    """
+    values = values or {}
+    mask = 0
+    fields = []
+    for bit, code in enumerate(AXES):
+        if code in values:
+            mask |= 1 << bit
+            fields.append(round(values[code] * FIXED_POINT))
+        else:
+            fields.append(0)
+    feedrate = 0
+    if 'F' in values:
+        mask |= 1 << 4
+        feedrate = min(max(round(values['F']), 0), MAX_FEEDRATE_FIELD)
+    body = RECORD.pack(SYNC, opcode, mask, seq & 0xFF, *fields, feedrate)
+    return body + struct.pack('<H', crc16(body))
+
+
+def encode(line, seq):
+    """
+    Turn one line of G-code into a record.
+
+    Returns:
+        bytes: The record, or None if the firmware would ignore the line
+    """
+    gcode = clean(line)
+    command = command_of(gcode)
+    if command not in COMMAND_OPCODES:
+        return None
+    values = None
+    if command in MOVE_COMMANDS or command == 'G92':
+        values = parse_move(gcode)
+    elif command == 'M100':
+        s_index = gcode.find('S')
+        if s_index == -1:
+            return None
+        values = {'X': to_int(gcode[s_index + 1:]) / FIXED_POINT}
+    return pack(COMMAND_OPCODES[command], seq, values)
+
+
+def decode(record):
+    """
+    Unpack a record.
+
+    Returns:
+        tuple: (opcode, seq, values) where values maps letter -> value for the fields given
+
+    Raises:
+        ValueError: If the record is the wrong size, not synchronised or fails its CRC
+    """
+    if len(record) != RECORD_SIZE or record[0] != SYNC:
+        raise ValueError("Not a record")
+    body, (crc,) = record[:-2], struct.unpack('<H', record[-2:])
+    if crc16(body) != crc:
+        raise ValueError("CRC mismatch")
+    _, opcode, mask, seq, x, y, z, e, f = RECORD.unpack(body)
+    values = {}
+    for bit, (code, raw) in enumerate(zip(AXES, (x, y, z, e))):
+        if mask & (1 << bit):
+            values[code] = raw / FIXED_POINT
+    if mask & (1 << 4):
+        values['F'] = float(f)
+    return opcode, seq, values
@@ -0,0 +1,57 @@
+#ifndef BLOCKQUEUE_H
+#define BLOCKQUEUE_H
+
+#include <stdint.h>
+
+// ---------------------
+// BLOCK QUEUE
+// Fixed-size ring buffer of preparsed commands between the serial parser
+// and the steppers. parseGCode() / handleRecord() plan each line into a
+// Block (step counts and speed profile worked out up front, see stepper.h)
+// as soon as a slot is free, and loop() steps through the oldest one a
+// pulse at a time, so the next lines are received and parsed while the
+// current move runs.
+// Nothing here touches the hardware, it builds on any C++ compiler.
+// ---------------------
+
+#define BLOCK_QUEUE_SIZE 8  // Power of two
+
+#define BLOCK_MOVE        1  // Step the motors together (stepper.h)
+#define BLOCK_MOTORS_ON   2  // M17
+#define BLOCK_MOTORS_OFF  3  // M18
+
+struct Block {
+  uint8_t type;              // BLOCK_*
+  int32_t steps[4];          // A, B, Z, E motor steps to take, signed by direction
+  uint32_t stepCount;        // Steps of the motor that moves most, one per tick
+  float initialRate;         // Ticks/s at the start and end of the move
+  float nominalRate;         // Ticks/s at the feedrate
+  float acceleration;        // Ticks/s^2
+  uint32_t accelerateUntil;  // Ticks spent speeding up
+  uint32_t decelerateAfter;  // Tick where slowing down starts
+};
+
+struct BlockQueue {
+  Block blocks[BLOCK_QUEUE_SIZE];
+  uint8_t head;   // Oldest block, the one being run
+  uint8_t count;  // Blocks waiting, including the one being run
+
+  void clear() { head = 0; count = 0; }
+  bool empty() const { return count == 0; }
+  bool full() const { return count == BLOCK_QUEUE_SIZE; }
+
+  // The free slot after the newest block, to be filled in and then push()ed
+  // (only while !full(): it is the oldest block otherwise)
+  Block *next() { return &blocks[(head + count) & (BLOCK_QUEUE_SIZE - 1)]; }
+  void push() { if (!full()) count++; }
+
+  // The oldest block, or 0 if there is none
+  Block *peek() { return empty() ? 0 : &blocks[head]; }
+  void pop() {
+    if (empty()) return;
+    head = (head + 1) & (BLOCK_QUEUE_SIZE - 1);
+    count--;
+  }
+};
+
+#endif
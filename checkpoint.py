@@ -0,0 +1,127 @@
+import json
+import os
+import time
+from collections import deque
+
+from gcode import MachineState, clean
+from metrics import log
+
+# ---------------------
+# JOB CHECKPOINTS
+# While a job is sent, the senders report every line the firmware has
+# acknowledged (on_ack). A Checkpoint keeps the number of lines done, the
+# byte offset the rest of the job starts at and the modal state the
+# firmware was left in, and saves them next to the job as <file>.checkpoint
+# every few seconds and whenever the job stops early. Resuming sends the
+# modal state back as a short preamble and carries on reading from that
+# offset, without reading or sending anything before it again:
+#
+#     checkpoint = Checkpoint.load(job) or Checkpoint(job)
+#     for gcode in checkpoint.preamble():
+#         uploader.send_gcode(gcode)
+#     uploader.stream_lines(checkpoint.lines(), job.percent_done, on_ack=checkpoint.acknowledged)
+#
+# The firmware acknowledges a line once it is planned into its block queue,
+# and only reads the next one while the queue has a free slot, so a command
+# is only known to have run once QUEUE_DEPTH more have been acknowledged.
+# The checkpoint stays that far behind: resuming may run a few moves again,
+# but never skips one.
+# ---------------------
+
+CHECKPOINT_SUFFIX = '.checkpoint'
+SAVE_INTERVAL = 5  # Seconds between saves while a job runs
+QUEUE_DEPTH = 8  # BLOCK_QUEUE_SIZE in blockqueue.h: acknowledged commands that may not have run yet
+
+
+class Checkpoint:
+    """
+    How far a job (jobfile.JobFile) got.
+
+    Args:
+        job (JobFile): The job being sent
+        line (int): Lines of the job already done, the next one to send is line `line` (0-based)
+        offset (int): Byte offset where that line starts
+        state (MachineState): Modal state of the firmware after those lines
+    """
+
+    def __init__(self, job, line=0, offset=0, state=None):
+        self.job = job
+        self.line = line
+        self.offset = offset
+        self.state = state or MachineState()
+        self._first_line = line  # The senders count lines from where this run started
+        self._queued = deque()  # (number, line) of the commands acknowledged in the last QUEUE_DEPTH
+        self._running = []  # Commands of the line after self.line that have run
+        self._last_save = time.time()
+
+    @property
+    def path(self):
+        return self.job.path + CHECKPOINT_SUFFIX
+
+    @classmethod
+    def load(cls, job):
+        """
+        The checkpoint saved for `job`.
+
+        Returns:
+            Checkpoint: Or None if there is none, or the file has changed since it was saved
+        """
+        try:
+            with open(job.path + CHECKPOINT_SUFFIX) as f:
+                data = json.load(f)
+            if data['size'] != job.size or data['mtime'] != job.mtime:
+                return None
+            return cls(job, data['line'], data['offset'], MachineState.from_dict(data['state']))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def acknowledged(self, number, line):
+        """
+        on_ack callback for the senders: the firmware has acknowledged a
+        command of line `number` (1-based, counted from where this run
+        started), i.e. planned it. The checkpoint moves on to the lines
+        whose commands were acknowledged QUEUE_DEPTH commands ago, which
+        have run.
+        """
+        self._queued.append((number, line))
+        while len(self._queued) > QUEUE_DEPTH:
+            done, command = self._queued.popleft()
+            self._running.append(command)
+            if self._queued[0][0] != done:  # The last command of its line (they are acknowledged together)
+                for command in self._running:
+                    self.state.apply(clean(command))
+                self._running.clear()
+                self.line = self._first_line + done
+        if time.time() - self._last_save >= SAVE_INTERVAL:
+            self.save()
+
+    def preamble(self):
+        """G-code that puts freshly reset firmware back in the state the job left it in"""
+        return self.state.preamble() if self.line else []
+
+    def lines(self):
+        """The lines of the job still to send"""
+        return self.job.lines(self.line, self.offset)
+
+    def save(self):
+        self.offset = self.job.offset_of(self.line)
+        self._last_save = time.time()
+        try:
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump({
+                    'size': self.job.size,
+                    'mtime': self.job.mtime,
+                    'line': self.line,
+                    'offset': self.offset,
+                    'state': self.state.to_dict(),
+                }, f)
+            os.replace(self.path + '.tmp', self.path)
+        except OSError as e:
+            log.warning("Could not save checkpoint: %s", e)
+
+    def remove(self):
+        """Forget the checkpoint once the job is done"""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
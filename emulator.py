@@ -0,0 +1,504 @@
+import argparse
+import math
+import os
+import random
+import threading
+import time
+import tty
+from collections import deque
+
+import binproto
+from gcode import AXES, MOVE_COMMANDS, clean, command_of, move_time, parse_move, parse_set_position, to_int
+
+# ---------------------
+# VIRTUAL PRINTER
+# Behaves like firmware.ino on the other end of a pseudo-terminal, so
+# uploader.py and GUI.py can be run without an Arduino on the bench:
+#
+#     printer = VirtualPrinter()
+#     uploader.PORT = printer.start()
+#     uploader.RESET_ON_CONNECT = False  # It cannot be reset, pinging it is quicker
+#     portfinder.CACHE_PATH = None  # Nothing to remember about a pty
+#     uploader.start_print('Gcode.txt')
+#
+# A pseudo-terminal has no baud rate of its own: the link is only as slow
+# as `baudrate` makes it, and only as unreliable as `noise` (corrupted
+# bytes per byte received at each rate) makes it, so high baud rates can
+# be tried without an Arduino that garbles them.
+#
+# Pseudo-terminals are POSIX only (Linux / macOS).
+# ---------------------
+
+
+def format_float(value):
+    """Format a float the way Arduino's Serial.print(float) does"""
+    return f"{value:.2f}"
+
+
+class VirtualPrinter:
+    """
+    Host-side stand-in for firmware.ino.
+
+    Args:
+        rx_buffer_size (int): Size of the emulated serial receive buffer.
+            Bytes that arrive while it is full are dropped, like on the Arduino.
+        baudrate (int): Throttle the link to this many baud (None = unthrottled)
+        simulate_motion (bool): Take as long as the steppers would. Moves are
+            planned into a queue of queue_size blocks and acknowledged straight
+            away, and lines are only read while the queue has room.
+        noise (dict): Baud rate -> chance that a byte received at that rate has a bit flipped
+    """
+
+    min_feedrate = 60.0
+    max_feedrate = 10000.0
+    max_coord = (130, 130, 400, 100)  # X, Y, Z, E
+    queue_size = 8  # BLOCK_QUEUE_SIZE in blockqueue.h
+    line_buffer_size = 128  # LINE_BUFFER_SIZE in firmware.ino, longer lines are cut short
+    idle_timeout = 30.0  # IDLE_TIMEOUT_MS in firmware.ino (seconds)
+    baud_rates = (115200, 250000, 500000, 1000000)  # baudRates in firmware.ino
+    boot_baud = 115200  # BAUD_RATE in firmware.ino
+    baud_trial = 2.0  # BAUD_TRIAL_MS in firmware.ino (seconds)
+
+    def __init__(self, rx_buffer_size=64, baudrate=None, simulate_motion=False, noise=None):
+        self.rx_buffer_size = rx_buffer_size
+        self.baudrate = baudrate
+        self.simulate_motion = simulate_motion
+        self.noise = noise or {}
+
+        self.port = None
+        self.overflow_bytes = 0  # Bytes dropped because the receive buffer was full
+        self.corrupted_bytes = 0  # Bytes received with a bit flipped (see noise)
+        self.lines_received = 0
+        self.link_baud = baudrate or self.boot_baud  # Rate the firmware's port is at
+        self._confirmed_baud = self.link_baud
+        self._baud_trial_end = None  # time.monotonic() the rate on trial is given up at
+        self._random = random.Random()
+
+        self._master_fd = None
+        self._slave_fd = None
+        self._rx_buffer = bytearray()
+        self._line = bytearray()  # Start of the G-code line being received
+        self._rx_ready = threading.Condition()
+        self._running = False
+        self._motors_enabled = True
+        self._blocks_done = deque()  # time.monotonic() when each queued block finishes
+        self._last_activity = time.monotonic()
+        self._threads = []
+
+        self.reset()
+
+    def reset(self):
+        """Put the firmware state back to what setup() leaves behind"""
+        self.feedrate = 1500.0
+        self.absolute_positioning = True
+        self.absolute_extrusion = True
+        self.coord = [0.0, 0.0, 0.0, 0.0]  # X, Y, Z, E
+        self.total_lines = 0
+        self.lines_processed = 0
+        self.last_percent_reported = -1
+        self.binary_mode = False
+        self.expected_seq = 0
+
+    # ---------------------
+    # PSEUDO-TERMINAL
+    # ---------------------
+
+    def start(self):
+        """
+        Open a pseudo-terminal and start answering on it.
+
+        Returns:
+            str: Device path to pass to serial.Serial() (e.g. uploader.PORT)
+        """
+        self._master_fd, self._slave_fd = os.openpty()
+        tty.setraw(self._slave_fd)  # No echo or newline translation on the line
+        self.port = os.ttyname(self._slave_fd)
+
+        self._running = True
+        self._threads = [
+            threading.Thread(target=self._receive_loop, daemon=True),
+            threading.Thread(target=self._main_loop, daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        # setup()'s banner. Opening the port discards it (there is no DTR to
+        # reset the emulator), so hosts get in by pinging.
+        self._send(["READY"])
+        return self.port
+
+    def stop(self):
+        """Stop answering and close the pseudo-terminal"""
+        self._running = False
+        with self._rx_ready:
+            self._rx_ready.notify_all()
+        for fd in (self._slave_fd, self._master_fd):
+            if fd is not None:
+                os.close(fd)
+        for thread in self._threads:
+            thread.join(timeout=2)
+        self._master_fd = self._slave_fd = None
+        self._threads = []
+
+    def _byte_time(self, n):
+        """Seconds it takes to move n bytes over the link (8N1 framing)"""
+        return n * 10 / self.baudrate if self.baudrate else 0
+
+    def _receive_loop(self):
+        """Move incoming bytes into the receive buffer, like the UART interrupt"""
+        while self._running:
+            try:
+                data = os.read(self._master_fd, 1 if self.baudrate else 4096)
+            except OSError:
+                return
+            if not data:
+                return
+            time.sleep(self._byte_time(len(data)))
+            data = self._corrupt(data)
+
+            with self._rx_ready:
+                room = self.rx_buffer_size - len(self._rx_buffer)
+                self._rx_buffer += data[:room]
+                self.overflow_bytes += max(0, len(data) - room)
+                self._rx_ready.notify()
+
+    def _corrupt(self, data):
+        """Flip a bit in the bytes the noise at the current rate hits"""
+        chance = self.noise.get(self.link_baud, 0)
+        if not chance:
+            return data
+        data = bytearray(data)
+        for i in range(len(data)):
+            if self._random.random() < chance:
+                data[i] ^= 1 << self._random.randrange(8)
+                self.corrupted_bytes += 1
+        return bytes(data)
+
+    def _main_loop(self):
+        """Equivalent of loop() in firmware.ino"""
+        while self._running:
+            self._check_baud_trial()
+            self._wait_for_room()
+            line = self._read_record() if self.binary_mode else self._read_line()
+            if line is None:
+                self._check_idle()
+                continue
+
+            self._last_activity = time.monotonic()
+            self.lines_received += 1
+            if isinstance(line, bytes):
+                output = self.process_record(line)
+                if output.unread:
+                    with self._rx_ready:
+                        self._rx_buffer[:0] = output.unread
+            else:
+                output = self.process_line(line)
+            if self.simulate_motion and output.motion_time:
+                self._queue_motion(output.motion_time)
+            self._send(output, output.reply)
+            if output.baudrate:
+                # Everything after the OK is at the new rate, on trial until M993 comes
+                self._switch_baud(output.baudrate)
+                self._baud_trial_end = time.monotonic() + self.baud_trial
+
+    # ---------------------
+    # BAUD RATE (M991 / M992 / M993 in firmware.ino)
+    # ---------------------
+
+    def _switch_baud(self, rate):
+        """switchBaud(): the throttle (if any) follows the rate, the half-received line is lost"""
+        self.link_baud = rate
+        if self.baudrate:
+            self.baudrate = rate
+        self._line.clear()
+
+    def _check_baud_trial(self):
+        """Go back to the confirmed rate if M993 has not come in time"""
+        if self._baud_trial_end is not None and time.monotonic() >= self._baud_trial_end:
+            self._baud_trial_end = None
+            self._switch_baud(self._confirmed_baud)
+
+    # ---------------------
+    # BLOCK QUEUE (blockqueue.h / runSteppers() in firmware.ino)
+    # ---------------------
+
+    def _queue_motion(self, seconds):
+        """Plan a move that starts once the ones before it are done"""
+        now = time.monotonic()
+        start = max(now, self._blocks_done[-1]) if self._blocks_done else now
+        self._blocks_done.append(start + seconds)
+        self._motors_enabled = True
+
+    def _drop_done_blocks(self):
+        now = time.monotonic()
+        while self._blocks_done and self._blocks_done[0] <= now:
+            self._last_activity = self._blocks_done.popleft()
+
+    def _wait_for_room(self):
+        """loop() leaves the serial buffer alone while every slot of the queue is taken"""
+        self._drop_done_blocks()
+        while self._running and len(self._blocks_done) >= self.queue_size:
+            time.sleep(max(self._blocks_done[0] - time.monotonic(), 0))
+            self._drop_done_blocks()
+
+    def _check_idle(self):
+        """Disable the motors once nothing has happened for idle_timeout"""
+        self._drop_done_blocks()
+        if (self._motors_enabled and not self._blocks_done
+                and time.monotonic() - self._last_activity >= self.idle_timeout):
+            self._motors_enabled = False
+            if not self.binary_mode:
+                self._send(["Motors disabled after idle timeout"])
+
+    def _read_record(self):
+        """
+        readBinary(): skip to a sync byte and wait for a whole record.
+        Returns None if nothing is waiting.
+        """
+        with self._rx_ready:
+            while True:
+                start = self._rx_buffer.find(bytes([binproto.SYNC]))
+                if start == -1:
+                    self._rx_buffer.clear()
+                elif start:
+                    del self._rx_buffer[:start]
+                if len(self._rx_buffer) >= binproto.RECORD_SIZE:
+                    record = bytes(self._rx_buffer[:binproto.RECORD_SIZE])
+                    del self._rx_buffer[:binproto.RECORD_SIZE]
+                    return record
+                if not self._running or not self._rx_ready.wait(0.05) and not self._rx_buffer:
+                    return None
+
+    def _read_line(self):
+        """
+        readLine(): move what has arrived into the line buffer, and return the
+        line once it is whole. Returns None if it is not yet.
+        """
+        with self._rx_ready:
+            if not self._rx_buffer:
+                self._rx_ready.wait(0.05)
+            end = self._rx_buffer.find(b'\n')
+            taken = self._rx_buffer[:end] if end != -1 else self._rx_buffer[:]
+            del self._rx_buffer[:len(taken) + (end != -1)]
+        self._line += taken[:self.line_buffer_size - 1 - len(self._line)]
+        if end == -1:
+            return None
+        line = bytes(self._line)
+        self._line.clear()
+        return line.decode(errors='replace')
+
+    def _send(self, lines, reply=b''):
+        """Serial.println() each line back to the host, then Serial.write() the binary reply"""
+        data = ''.join(line + '\r\n' for line in lines).encode() + reply
+        try:
+            os.write(self._master_fd, data)
+        except OSError:
+            return
+        time.sleep(self._byte_time(len(data)))
+
+    # ---------------------
+    # G-CODE (mirrors parseGCode / parseMove in firmware.ino)
+    # ---------------------
+
+    def process_line(self, line):
+        """
+        Run one line through the emulated firmware.
+
+        Returns:
+            Response: The lines the firmware prints, ending in the echo and "OK".
+                response.motion_time is how long the steppers take for it (seconds).
+        """
+        output = Response()
+
+        gcode = clean(line)
+        command = command_of(gcode)
+        if command in MOVE_COMMANDS:
+            self._execute_move(parse_move(gcode), output)
+        elif command == 'G92':
+            self._set_position(parse_set_position(gcode), output)
+        elif command == 'M100':
+            s_index = gcode.find('S')
+            if s_index != -1:
+                self._set_total_lines(to_int(gcode[s_index + 1:]), output)
+        elif command is not None:
+            self._run(command, output)
+        elif gcode.startswith("M990"):
+            output.append("BINARY")
+        elif gcode.startswith("M991"):
+            b_index = gcode.find('B')
+            rate = to_int(gcode[b_index + 1:]) if b_index != -1 else 0
+            if rate in self.baud_rates:
+                output.append(f"BAUD {rate}")
+                output.baudrate = rate
+            else:
+                output.append("ERROR: Unsupported baud rate")
+        elif gcode.startswith("M992"):
+            output.append(f"CHECK {binproto.crc16(gcode[5:].encode()):X}")
+        elif gcode.startswith("M993"):
+            self._baud_trial_end = None
+            self._confirmed_baud = self.link_baud
+
+        output.append(gcode)
+        output.append("OK")
+        if gcode.startswith("M990"):
+            # Everything after the OK is binary
+            self.binary_mode = True
+            self.expected_seq = 0
+
+        self._update_progress(output)
+        return output
+
+    def process_record(self, record):
+        """
+        Run one binary record (binproto.py) through the emulated firmware.
+
+        Returns:
+            Response: Any text lines printed, with the one-byte reply in response.reply.
+                If the CRC was wrong, response.unread holds the bytes that are
+                searched for the start of the next record.
+        """
+        output = Response()
+        try:
+            opcode, seq, values = binproto.decode(record)
+        except ValueError:
+            output.reply = bytes([binproto.REPLY_NAK, self.expected_seq])
+            start = record.find(bytes([binproto.SYNC]), 1)
+            output.unread = record[start:] if start != -1 else b''
+            return output
+
+        if seq != self.expected_seq:
+            # Behind: already ran and the host missed the reply. Ahead: an earlier record was rejected.
+            if (self.expected_seq - seq) % 256 <= 128:
+                output.reply = bytes([binproto.REPLY_ACK])
+            else:
+                output.reply = bytes([binproto.REPLY_CAN, self.expected_seq])
+            return output
+        self.expected_seq = (self.expected_seq + 1) % 256
+
+        in_bounds = True
+        if opcode == binproto.OP_MOVE:
+            in_bounds = self._execute_move(values, output)
+        elif opcode == binproto.OP_SET_POSITION:
+            values.pop('F', None)
+            self._set_position(values or dict.fromkeys(AXES, 0.0), output)
+        elif opcode == binproto.OP_SET_LINES:
+            self._set_total_lines(round(values.get('X', 0) * binproto.FIXED_POINT), output)
+        elif opcode == binproto.OP_TEXT_MODE:
+            self.binary_mode = False
+        elif opcode in _OPCODE_COMMANDS:
+            self._run(_OPCODE_COMMANDS[opcode], output)
+
+        output.reply = bytes([binproto.REPLY_ACK if in_bounds else binproto.REPLY_BOUNDS])
+        self._update_progress(output)
+        return output
+
+    def _info(self, output, message):
+        """Status messages are only printed in text mode"""
+        if not self.binary_mode:
+            output.append(message)
+
+    def _run(self, command, output):
+        """The commands without arguments"""
+        if command == 'G90':
+            self.absolute_positioning = True
+            self._info(output, "Switched to Absolute Positioning (G90)")
+        elif command == 'G91':
+            self.absolute_positioning = False
+            self._info(output, "Switched to Relative Positioning (G91)")
+        elif command == 'M82':
+            self.absolute_extrusion = True
+            self._info(output, "Switched to Absolute Extrusion (M82)")
+        elif command == 'M83':
+            self.absolute_extrusion = False
+            self._info(output, "Switched to Relative Extrusion (M83)")
+        elif command == 'G28':
+            self.coord[0] = self.coord[1] = self.coord[2] = 0.0
+            self._info(output, "Soft homing: Current position set to (0,0,0)")
+        elif command == 'M17':
+            self._motors_enabled = True
+            self._info(output, "Motors enabled via M17")
+        elif command == 'M18':
+            self._motors_enabled = False
+            self._info(output, "Motors disabled via M18")
+        elif command == 'M114':
+            x, y, z, e = (format_float(c) for c in self.coord)
+            output.append(f"X:{x} Y:{y} Z:{z} E:{e}")
+
+    def _set_position(self, values, output):
+        """setPosition(): values maps axis letter -> new position"""
+        for code, value in values.items():
+            self.coord[AXES.index(code)] = value
+        self._info(output, "Position set via G92")
+
+    def _set_total_lines(self, total, output):
+        self.total_lines = total
+        self.lines_processed = 0
+        self.last_percent_reported = -1
+        self._info(output, f"Total lines set: {self.total_lines}")
+
+    def _update_progress(self, output):
+        self.lines_processed += 1
+        if self.total_lines > 0:
+            percent = (100 * self.lines_processed) // self.total_lines
+            if percent != self.last_percent_reported and percent % 5 == 0:
+                output.append(f"Progress: {percent}%")
+                self.last_percent_reported = percent
+
+    def _execute_move(self, words, output):
+        """executeMove(): returns False if the move went out of bounds"""
+        x, y, z, e, f = (words.get(code, math.nan) for code in 'XYZEF')
+
+        if not math.isnan(f):
+            self.feedrate = min(max(f, self.min_feedrate), self.max_feedrate)
+
+        # The firmware plans the move and updates coord[] first, then checks
+        # the bounds of the position it has already reached, so out of bounds
+        # moves still happen and are only reported.
+        targets = (x, y, z, e)
+        deltas = [0.0] * 4
+        for axis, value in enumerate(targets):
+            if math.isnan(value):
+                continue
+            absolute = self.absolute_extrusion if axis == 3 else self.absolute_positioning
+            deltas[axis] = value - self.coord[axis] if absolute else value
+            self.coord[axis] += deltas[axis]
+        output.motion_time = move_time(deltas, self.feedrate)
+
+        if any(c < 0 or c > limit for c, limit in zip(self.coord, self.max_coord)):
+            self._info(output, "ERROR: Movement exceeds boundary limits. Command skipped.")
+            return False
+        return True
+
+
+# Opcodes that map onto a command without arguments
+_OPCODE_COMMANDS = {opcode: command for command, opcode in binproto.COMMAND_OPCODES.items()
+                    if opcode not in (binproto.OP_MOVE, binproto.OP_SET_LINES)}
+
+
+class Response(list):
+    """
+    Lines printed for one command, plus how long its move takes,
+    in binary mode the one-byte reply, and the baud rate M991 switches to
+    """
+    motion_time = 0.0
+    reply = b''
+    unread = b''
+    baudrate = None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a virtual CeraTech printer on a pseudo-terminal")
+    parser.add_argument('--rx-buffer', type=int, default=64, help="receive buffer size in bytes")
+    parser.add_argument('--baud', type=int, default=None, help="throttle the link to this baud rate")
+    parser.add_argument('--motion', action='store_true', help="sleep for the time each move would take")
+    parser.add_argument('--noise', action='append', default=[], metavar='BAUD:CHANCE',
+                        help="flip a bit in this fraction of the bytes received at a baud rate (repeatable)")
+    args = parser.parse_args()
+
+    noise = {int(rate): float(chance) for rate, chance in (item.split(':') for item in args.noise)}
+    printer = VirtualPrinter(args.rx_buffer, args.baud, args.motion, noise)
+    print(f"Virtual printer listening on {printer.start()}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        printer.stop()
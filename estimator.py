@@ -0,0 +1,159 @@
+import copy
+
+import numpy as np
+
+import arcs
+import jobarrays
+from gcode import ACCELERATION, START_SPEED, STEPS_PER_MM
+
+# ---------------------
+# PRINT-TIME ESTIMATES
+# Works out how long the firmware takes to run each line of a job, with the
+# speed profile of its step generator (stepper.h, gcode.move_time): each
+# move speeds up from START_SPEED to the feedrate (clamped to
+# minFeedrate..maxFeedrate) at ACCELERATION and slows down again by its
+# end, along the XYZ path. The cumulative time table turns the line a
+# sender has reached into progress and time left by predicted time instead
+# of by line count:
+#
+#     estimate = estimate_file('job.gcode')
+#     estimate.percent_done(line), estimate.remaining(line)
+# ---------------------
+
+
+
+class TimeEstimate:
+    """
+    Predicted run time of a job.
+
+    Progress is asked for by the number of lines done, counted from
+    `first_line` (0-based line of the file a run starts from, e.g. when
+    resuming), which is how the senders count them.
+
+    Attributes:
+        duration: float64 (lines,) seconds each line of the file takes
+        elapsed: float64 (lines,) seconds from the start of the job to the end of each line
+    """
+
+    def __init__(self, duration, first_line=0):
+        self.duration = duration
+        self.elapsed = np.cumsum(duration)
+        self.first_line = first_line
+
+    @property
+    def total(self):
+        """Seconds the whole job takes"""
+        return float(self.elapsed[-1]) if len(self.elapsed) else 0.0
+
+    def starting_at(self, first_line):
+        """The same estimate for a run that starts at line `first_line` (0-based)"""
+        estimate = copy.copy(self)
+        estimate.first_line = first_line
+        return estimate
+
+    def elapsed_at(self, current_line):
+        """Seconds of the job done once `current_line` lines of this run have run"""
+        line = min(self.first_line + current_line, len(self.elapsed))
+        return float(self.elapsed[line - 1]) if line else 0.0
+
+    def percent_done(self, current_line):
+        """Progress in percent by predicted time"""
+        if not self.total:
+            return 100.0 if self.first_line + current_line >= len(self.elapsed) else 0.0
+        return self.elapsed_at(current_line) / self.total * 100
+
+    def remaining(self, current_line):
+        """Predicted seconds left once `current_line` lines of this run have run"""
+        return self.total - self.elapsed_at(current_line)
+
+    def __call__(self, current_line):
+        """The senders' total_lines (see printer.percent_done)"""
+        return self.percent_done(current_line)
+
+
+def line_durations(job, states=None):
+    """
+    Seconds the firmware takes to run each line.
+
+    Args:
+        job (JobArrays): The parsed job
+        states (MachineStates): jobarrays.replay(job), if already worked out
+
+    Returns:
+        float64 (lines,): 0 for lines that do not move
+    """
+    states = states or jobarrays.replay(job)
+    move = job.is_move()
+    delta = np.where(move[:, None] & job.given()[:, :4], states.position - states.before(), 0.0)
+    duration = move_durations(delta, states.feedrate)
+
+    # Arcs run as the chords they are cut into, each one speeding up and slowing down
+    start, end, row = arcs.job_chords(job, states)
+    np.add.at(duration, row, move_durations(end - start, states.feedrate[row]))
+    return duration
+
+
+def move_durations(delta, feedrate):
+    """
+    move_time() of many moves at once.
+
+    Args:
+        delta: float64 (moves, 4) X, Y, Z, E distances in mm
+        feedrate: float64 (moves,) mm/min, already clamped
+
+    Returns:
+        float64 (moves,)
+    """
+    # Motor steps as planMove() works them out (Arduino round(): halves away from zero)
+    steps = np.copysign(np.floor(np.abs(delta) * STEPS_PER_MM + 0.5), delta)
+    x, y, z, e = steps.T
+    step_count = np.max(np.abs([x + y, x - y, z, e]), axis=0)
+    length = np.where((x != 0) | (y != 0) | (z != 0), np.linalg.norm(delta[:, :3], axis=1), np.abs(delta[:, 3]))
+
+    # trapezoid_time() for every move with steps at once
+    moving = step_count > 0
+    step_count, length, speed = step_count[moving], length[moving], feedrate[moving] / 60
+    steps_per_mm = step_count / length
+    nominal = speed * steps_per_mm
+    initial = np.minimum(START_SPEED, speed) * steps_per_mm
+    acceleration = ACCELERATION * steps_per_mm
+    ramp = np.minimum(np.ceil((nominal ** 2 - initial ** 2) / (2 * acceleration)), step_count // 2)
+    peak = np.minimum(np.sqrt(initial ** 2 + 2 * acceleration * ramp), nominal)
+    duration = np.zeros(len(delta))
+    duration[moving] = 2 * (peak - initial) / acceleration + (step_count - 2 * ramp) / peak
+    return duration
+
+
+def estimate(job, states=None):
+    """TimeEstimate for a parsed job (see line_durations)"""
+    return TimeEstimate(line_durations(job, states))
+
+
+def estimate_file(path):
+    """TimeEstimate for a G-code file"""
+    return estimate(jobarrays.load(path))
+
+
+def format_duration(seconds):
+    """H:MM:SS"""
+    seconds = max(int(round(seconds)), 0)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+def main():
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Predict how long the firmware takes to run a G-code file")
+    parser.add_argument('file')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    estimate = estimate_file(args.file)
+    took = time.perf_counter() - start
+    print(f"{len(estimate.duration)} lines, {format_duration(estimate.total)} "
+          f"({estimate.total:.1f} s), estimated in {took:.2f} s")
+
+
+if __name__ == '__main__':
+    main()
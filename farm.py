@@ -0,0 +1,361 @@
+import argparse
+import contextlib
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+import estimator
+import pipeline
+import portfinder
+import uploader
+from jobfile import JobFile
+
+# ---------------------
+# PRINTER FARM
+# Runs a bench of identical boards at once. Every board portfinder.find_ports()
+# finds is named by its USB serial number and gets a worker process of its
+# own, with its own uploader connection, so a board that stalls or drops off
+# only holds up its own job. Jobs wait in one queue and the next idle worker
+# takes the next file. Workers send their status back to the farm, which
+# keeps the state of every printer and the throughput of the whole bench:
+#
+#     farm = PrinterFarm()  # Every board plugged in
+#     for path in ['a.gcode', 'b.gcode', 'c.gcode']:
+#         farm.submit(path)
+#     farm.wait()
+#     farm.print_status()
+#     farm.stop()
+#
+# python farm.py --emulate 4 job.gcode ... runs the same on virtual printers (emulator.py).
+# ---------------------
+
+IDLE = 'idle'
+CONNECTING = 'connecting'
+PRINTING = 'printing'
+STALLED = 'stalled'  # Printing, but no progress for STALL_TIMEOUT
+FAILED = 'failed'    # A job failed on it (timeout, connection lost), takes no more jobs
+OFFLINE = 'offline'  # Could not connect, or its worker has stopped (or died)
+
+STATUS_INTERVAL = 0.5  # Seconds between progress updates from a worker
+STALL_TIMEOUT = 30  # Seconds without progress before a printing board counts as stalled
+MAX_ATTEMPTS = 2  # Printers a job is tried on before it is given up
+WATCH_INTERVAL = 1.0  # Seconds between checks for workers that died without a word (crash, OOM, kill)
+
+
+def _print_job(path, update):
+    """Send one file on the worker's connection, reporting progress. Returns the sender's stats."""
+    with JobFile(path) as job:
+        estimate = estimator.estimate_file(path)
+        last_update = 0
+
+        def on_progress(current_line, percent, line):
+            nonlocal last_update
+            now = time.monotonic()
+            if now - last_update >= STATUS_INTERVAL:
+                last_update = now
+                update(percent=percent, remaining=estimate.remaining(current_line))
+
+        stats = uploader.stream_lines(pipeline.preprocess(job.lines()), estimate, on_progress)
+    update(percent=100.0, remaining=0.0)
+    return stats
+
+
+def _run_printer(name, port, jobs, updates, log_path, ack_timeout, reset, port_cache):
+    """Body of the worker process for one printer"""
+    def update(**fields):
+        updates.put((name, fields))
+
+    with open(log_path or os.devnull, 'a') as log, contextlib.redirect_stdout(log):
+        uploader.PORT = port
+        uploader.ACK_TIMEOUT = ack_timeout
+        uploader.RESET_ON_CONNECT = reset
+        portfinder.CACHE_PATH = port_cache
+        if not uploader.connect_arduino():
+            update(state=OFFLINE, error=f"Could not connect to {port}")
+            return
+        update(state=IDLE)
+
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            path, attempt = job
+            update(state=PRINTING, job=path, percent=0.0, remaining=None, started=job)
+            try:
+                stats = _print_job(path, update)
+            except Exception as e:
+                print(f"Print job failed: {e}")
+                uploader.close_connection()
+                update(state=FAILED, job=None, error=str(e), failed=job)
+                return
+            update(state=IDLE, job=None, percent=None, remaining=None, finished=(path, stats))
+
+        uploader.close_connection()
+    update(state=OFFLINE)
+
+
+class PrinterFarm:
+    """
+    Sends jobs to several printers at once, one worker process per printer.
+
+    Args:
+        printers (dict): {name: port}, default every board plugged in, by USB serial number
+        log_dir (str): Write what each worker prints to <log_dir>/<name>.log (default: discard it)
+        ack_timeout (float): uploader.ACK_TIMEOUT for the workers, how long a silent board
+            has before its job fails and goes to another printer
+        reset (bool): uploader.RESET_ON_CONNECT for the workers
+        port_cache (str): portfinder.CACHE_PATH for the workers, None to remember nothing (emulators)
+
+    Attributes:
+        finished: (path, printer name, stats) of every job done
+        failed: (path, error) of every job given up
+    """
+
+    def __init__(self, printers=None, log_dir=None, ack_timeout=uploader.ACK_TIMEOUT, reset=True,
+                 port_cache=portfinder.CACHE_PATH):
+        if printers is None:
+            printers = {serial_number: port for port, serial_number in portfinder.find_ports()}
+        if log_dir:
+            os.makedirs(log_dir, exist_ok=True)
+
+        self.finished = []
+        self.failed = []
+        self._jobs = multiprocessing.Queue()
+        self._updates = multiprocessing.Queue()
+        self._changed = threading.Condition()
+        self._pending = 0  # Jobs submitted and neither finished nor given up
+        self._printing = {}  # name -> (path, attempt) of the job each printer has
+        self._start = time.monotonic()
+        self._status = {
+            name: {'port': port, 'state': CONNECTING, 'job': None, 'percent': None, 'remaining': None,
+                   'jobs_done': 0, 'lines': 0, 'bytes': 0, 'busy': 0.0, 'error': None, 'updated': self._start}
+            for name, port in printers.items()
+        }
+        self._workers = {
+            name: multiprocessing.Process(
+                target=_run_printer, daemon=True,
+                args=(name, port, self._jobs, self._updates,
+                      os.path.join(log_dir, f"{name}.log") if log_dir else None, ack_timeout, reset, port_cache))
+            for name, port in printers.items()
+        }
+        for worker in self._workers.values():
+            worker.start()
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+    def submit(self, path):
+        """Queue a G-code file for the next idle printer"""
+        with self._changed:
+            self._pending += 1
+        self._jobs.put((path, 1))
+
+    def _live(self):
+        return [name for name, status in self._status.items() if status['state'] not in (FAILED, OFFLINE)]
+
+    def _collect(self):
+        """Apply the updates the workers send (on a thread of the parent process)"""
+        last_check = time.monotonic()
+        while True:
+            try:
+                name, fields = self._updates.get(timeout=WATCH_INTERVAL)
+            except queue.Empty:
+                pass
+            else:
+                if name is None:
+                    return
+                self._apply(name, fields)
+            if time.monotonic() - last_check >= WATCH_INTERVAL:
+                last_check = time.monotonic()
+                if not self._check_workers():
+                    return
+
+    def _apply(self, name, fields):
+        with self._changed:
+            status = self._status[name]
+            started = fields.pop('started', None)
+            finished = fields.pop('finished', None)
+            failed = fields.pop('failed', None)
+            status.update(fields, updated=time.monotonic())
+
+            if started:
+                self._printing[name] = started
+            if finished:
+                path, stats = finished
+                status['jobs_done'] += 1
+                status['lines'] += stats['lines']
+                status['bytes'] += stats['bytes']
+                status['busy'] += stats['elapsed']
+                self.finished.append((path, name, stats))
+                self._pending -= 1
+                self._printing.pop(name, None)
+            if failed:
+                self._printing.pop(name, None)
+                self._retry(failed, fields.get('error'))
+            self._changed.notify_all()
+
+    def _retry(self, job, error):
+        """A job failed on a printer: queue it for another one, or give it up (with self._changed held)"""
+        path, attempt = job
+        if attempt < MAX_ATTEMPTS and self._live():
+            self._jobs.put((path, attempt + 1))  # Another printer tries it
+        else:
+            self.failed.append((path, error))
+            self._pending -= 1
+
+    def _check_workers(self):
+        """
+        Take printers whose worker process died without saying so offline,
+        and hand their job to another printer. A worker that exits on its
+        own has sent its last update (exit code 0).
+
+        Returns:
+            bool: False if the farm was stopped meanwhile
+        """
+        dead = [name for name, worker in self._workers.items() if worker.exitcode]
+        if not dead:
+            return True
+        # What they managed to send before dying is in the queue already, and counts
+        while True:
+            try:
+                name, fields = self._updates.get_nowait()
+            except queue.Empty:
+                break
+            if name is None:
+                return False
+            self._apply(name, fields)
+        with self._changed:
+            for name in dead:
+                status = self._status[name]
+                if status['state'] in (FAILED, OFFLINE):
+                    continue
+                error = f"Worker died (exit code {self._workers[name].exitcode})"
+                status.update(state=OFFLINE, job=None, percent=None, remaining=None, error=error,
+                              updated=time.monotonic())
+                job = self._printing.pop(name, None)
+                if job:
+                    self._retry(job, error)
+            self._changed.notify_all()
+        return True
+
+    def wait(self, timeout=None):
+        """
+        Wait until every job submitted is finished or given up. Jobs still
+        queued when no printer is left to take them are given up.
+
+        Returns:
+            bool: False if the timeout expired first
+        """
+        with self._changed:
+            if not self._changed.wait_for(lambda: not self._pending or not self._live(), timeout):
+                return False
+            while self._pending and not self._live():
+                try:
+                    path, _ = self._jobs.get(timeout=0.1)
+                except queue.Empty:
+                    break  # Failed on a printer, already counted
+                self.failed.append((path, "No printer left to take it"))
+                self._pending -= 1
+            return True
+
+    def status(self):
+        """
+        Returns:
+            dict: {name: status dict} of every printer (state, port, job, percent,
+                remaining seconds, jobs_done, lines, bytes, busy seconds, error)
+        """
+        now = time.monotonic()
+        with self._changed:
+            status = {name: dict(s) for name, s in self._status.items()}
+        for s in status.values():
+            if s['state'] == PRINTING and now - s['updated'] > STALL_TIMEOUT:
+                s['state'] = STALLED
+            del s['updated']
+        return status
+
+    def throughput(self):
+        """
+        Returns:
+            dict: Jobs, lines and bytes sent by the whole farm, the seconds since
+                it started and the lines/bytes per second over that time
+        """
+        elapsed = max(time.monotonic() - self._start, 1e-9)
+        with self._changed:
+            lines = sum(s['lines'] for s in self._status.values())
+            total_bytes = sum(s['bytes'] for s in self._status.values())
+            jobs = len(self.finished)
+        return {'jobs': jobs, 'lines': lines, 'bytes': total_bytes, 'elapsed': elapsed,
+                'lines_per_s': lines / elapsed, 'bytes_per_s': total_bytes / elapsed}
+
+    def print_status(self):
+        """Print one line per printer and the farm's throughput"""
+        for name, s in self.status().items():
+            doing = s['job'] or ''
+            if s['percent'] is not None:
+                doing += f" {s['percent']:.1f}%"
+            if s['remaining'] is not None:
+                doing += f" ({estimator.format_duration(s['remaining'])} left)"
+            if s['state'] in (FAILED, OFFLINE) and s['error']:
+                doing = s['error']
+            print(f"{name:<20} {s['state']:<10} {s['jobs_done']:>4} jobs  {doing}")
+        t = self.throughput()
+        print(f"Farm: {t['jobs']} jobs, {t['lines']} lines ({t['bytes']} bytes) in {t['elapsed']:.1f} s: "
+              f"{t['lines_per_s']:.1f} lines/sec, {t['bytes_per_s']:.0f} bytes/sec")
+
+    def stop(self, timeout=5):
+        """Let the workers finish their current job, then stop them (stuck ones are killed after `timeout`)"""
+        for _ in self._workers:
+            self._jobs.put(None)
+        deadline = time.monotonic() + timeout
+        for worker in self._workers.values():
+            worker.join(max(0, deadline - time.monotonic()))
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        self._updates.put((None, None))
+        self._collector.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send G-code files to every printer of a farm")
+    parser.add_argument('files', nargs='+', help="jobs, each goes to the next idle printer")
+    parser.add_argument('--port', action='append', metavar='NAME=PORT',
+                        help="printer to use (repeatable, default: every board plugged in)")
+    parser.add_argument('--emulate', type=int, metavar='N', help="run on N virtual printers instead")
+    parser.add_argument('--motion', action='store_true', help="with --emulate: take as long as the moves would")
+    parser.add_argument('--logs', metavar='DIR', help="save what each printer's worker prints to DIR/<name>.log")
+    parser.add_argument('--ack-timeout', type=float, default=uploader.ACK_TIMEOUT,
+                        help="seconds a silent printer has before its job goes to another one")
+    args = parser.parse_args()
+
+    emulators = []
+    printers = None
+    if args.emulate:
+        import emulator
+        emulators = [emulator.VirtualPrinter(simulate_motion=args.motion) for _ in range(args.emulate)]
+        printers = {f"emulator-{i + 1}": printer.start() for i, printer in enumerate(emulators)}
+    elif args.port:
+        printers = dict(entry.split('=', 1) for entry in args.port)
+
+    farm = PrinterFarm(printers, log_dir=args.logs, ack_timeout=args.ack_timeout, reset=not args.emulate,
+                       port_cache=None if args.emulate else portfinder.CACHE_PATH)
+    if not farm.status():
+        print("No printers found.")
+        return
+    for path in args.files:
+        farm.submit(path)
+    try:
+        while not farm.wait(timeout=2):
+            farm.print_status()
+    finally:
+        farm.print_status()
+        for path, error in farm.failed:
+            print(f"Failed: {path}: {error}")
+        farm.stop()
+        for printer in emulators:
+            printer.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,6 @@
 #include <Arduino.h>
+#include "blockqueue.h"
+#include "stepper.h"
 
 #define EN       8  // Enable pin for stepper drivers
 #define A_DIR    5  // CoreXY Motor A direction
@@ -10,11 +12,37 @@
 #define E_DIR    9  // Extruder direction
 #define E_STP    10 // Extruder step
 
+// Binary motion protocol (see binproto.py on the host side)
+#define BIN_SYNC         0xA5
+#define BIN_RECORD_SIZE  24
+#define OP_MOVE          1   // G0 / G1
+#define OP_ABSOLUTE      2   // G90
+#define OP_RELATIVE      3   // G91
+#define OP_ABSOLUTE_E    4   // M82
+#define OP_RELATIVE_E    5   // M83
+#define OP_SET_POSITION  6   // G92
+#define OP_HOME          7   // G28
+#define OP_MOTORS_ON     8   // M17
+#define OP_MOTORS_OFF    9   // M18
+#define OP_REPORT        10  // M114
+#define OP_SET_LINES     11  // M100
+#define OP_TEXT_MODE     0x7F
+#define REPLY_ACK        0x06
+#define REPLY_BOUNDS     0x07
+#define REPLY_NAK        0x15
+#define REPLY_CAN        0x18
+
+#define LINE_BUFFER_SIZE 128          // Longest G-code line kept, the rest is dropped
+#define IDLE_TIMEOUT_MS  30000UL      // Motors are disabled after this long with nothing to do
+#define BAUD_RATE        115200       // Rate setup() starts at, and M991 goes back to if it is not confirmed
+#define BAUD_TRIAL_MS    2000UL       // How long a rate switched to by M991 has to be confirmed with M993
+
 int stps_per_mm = 200;
-int delayTime = 2000;  // microseconds between steps
 float feedrate = 1500.0;         // mm/min (default value)
 float minFeedrate = 60.0;        // mm/min, to avoid divide-by-zero
 float maxFeedrate = 10000.0;     // mm/min, clamp to avoid extreme speeds
+float acceleration = 1000.0;     // mm/s^2, every move speeds up and slows down at this rate
+float startSpeed = 5.0;          // mm/s, moves start and end at this speed (must be > 0)
 
 
 bool absolutePositioning = true;
@@ -26,16 +54,55 @@ int totalLines = 0;
 int linesProcessed = 0;
 int lastPercentReported = -1;
 
+bool binaryMode = false;              // Reading binary records instead of G-code text (M990)
+uint8_t binBuffer[BIN_RECORD_SIZE];   // Record being received
+uint8_t binLength = 0;                // Bytes of it received so far
+uint8_t expectedSeq = 0;              // Sequence number of the next record to run
+
+char lineBuffer[LINE_BUFFER_SIZE];    // G-code line being received
+uint8_t lineLength = 0;               // Characters of it received so far
+
+const long baudRates[] = {115200, 250000, 500000, 1000000};  // Rates M991 accepts (all but 115200 divide 16 MHz exactly)
+long baudRate = BAUD_RATE;            // Rate the port runs at
+long confirmedBaud = BAUD_RATE;       // Rate to go back to if the one on trial is not confirmed
+unsigned long baudTrialStart = 0;     // millis() when the rate on trial was switched to
+bool baudTrial = false;               // Running at a rate from M991 that M993 has not confirmed yet
+
+BlockQueue blocks;                    // Planned commands waiting for the steppers
+StepGenerator stepper;                // Steps the oldest block
+bool blockStarted = false;            // The oldest block has started stepping
+unsigned long nextStep = 0;           // micros() when the next step is due
+bool motorsEnabled = true;
+unsigned long lastActivity = 0;       // millis() of the last line received or move finished
+
 void parseGCode(String gcode);
+long baudRateOf(String gcode);
+void switchBaud(long rate);
+uint16_t crc16(const uint8_t *data, uint8_t length);
 void parseMove(String gcode);
-void resetCoordinates();
+void parseWords(String gcode, float *v);
+bool executeMove(float x, float y, float z, float e, float f);
+bool readLine();
+void readBinary();
+void handleRecord();
+void parseSetPosition(String gcode);
+void setPosition(float x, float y, float z, float e);
 void homeAxes();
 void enableMotors();
 void disableMotors();
+void queueBlock(uint8_t type);
+void setMotorsEnabled(bool enabled);
 void reportPosition();
-void moveCoreXY(float x_mm, float y_mm);
-void moveZ(float z_mm);
-void extrude(float e_mm);
+void runSteppers();
+void writeStepPins(uint8_t motors, uint8_t level);
+void enableAbsolutePositioning();
+void enableRelativePosition();
+void enableAbsoluteExtrusion();
+void enableRelativeExtrusion();
+void countGcodeLines(String gcode);
+void setTotalLines(int total);
+void updateProgress();
+void info(const char *msg);
 
 void parseGCode(String gcode) {
 
@@ -47,6 +114,7 @@ void parseGCode(String gcode) {
   }
   gcode.trim();
   gcode.toUpperCase();
+  long newBaud = 0;
 
     if (gcode.startsWith("G90")) {
       enableAbsolutePositioning();
@@ -59,7 +127,7 @@ void parseGCode(String gcode) {
     } else if (gcode.startsWith("G0") || gcode.startsWith("G1")) {
       parseMove(gcode);
     } else if (gcode.startsWith("G92")) {
-      resetCoordinates();
+      parseSetPosition(gcode);
     } else if (gcode.startsWith("G28")) {
       homeAxes();
     } else if (gcode.startsWith("M17")) {
@@ -70,10 +138,58 @@ void parseGCode(String gcode) {
       reportPosition();
     } else if (gcode.startsWith("M100")) {
       countGcodeLines(gcode);
+    } else if (gcode.startsWith("M990")) {
+      Serial.println("BINARY");  // Tell the host binary records are understood
+    } else if (gcode.startsWith("M991")) {
+      newBaud = baudRateOf(gcode);
+      if (newBaud) {
+        Serial.print("BAUD ");  // Tell the host the next line is read at the new rate
+        Serial.println(newBaud);
+      } else {
+        Serial.println("ERROR: Unsupported baud rate");
+      }
+    } else if (gcode.startsWith("M992")) {
+      // Echo test: the CRC of what arrived, so the host can tell it got through unchanged
+      Serial.print("CHECK ");
+      Serial.println(crc16((const uint8_t *)gcode.c_str() + 5, gcode.length() > 5 ? gcode.length() - 5 : 0), HEX);
+    } else if (gcode.startsWith("M993")) {
+      baudTrial = false;  // The host heard us at this rate, keep it
+      confirmedBaud = baudRate;
     }
     // Request next line
     Serial.println(gcode);
     Serial.println("OK");
+
+    if (gcode.startsWith("M990")) {
+      // Everything after the OK is binary
+      binaryMode = true;
+      binLength = 0;
+      expectedSeq = 0;
+    } else if (newBaud) {
+      // Everything after the OK is at the new rate, on trial until M993 comes
+      switchBaud(newBaud);
+      baudTrial = true;
+      baudTrialStart = millis();
+    }
+}
+
+// M991 B<rate>: the rate if it is one of baudRates, otherwise 0
+long baudRateOf(String gcode) {
+  int b = gcode.indexOf('B');
+  if (b == -1) return 0;
+  long rate = gcode.substring(b + 1).toInt();
+  for (uint8_t i = 0; i < sizeof(baudRates) / sizeof(baudRates[0]); i++) {
+    if (baudRates[i] == rate) return rate;
+  }
+  return 0;
+}
+
+void switchBaud(long rate) {
+  Serial.flush();  // Let the OK go out at the old rate
+  Serial.end();
+  Serial.begin(rate);
+  baudRate = rate;
+  lineLength = 0;
 }
 
 void parseMove(String gcode) {
@@ -83,6 +199,13 @@ void parseMove(String gcode) {
   // if bounds are not ok then send an error message and do not move, so coord[i] stay the same
   // 
   
+  float v[5];
+  parseWords(gcode, v);
+  executeMove(v[0], v[1], v[2], v[3], v[4]);
+}
+
+// Reads the X, Y, Z, E and F words after the command into v[0..4], NAN where not given
+void parseWords(String gcode, float *v) {
   float x = NAN, y = NAN, z = NAN, e = NAN, f = NAN;
   gcode.remove(0, 2);
   gcode.trim();
@@ -102,60 +225,63 @@ void parseMove(String gcode) {
     else if (code == 'E') e = val;
     else if (code == 'F') f = val;
   }
-if (!isnan(f)) {
-  feedrate = constrain(f, minFeedrate, maxFeedrate);
-  delayTime = round((60.0 * 1000000.0) / (feedrate * stps_per_mm)); // microseconds
+  v[0] = x; v[1] = y; v[2] = z; v[3] = e; v[4] = f;
 }
 
-  if (!isnan(x)) moveCoreXY((absolutePositioning ? x - coord[0] : x), 0);
-  if (!isnan(y)) moveCoreXY(0, (absolutePositioning ? y - coord[1] : y));
-  if (!isnan(z)) moveZ((absolutePositioning ? z - coord[2] : z));
-  if (!isnan(e)) extrude((absoluteExtrusion ? e - coord[3] : e));
-
-  if (!isnan(x)) coord[0] += (absolutePositioning ? x - coord[0] : x);
-  if (!isnan(y)) coord[1] += (absolutePositioning ? y - coord[1] : y);
-  if (!isnan(z)) coord[2] += (absolutePositioning ? z - coord[2] : z);
-  if (!isnan(e)) coord[3] += (absoluteExtrusion ? e - coord[3] : e);
-
-  // ---------------
-  // Prevent moving out of bounds
-  // ---------------
-  float dx = 0.0;
-  float dy = 0.0;
-  float dz = 0.0;
-  float de = 0.0;
-
-  // Predict final coordinates
-  float newX = coord[0] + dx;
-  float newY = coord[1] + dy;
-  float newZ = coord[2] + dz;
-  float newE = coord[3] + de;
-
-  // Check limits
-  if (newX < 0 || newX > max_coord[0] ||
-      newY < 0 || newY > max_coord[1] ||
-      newZ < 0 || newZ > max_coord[2] ||
-      newE < 0 || newE > max_coord[3]) {
-    Serial.println("ERROR: Movement exceeds boundary limits. Command skipped.");
+// Plans the move into the block queue (there must be a free slot) and
+// returns false if it went out of bounds
+bool executeMove(float x, float y, float z, float e, float f) {
+  if (!isnan(f)) {
+    feedrate = constrain(f, minFeedrate, maxFeedrate);
+  }
+
+  float target[4] = {x, y, z, e};
+  float delta[4];
+  int32_t steps[4];
+  for (uint8_t i = 0; i < 4; i++) {
+    delta[i] = 0;
+    steps[i] = 0;
+    if (isnan(target[i])) continue;
+    bool absolute = (i == 3) ? absoluteExtrusion : absolutePositioning;
+    delta[i] = absolute ? target[i] - coord[i] : target[i];
+    steps[i] = round(delta[i] * stps_per_mm);
+    coord[i] += delta[i];
   }
-  else {
-  // Execute movement
-  if (dx != 0 || dy != 0) moveCoreXY(dx, dy);
-  if (dz != 0) moveZ(dz);
-  if (de != 0) extrude(de);
-
-  // Update coordinate state
-  // here the coord update should be the something like coord[i] = coord[i] + di
-  coord[0] = newX;
-  coord[1] = newY;
-  coord[2] = newZ;
-  coord[3] = newE;
+
+  // The feedrate is along the XYZ path, E follows along (or sets the pace on its own)
+  float length = sqrt(delta[0] * delta[0] + delta[1] * delta[1] + delta[2] * delta[2]);
+  if (steps[0] == 0 && steps[1] == 0 && steps[2] == 0) length = fabs(delta[3]);
+  Block *block = blocks.next();
+  planMove(block, steps, length, feedrate / 60.0, startSpeed, acceleration);
+  if (block->stepCount) blocks.push();  // Nothing to step, the slot stays free
+
+  // The move is planned either way, the bounds are only reported
+  if (coord[0] < 0 || coord[0] > max_coord[0] ||
+      coord[1] < 0 || coord[1] > max_coord[1] ||
+      coord[2] < 0 || coord[2] > max_coord[2] ||
+      coord[3] < 0 || coord[3] > max_coord[3]) {
+    if (!binaryMode) Serial.println("ERROR: Movement exceeds boundary limits. Command skipped.");
+    return false;
   }
+  return true;
+}
+
+void parseSetPosition(String gcode) {
+  float v[5];
+  parseWords(gcode, v);
+  setPosition(v[0], v[1], v[2], v[3]);
 }
 
-void resetCoordinates() {
-  coord[0] = coord[1] = coord[2] = coord[3] = 0;
-  Serial.println("Position reset to (0,0,0,0) via G92");
+// G92: the axes given take the new value, a bare G92 resets every axis to 0
+void setPosition(float x, float y, float z, float e) {
+  if (isnan(x) && isnan(y) && isnan(z) && isnan(e)) {
+    x = y = z = e = 0;
+  }
+  if (!isnan(x)) coord[0] = x;
+  if (!isnan(y)) coord[1] = y;
+  if (!isnan(z)) coord[2] = z;
+  if (!isnan(e)) coord[3] = e;
+  info("Position set via G92");
 }
 
 void homeAxes() {
@@ -163,17 +289,29 @@ void homeAxes() {
   coord[0] = 0;  // X = 0
   coord[1] = 0;  // Y = 0
   coord[2] = 0;  // Z = 0
-  Serial.println("Soft homing: Current position set to (0,0,0)");
+  info("Soft homing: Current position set to (0,0,0)");
 }
 
+// M17 / M18 take effect once the moves planned before them are done
 void enableMotors() {
-  digitalWrite(EN, LOW);
-  Serial.println("Motors enabled via M17");
+  queueBlock(BLOCK_MOTORS_ON);
+  info("Motors enabled via M17");
 }
 
 void disableMotors() {
-  digitalWrite(EN, HIGH);
-  Serial.println("Motors disabled via M18");
+  queueBlock(BLOCK_MOTORS_OFF);
+  info("Motors disabled via M18");
+}
+
+void queueBlock(uint8_t type) {
+  Block *block = blocks.next();
+  block->type = type;
+  blocks.push();
+}
+
+void setMotorsEnabled(bool enabled) {
+  digitalWrite(EN, enabled ? LOW : HIGH);
+  motorsEnabled = enabled;
 }
 
 void reportPosition() {
@@ -183,73 +321,77 @@ void reportPosition() {
   Serial.print(" E:"); Serial.println(coord[3]);
 }
 
-void moveCoreXY(float x_mm, float y_mm) {
-  int x_steps = round(x_mm * stps_per_mm);
-  int y_steps = round(y_mm * stps_per_mm);
-  int a_steps = x_steps + y_steps;
-  int b_steps = x_steps - y_steps;
-
-  boolean a_dir = (a_steps >= 0);
-  boolean b_dir = (b_steps >= 0);
+// ---------------------
+// STEPPERS
+// Runs the oldest block one tick at a time (stepper.h), without waiting,
+// so loop() keeps reading serial in between.
+// ---------------------
 
-  a_steps = abs(a_steps);
-  b_steps = abs(b_steps);
+void runSteppers() {
+  Block *block = blocks.peek();
+  if (!block) return;
 
-  digitalWrite(A_DIR, a_dir);
-  digitalWrite(B_DIR, b_dir);
-
-  for (int i = 0; i < max(a_steps, b_steps); i++) {
-    if (i < a_steps) digitalWrite(A_STP, HIGH);
-    if (i < b_steps) digitalWrite(B_STP, HIGH);
-    delayMicroseconds(delayTime);
-    if (i < a_steps) digitalWrite(A_STP, LOW);
-    if (i < b_steps) digitalWrite(B_STP, LOW);
-    delayMicroseconds(delayTime);
+  if (block->type != BLOCK_MOVE) {
+    setMotorsEnabled(block->type == BLOCK_MOTORS_ON);
+    blocks.pop();
+    return;
   }
-}
 
-void moveZ(float z_mm) {
-  boolean up = z_mm >= 0;
-  int steps = abs(round(z_mm * stps_per_mm));
-  digitalWrite(Z_DIR, !up);
-  for (int i = 0; i < steps; i++) {
-    digitalWrite(Z_STP, HIGH);
-    delayMicroseconds(delayTime);
-    digitalWrite(Z_STP, LOW);
-    delayMicroseconds(delayTime);
+  unsigned long now = micros();
+  if (!blockStarted) {
+    if (!motorsEnabled) setMotorsEnabled(true);
+    if ((long)(now - nextStep) > 0) nextStep = now;  // Idle since the last block
+    blockStarted = true;
+    stepper.begin(block);
+    // Z_DIR is inverted, like moveZ() always had it
+    digitalWrite(A_DIR, block->steps[MOTOR_A] >= 0);
+    digitalWrite(B_DIR, block->steps[MOTOR_B] >= 0);
+    digitalWrite(Z_DIR, block->steps[MOTOR_Z] < 0);
+    digitalWrite(E_DIR, block->steps[MOTOR_E] >= 0);
   }
+  if ((long)(now - nextStep) < 0) return;
+
+  // A block is done once the interval after its last step is over
+  if (stepper.done()) {
+    blocks.pop();
+    blockStarted = false;
+    lastActivity = millis();
+    return;
+  }
+
+  uint32_t interval;
+  uint8_t motors = stepper.step(&interval);
+  writeStepPins(motors, HIGH);
+  writeStepPins(motors, LOW);
+  if ((long)(now - nextStep) > (long)interval) nextStep = now + interval;  // Stalled (serial, parsing): go on from now, not in a burst
+  else nextStep += interval;
 }
 
-void extrude(float e_mm) {
-  boolean dir = (e_mm >= 0);
-  int steps = abs(round(e_mm * stps_per_mm));
-  digitalWrite(E_DIR, dir);
-  for (int i = 0; i < steps; i++) {
-    digitalWrite(E_STP, HIGH);
-    delayMicroseconds(delayTime);
-    digitalWrite(E_STP, LOW);
-    delayMicroseconds(delayTime);
-  }
+void writeStepPins(uint8_t motors, uint8_t level) {
+  if (motors & (1 << MOTOR_A)) digitalWrite(A_STP, level);
+  if (motors & (1 << MOTOR_B)) digitalWrite(B_STP, level);
+  if (motors & (1 << MOTOR_Z)) digitalWrite(Z_STP, level);
+  if (motors & (1 << MOTOR_E)) digitalWrite(E_STP, level);
 }
 
 void enableAbsolutePositioning() {
   absolutePositioning = true;
-  Serial.println("Switched to Absolute Positioning (G90)");
+  info("Switched to Absolute Positioning (G90)");
 }
 
 void enableRelativePosition() {
   absolutePositioning = false;
-  Serial.println("Switched to Relative Positioning (G91)");
+  info("Switched to Relative Positioning (G91)");
 }
 
 void enableAbsoluteExtrusion() {
   absoluteExtrusion = true;
-  Serial.println("Switched to Absolute Extrusion (M82)");
+  info("Switched to Absolute Extrusion (M82)");
 }
 
 void enableRelativeExtrusion() {
   absoluteExtrusion = false;
-  Serial.println("Switched to Relative Extrusion (M83)");
+  info("Switched to Relative Extrusion (M83)");
 }
 
 void countGcodeLines(String gcode) {
@@ -264,8 +406,115 @@ void setTotalLines(int total) {
   totalLines = total;
   linesProcessed = 0;
   lastPercentReported = -1;
-  Serial.print("Total lines set: ");
-  Serial.println(totalLines);
+  if (!binaryMode) {
+    Serial.print("Total lines set: ");
+    Serial.println(totalLines);
+  }
+}
+
+// Status messages are only printed in text mode, binary mode answers with one byte
+void info(const char *msg) {
+  if (!binaryMode) Serial.println(msg);
+}
+
+// ---------------------
+// BINARY PROTOCOL
+// ---------------------
+
+uint16_t crc16(const uint8_t *data, uint8_t length) {
+  uint16_t crc = 0xFFFF;
+  for (uint8_t i = 0; i < length; i++) {
+    crc ^= (uint16_t)data[i] << 8;
+    for (uint8_t bit = 0; bit < 8; bit++) {
+      crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+    }
+  }
+  return crc;
+}
+
+int32_t readInt32(const uint8_t *p) {
+  return (int32_t)((uint32_t)p[0] | ((uint32_t)p[1] << 8) | ((uint32_t)p[2] << 16) | ((uint32_t)p[3] << 24));
+}
+
+// Collects a line without waiting for the rest of it. Returns true once
+// lineBuffer holds a whole line.
+bool readLine() {
+  while (Serial.available()) {
+    char c = Serial.read();
+    if (c == '\n') {
+      lineBuffer[lineLength] = '\0';
+      lineLength = 0;
+      return true;
+    }
+    if (lineLength < LINE_BUFFER_SIZE - 1) lineBuffer[lineLength++] = c;
+  }
+  return false;
+}
+
+void readBinary() {
+  while (Serial.available()) {
+    uint8_t b = Serial.read();
+    if (binLength == 0 && b != BIN_SYNC) continue;  // Hunt for the start of a record
+    binBuffer[binLength++] = b;
+    if (binLength == BIN_RECORD_SIZE) {
+      handleRecord();
+      return;  // One record per pass through loop()
+    }
+  }
+}
+
+void handleRecord() {
+  uint16_t crc = binBuffer[22] | ((uint16_t)binBuffer[23] << 8);
+  if (crc16(binBuffer, 22) != crc) {
+    Serial.write(REPLY_NAK);
+    Serial.write(expectedSeq);
+    // The real record may start at a later sync byte in what was read
+    uint8_t start = 1;
+    while (start < BIN_RECORD_SIZE && binBuffer[start] != BIN_SYNC) start++;
+    memmove(binBuffer, binBuffer + start, BIN_RECORD_SIZE - start);
+    binLength = BIN_RECORD_SIZE - start;
+    return;
+  }
+  binLength = 0;
+
+  uint8_t seq = binBuffer[3];
+  if (seq != expectedSeq) {
+    if ((uint8_t)(expectedSeq - seq) <= 128) {
+      Serial.write(REPLY_ACK);  // Already ran, the host missed the reply
+    } else {
+      Serial.write(REPLY_CAN);  // An earlier record was rejected
+      Serial.write(expectedSeq);
+    }
+    return;
+  }
+  expectedSeq++;
+
+  uint8_t op = binBuffer[1];
+  uint8_t mask = binBuffer[2];
+  float v[4];
+  for (uint8_t i = 0; i < 4; i++) {
+    v[i] = (mask & (1 << i)) ? readInt32(binBuffer + 4 + 4 * i) / 1000.0 : NAN;
+  }
+  float f = (mask & 0x10) ? (float)(binBuffer[20] | ((uint16_t)binBuffer[21] << 8)) : NAN;
+
+  bool inBounds = true;
+  switch (op) {
+    case OP_MOVE:         inBounds = executeMove(v[0], v[1], v[2], v[3], f); break;
+    case OP_ABSOLUTE:     enableAbsolutePositioning(); break;
+    case OP_RELATIVE:     enableRelativePosition(); break;
+    case OP_ABSOLUTE_E:   enableAbsoluteExtrusion(); break;
+    case OP_RELATIVE_E:   enableRelativeExtrusion(); break;
+    case OP_SET_POSITION: setPosition(v[0], v[1], v[2], v[3]); break;
+    case OP_HOME:         homeAxes(); break;
+    case OP_MOTORS_ON:    enableMotors(); break;
+    case OP_MOTORS_OFF:   disableMotors(); break;
+    case OP_REPORT:       reportPosition(); break;
+    case OP_SET_LINES:    setTotalLines(readInt32(binBuffer + 4)); break;
+    case OP_TEXT_MODE:    binaryMode = false; break;
+  }
+  Serial.write(inBounds ? REPLY_ACK : REPLY_BOUNDS);
+  linesProcessed++;
+  updateProgress();
 }
 
 void updateProgress() {
@@ -281,24 +530,42 @@ void updateProgress() {
 }
 
 void setup() {
-  Serial.begin(115200);
+  Serial.begin(BAUD_RATE);
   pinMode(A_DIR, OUTPUT); pinMode(A_STP, OUTPUT);
   pinMode(B_DIR, OUTPUT); pinMode(B_STP, OUTPUT);
   pinMode(Z_DIR, OUTPUT); pinMode(Z_STP, OUTPUT);
   pinMode(E_DIR, OUTPUT); pinMode(E_STP, OUTPUT);
   pinMode(EN, OUTPUT);
-  digitalWrite(EN, LOW);
+  setMotorsEnabled(true);
+  blocks.clear();
+  lastActivity = millis();
+  Serial.println("READY");  // The host waits for this instead of sleeping after it opens the port
 }
 
 void loop() {
-  if (Serial.available()) {
-    String line = Serial.readStringUntil('\n');
-    parseGCode(line);
-    linesProcessed++;
-    updateProgress();
+  runSteppers();
+
+  // A line is only read once there is a slot to plan it into. Until then it
+  // waits in the serial buffer and its OK holds back the host.
+  if (!blocks.full() && Serial.available()) {
+    lastActivity = millis();
+    if (binaryMode) {
+      readBinary();
+    } else if (readLine()) {
+      parseGCode(String(lineBuffer));
+      linesProcessed++;
+      updateProgress();
+    }
+  }
+  else if (motorsEnabled && blocks.empty() && millis() - lastActivity >= IDLE_TIMEOUT_MS) {
+    setMotorsEnabled(false);
+    info("Motors disabled after idle timeout");
   }
-  else {
-    disableMotors();
+
+  if (baudTrial && millis() - baudTrialStart >= BAUD_TRIAL_MS) {
+    // The host never confirmed the new rate, so it cannot hear us there: go back
+    baudTrial = false;
+    switchBaud(confirmedBaud);
   }
 }
 
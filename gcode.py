@@ -0,0 +1,209 @@
+import math
+import re
+
+# ---------------------
+# G-CODE PARSING THE WAY firmware.ino DOES IT
+# Shared by the host-side tools that need to agree with the firmware
+# (preprocessing, the virtual printer, ...).
+# ---------------------
+
+# Prefixes parseGCode() recognises, in the order it checks them
+FIRMWARE_COMMANDS = ('G90', 'G91', 'M82', 'M83', 'G0', 'G1', 'G92', 'G28', 'M17', 'M18', 'M114', 'M100')
+MOVE_COMMANDS = ('G0', 'G1')
+AXES = ('X', 'Y', 'Z', 'E')
+DEFAULT_FEEDRATE = 1500.0  # feedrate / minFeedrate / maxFeedrate in firmware.ino
+MIN_FEEDRATE = 60.0
+MAX_FEEDRATE = 10000.0
+MAX_COORD = (130.0, 130.0, 400.0, 100.0)  # max_coord in firmware.ino: X, Y, Z, E go from 0 to these
+STEPS_PER_MM = 200  # stps_per_mm / acceleration / startSpeed in firmware.ino
+ACCELERATION = 1000.0  # mm/s^2
+START_SPEED = 5.0  # mm/s
+
+_FLOAT_PREFIX = re.compile(r'[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?')
+_INT_PREFIX = re.compile(r'[+-]?\d+')
+
+
+def to_float(text):
+    """Parse a number the way Arduino's String.toFloat() does (0 if invalid)"""
+    match = _FLOAT_PREFIX.match(text.lstrip())
+    return float(match.group(0)) if match else 0.0
+
+
+def to_int(text):
+    """Parse a number the way Arduino's String.toInt() does (0 if invalid)"""
+    match = _INT_PREFIX.match(text.lstrip())
+    return int(match.group(0)) if match else 0
+
+
+def clean(line):
+    """Remove the comment, surrounding whitespace and lower case, like the start of parseGCode()"""
+    semicolon_pos = line.find(';')
+    if semicolon_pos != -1:
+        line = line[:semicolon_pos]
+    return line.strip().upper()
+
+
+def command_of(gcode):
+    """
+    Which firmware command a cleaned line runs.
+
+    Returns:
+        str: One of FIRMWARE_COMMANDS, or None if the firmware ignores the line
+    """
+    for prefix in FIRMWARE_COMMANDS:
+        if gcode.startswith(prefix):
+            return prefix
+    return None
+
+
+def move_words(gcode):
+    """
+    Split a cleaned G0/G1 line the way parseMove() does: the first two
+    characters are dropped and the rest is split on single spaces. Later
+    words win over earlier ones with the same letter.
+
+    Returns:
+        dict: Letter -> word text (e.g. 'X' -> 'X10.5') for the X, Y, Z, E and F words
+    """
+    words = {}
+    for token in gcode[2:].strip().split(' '):
+        code = token[:1]
+        if code and code in 'XYZEF':
+            words[code] = token
+    return words
+
+
+def parse_move(gcode):
+    """
+    Read the words of a cleaned G0/G1 line the way parseMove() does.
+
+    Returns:
+        dict: Letter -> value for the X, Y, Z, E and F words that were given
+    """
+    return {code: to_float(word[1:]) for code, word in move_words(gcode).items()}
+
+
+def parse_set_position(gcode):
+    """
+    Read a cleaned G92 line the way setPosition() does.
+
+    Returns:
+        dict: Axis letter -> new position, every axis at 0 if none was given
+    """
+    values = parse_move(gcode)
+    values.pop('F', None)
+    return values or dict.fromkeys(AXES, 0.0)
+
+
+def round_half_away(value):
+    """Arduino's round(): halves go away from zero"""
+    return math.copysign(math.floor(abs(value) + 0.5), value)
+
+
+def move_time(deltas, feedrate):
+    """
+    Seconds the step generator (stepper.h) takes for one move.
+
+    Every move speeds up from START_SPEED to the feedrate at ACCELERATION
+    and slows down to START_SPEED again by its end, along the XYZ path (or
+    along E for a move that only extrudes).
+
+    Args:
+        deltas: X, Y, Z, E distances in mm
+        feedrate (float): mm/min, already clamped
+    """
+    x, y, z, e = (round_half_away(d * STEPS_PER_MM) for d in deltas)
+    step_count = max(abs(x + y), abs(x - y), abs(z), abs(e))
+    if not step_count:
+        return 0.0
+    dx, dy, dz, de = deltas
+    length = math.sqrt(dx * dx + dy * dy + dz * dz) if x or y or z else abs(de)
+    return trapezoid_time(step_count, length, feedrate / 60)
+
+
+def trapezoid_time(step_count, length, speed):
+    """Seconds to run step_count ticks over length mm at speed mm/s, see move_time"""
+    steps_per_mm = step_count / length
+    nominal = speed * steps_per_mm
+    initial = min(START_SPEED, speed) * steps_per_mm
+    acceleration = ACCELERATION * steps_per_mm
+    ramp = min(math.ceil((nominal * nominal - initial * initial) / (2 * acceleration)), step_count // 2)
+    peak = min(math.sqrt(initial * initial + 2 * acceleration * ramp), nominal)
+    return 2 * (peak - initial) / acceleration + (step_count - 2 * ramp) / peak
+
+
+def format_number(value, precision=3):
+    """Shortest text for value rounded to `precision` decimals that toFloat() reads back the same"""
+    text = f"{value:.{precision}f}"
+    if '.' in text:
+        text = text.rstrip('0').rstrip('.')
+    if text in ('', '-0', '-'):
+        return '0'
+    if text.startswith('0.'):
+        return text[1:]
+    if text.startswith('-0.'):
+        return '-' + text[2:]
+    return text
+
+
+class MachineState:
+    """
+    The modal state the firmware is in after running some lines: G90/G91,
+    M82/M83, the feedrate and the position, kept with the same rules as
+    firmware.ino (moves update the position even when they are out of
+    bounds). Starts in the state the firmware boots in.
+    """
+
+    def __init__(self):
+        self.absolute_positioning = True
+        self.absolute_extrusion = True
+        self.feedrate = DEFAULT_FEEDRATE
+        self.coord = [0.0, 0.0, 0.0, 0.0]  # X, Y, Z, E
+
+    def apply(self, gcode):
+        """Update the state for one cleaned line the firmware has run"""
+        command = command_of(gcode)
+        if command in ('G90', 'G91'):
+            self.absolute_positioning = command == 'G90'
+        elif command in ('M82', 'M83'):
+            self.absolute_extrusion = command == 'M82'
+        elif command in MOVE_COMMANDS:
+            words = parse_move(gcode)
+            if 'F' in words:
+                self.feedrate = min(max(words.pop('F'), MIN_FEEDRATE), MAX_FEEDRATE)
+            for code, value in words.items():
+                axis = AXES.index(code)
+                absolute = self.absolute_extrusion if code == 'E' else self.absolute_positioning
+                self.coord[axis] = value if absolute else self.coord[axis] + value
+        elif command == 'G92':
+            for code, value in parse_set_position(gcode).items():
+                self.coord[AXES.index(code)] = value
+        elif command == 'G28':
+            self.coord[0] = self.coord[1] = self.coord[2] = 0.0
+
+    def preamble(self, precision=3):
+        """Lines that put firmware that has just been reset into this state"""
+        position = ' '.join(code + format_number(value, precision) for code, value in zip(AXES, self.coord))
+        return [
+            'G90' if self.absolute_positioning else 'G91',
+            'M82' if self.absolute_extrusion else 'M83',
+            'G92 ' + position,
+            'G1 F' + format_number(self.feedrate, precision),
+        ]
+
+    def to_dict(self):
+        return {
+            'absolute_positioning': self.absolute_positioning,
+            'absolute_extrusion': self.absolute_extrusion,
+            'feedrate': self.feedrate,
+            'coord': list(self.coord),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        state = cls()
+        state.absolute_positioning = data['absolute_positioning']
+        state.absolute_extrusion = data['absolute_extrusion']
+        state.feedrate = data['feedrate']
+        state.coord = list(data['coord'])
+        return state
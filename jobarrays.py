@@ -0,0 +1,334 @@
+import mmap
+
+import numpy as np
+
+from arcs import ARC_COMMANDS, ARC_WORDS
+from gcode import AXES, FIRMWARE_COMMANDS, MAX_FEEDRATE, MIN_FEEDRATE, MOVE_COMMANDS, MachineState, to_float
+
+# ---------------------
+# G-CODE JOBS AS COLUMNS
+# Parses a whole job into NumPy arrays (one row per line of the file) with
+# the same rules as parseGCode() / parseMove() in firmware.ino, without a
+# Python loop over the lines, and replays the modal state (G90/G91,
+# M82/M83, G92, G28, F) in vectorized form. G2/G3 arcs, which the firmware
+# never sees (they are sent as chords, see arcs.py), are kept as commands
+# of their own after the firmware's. The optimizer, the print-time
+# estimator and the preflight validator all work from these:
+#
+#     job = load('job.gcode')
+#     state = replay(job)
+#     state.position[-1]  # X, Y, Z, E where the job ends
+# ---------------------
+
+WORDS = AXES + ('F',) + ARC_WORDS  # Columns of JobArrays.words
+COMMANDS = FIRMWARE_COMMANDS + ARC_COMMANDS  # What JobArrays.command indexes into
+BLANK = -1  # JobArrays.command of a blank or comment-only line
+UNKNOWN = -2  # JobArrays.command of a line the firmware ignores (and that is not an arc)
+COMMAND_INDEX = {command: i for i, command in enumerate(COMMANDS)}
+MOVES = [COMMAND_INDEX[command] for command in MOVE_COMMANDS]
+ARCS = [COMMAND_INDEX[command] for command in ARC_COMMANDS]
+
+CHUNK_SIZE = 1 << 18  # Bytes parsed at a time (small enough for the work arrays to stay in cache)
+_NUMBER_WIDTH = 15  # Longest number the fast parser reads (more digits than a double holds)
+
+_SPACE, _TAB, _NEWLINE, _RETURN, _SEMICOLON = 0x20, 0x09, 0x0A, 0x0D, 0x3B
+_POWERS_OF_TEN = 10.0 ** np.arange(_NUMBER_WIDTH + 1)
+_WORD_COLUMN = np.full(256, -1, np.int64)  # Byte -> column of JobArrays.words
+_WORD_COLUMN[[ord(code) for code in WORDS]] = np.arange(len(WORDS))
+
+
+class JobArrays:
+    """
+    A parsed job, one row per line of the file.
+
+    Attributes:
+        command: int8 index into COMMANDS, or BLANK / UNKNOWN
+        words: float64 (lines, 8) X, Y, Z, E, F values of G0/G1/G92/G2/G3 lines and I, J, R
+            of G2/G3 lines, NaN where not given
+    """
+
+    def __init__(self, command, words):
+        self.command = command
+        self.words = words
+
+    def __len__(self):
+        return len(self.command)
+
+    def is_move(self):
+        return np.isin(self.command, MOVES)
+
+    def is_arc(self):
+        return np.isin(self.command, ARCS)
+
+    def is_command(self, command):
+        return self.command == COMMAND_INDEX[command]
+
+    def given(self):
+        """bool (lines, 5): which words each line has"""
+        return ~np.isnan(self.words)
+
+
+class MachineStates:
+    """
+    The firmware's modal state after each line of a job (see replay).
+
+    Attributes:
+        position: float64 (lines, 4) X, Y, Z, E after the line has run
+        feedrate: float64 (lines,) mm/min in effect after the line, clamped like the firmware does
+        absolute_positioning, absolute_extrusion: bool (lines,) G90/G91 and M82/M83 after the line
+        start: MachineState the job started from
+    """
+
+    def __init__(self, position, feedrate, absolute_positioning, absolute_extrusion, start):
+        self.position = position
+        self.feedrate = feedrate
+        self.absolute_positioning = absolute_positioning
+        self.absolute_extrusion = absolute_extrusion
+        self.start = start
+
+    def before(self):
+        """float64 (lines, 4): X, Y, Z, E before each line runs"""
+        before = np.empty_like(self.position)
+        before[0] = self.start.coord
+        before[1:] = self.position[:-1]
+        return before
+
+
+# ---------------------
+# PARSING
+# ---------------------
+
+def load(path):
+    """Parse a G-code file (see parse)"""
+    with open(path, 'rb') as f:
+        if not f.seek(0, 2):
+            return parse(b'')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return parse(data)
+
+
+def parse(data):
+    """
+    Parse G-code text.
+
+    Args:
+        data: bytes-like object with the whole job (e.g. an mmap)
+
+    Returns:
+        JobArrays: One row per line
+    """
+    commands = []
+    words = []
+    start = 0
+    size = len(data)
+    while start < size:
+        end = min(start + CHUNK_SIZE, size)
+        if end < size:
+            newline = data.rfind(b'\n', start, end)
+            end = newline + 1 if newline != -1 else data.find(b'\n', end) + 1 or size
+        chunk = data[start:end]
+        if not chunk.endswith(b'\n'):
+            chunk += b'\n'
+        command, chunk_words = _parse_chunk(chunk)
+        commands.append(command)
+        words.append(chunk_words)
+        start = end
+    if not commands:
+        return JobArrays(np.empty(0, np.int8), np.empty((0, len(WORDS))))
+    return JobArrays(np.concatenate(commands), np.concatenate(words))
+
+
+def _parse_chunk(chunk):
+    """parse() for text that ends in a newline"""
+    buf = np.frombuffer(chunk, np.uint8)
+    newline = buf == _NEWLINE
+    separator = newline | (buf == _SPACE) | (buf == _TAB) | (buf == _RETURN)
+    ends = np.flatnonzero(newline)
+    n = len(ends)
+
+    # Everything from the first ';' of a line on is a comment
+    cut = ends.copy()
+    semicolons = np.flatnonzero(buf == _SEMICOLON)
+    if len(semicolons):
+        semicolon_line = np.searchsorted(ends, semicolons)
+        first = _first_of_each(semicolon_line)
+        cut[semicolon_line[first]] = semicolons[first]
+
+    # Words start wherever a separator is followed by anything else, and end at the next separator
+    starts = np.flatnonzero(separator[:-1] & ~separator[1:]) + 1
+    if not separator[0]:
+        starts = np.concatenate(([0], starts))
+    word_ends = np.flatnonzero(~separator[:-1] & separator[1:]) + 1
+    line = np.searchsorted(ends, starts)
+    in_text = starts < cut[line]
+    starts, word_ends, line = starts[in_text], np.minimum(word_ends[in_text], cut[line[in_text]]), line[in_text]
+
+    # trim(): each line's text starts at its first word
+    first = _first_of_each(line)
+    lines = line[first]
+    text_start = np.full(n, -1, np.int64)
+    text_start[lines] = starts[first]
+    first_word_end = np.zeros(n, np.int64)
+    first_word_end[lines] = word_ends[first]
+
+    # startsWith() against each command, in the order parseGCode() checks them: the first
+    # four characters of each line are packed into one number and the commands tried in
+    # reverse, so the earliest match is the one left
+    command = np.full(n, BLANK, np.int8)
+    at = np.minimum(text_start[lines][:, None] + np.arange(4), len(buf) - 1)
+    head = np.where(at < cut[lines][:, None], _upper(buf[at]), 0).astype(np.uint32)
+    head = head[:, 0] << 24 | head[:, 1] << 16 | head[:, 2] << 8 | head[:, 3]
+    line_command = np.full(len(lines), UNKNOWN, np.int8)
+    # Arcs are only what the firmware ignores, and 'G2' / 'G3' must not be followed by a digit (G28)
+    third = head >> 8 & 0xFF
+    not_digit = (third < ord('0')) | (third > ord('9'))
+    for arc in ARC_COMMANDS:
+        line_command[(head >> 16 == int.from_bytes(arc.encode(), 'big')) & not_digit] = COMMAND_INDEX[arc]
+    for index in reversed(range(len(FIRMWARE_COMMANDS))):
+        prefix = FIRMWARE_COMMANDS[index].encode().ljust(4, b'\0')
+        mask = int.from_bytes(bytes(0xFF if c else 0 for c in prefix), 'big')
+        line_command[(head & mask) == int.from_bytes(prefix, 'big')] = index
+    command[lines] = line_command
+
+    words = np.full((n, len(WORDS)), np.nan)
+    with_words = np.isin(command, MOVES + ARCS + [COMMAND_INDEX['G92']])
+    if not with_words.any():
+        return command, words
+
+    # parseMove(): drop the first two characters, then split on single spaces.
+    # The words are those after a space, and whatever follows the two characters
+    # when they are glued on to the command ("G1X10").
+    after = text_start + 2
+    spaced = with_words[line] & (starts >= after[line])
+    glued = np.flatnonzero(with_words & (after < first_word_end))
+    glued = glued[~separator[after[glued] - 1]]
+    _set_words(words, buf, glued, after[glued], first_word_end[glued])
+    # Later words win over earlier ones with the same letter, so these go second
+    _set_words(words, buf, line[spaced], starts[spaced], word_ends[spaced])
+    words[~np.isin(command, ARCS), len(AXES) + 1:] = np.nan  # I, J, R only mean something to arcs
+    return command, words
+
+
+def _set_words(words, buf, line, starts, ends):
+    """Fill in words[line] from the tokens buf[start:end] (a letter and a number) in line order"""
+    column = _WORD_COLUMN[_upper(buf[starts])]
+    known = column >= 0
+    line, starts, ends, column = line[known], starts[known], ends[known], column[known]
+    values = _parse_numbers(buf, starts + 1, ends)
+    # A letter given twice on a line keeps its last value: each cell takes the latest token
+    # that goes there (ufunc.at, unlike an assignment, is done in order)
+    cell = line * len(WORDS) + column
+    token = np.arange(len(cell))
+    latest = np.full(words.size, -1)
+    np.maximum.at(latest, cell, token)
+    last = latest[cell] == token
+    words.reshape(-1)[cell[last]] = values[last]
+
+
+def _first_of_each(sorted_keys):
+    """Indices where each run of equal keys starts"""
+    return np.flatnonzero(np.diff(sorted_keys, prepend=-1))
+
+
+def _upper(chars):
+    """toUpperCase() on an array of bytes"""
+    return np.where((chars >= ord('a')) & (chars <= ord('z')), chars - 32, chars)
+
+
+def _parse_numbers(buf, starts, ends):
+    """String.toFloat() of every buf[start:end], without a Python loop for plain decimal numbers"""
+    values = np.zeros(len(starts))
+    if not len(starts):
+        return values
+    lengths = ends - starts
+    width = int(min(max(lengths.max(), 1), _NUMBER_WIDTH))
+    # One row per character position: each number's bytes are copied out of a
+    # sliding window over the buffer, so nothing reads past its end
+    padded = np.concatenate((buf, np.zeros(width, np.uint8)))
+    windows = np.lib.stride_tricks.sliding_window_view(padded, width)
+    inside = np.arange(width)[:, None] < lengths
+    chars = windows[starts].T * inside
+
+    digits = chars - np.uint8(ord('0'))  # Wraps around for anything that is not a digit
+    digit = digits < 10
+    point = chars == ord('.')
+    sign = (chars[0] == ord('-')) | (chars[0] == ord('+'))
+    allowed = digit | point | ~inside
+    plain = (lengths <= width) & (allowed[0] | sign) & allowed[1:].all(axis=0) & (point.sum(axis=0) <= 1)
+
+    # Horner's rule over the digits, skipping the point and whatever is past the end
+    # (uint8 arithmetic on the masks, np.where and argmax are several times slower here)
+    digit = digit.view(np.uint8)
+    scale = digit * np.uint8(9)
+    scale += np.uint8(1)  # 10 for a digit, 1 for anything else
+    digits *= digit
+    mantissa = np.zeros(len(starts))
+    for i in range(width):
+        np.multiply(mantissa, scale[i], out=mantissa)
+        np.add(mantissa, digits[i], out=mantissa)
+    # Characters up to and including the point (0 without one), plain numbers have at most one
+    point_end = (point.view(np.uint8) * np.arange(1, width + 1, dtype=np.uint8)[:, None]).max(axis=0)
+    decimals = np.where((point_end > 0) & (lengths <= width), lengths - point_end, 0)  # Longer ones: the slow way
+    values = mantissa / _POWERS_OF_TEN[decimals]
+    values[chars[0] == ord('-')] *= -1
+
+    # Anything else (exponents, trailing junk, very long numbers) the slow way
+    for i in np.flatnonzero(~plain):
+        values[i] = to_float(bytes(buf[starts[i]:ends[i]]).decode(errors='replace'))
+    return values
+
+
+# ---------------------
+# MODAL STATE
+# ---------------------
+
+def _forward_fill(is_set, values, initial):
+    """For each row, values at the last row where is_set, or initial before the first one"""
+    rows = np.arange(len(is_set))
+    last = np.maximum.accumulate(np.where(is_set, rows, -1))
+    return np.where(last >= 0, values[np.maximum(last, 0)], initial)
+
+
+def replay(job, start=None):
+    """
+    Work out the firmware's state after every line of a job.
+
+    Args:
+        job (JobArrays): The parsed job
+        start (gcode.MachineState): State before the first line (default: just booted)
+
+    Returns:
+        MachineStates
+    """
+    start = start or MachineState()
+    command = job.command
+    move = job.is_move() | job.is_arc()  # An arc ends where a straight move with its words would
+
+    positioning = job.is_command('G90') | job.is_command('G91')
+    absolute_positioning = _forward_fill(positioning, job.is_command('G90'), start.absolute_positioning)
+    extrusion = job.is_command('M82') | job.is_command('M83')
+    absolute_extrusion = _forward_fill(extrusion, job.is_command('M82'), start.absolute_extrusion)
+
+    given = job.given()
+    feedrate = np.clip(job.words[:, 4], MIN_FEEDRATE, MAX_FEEDRATE)
+    feedrate = _forward_fill(move & given[:, 4], feedrate, start.feedrate)
+
+    set_position = job.is_command('G92')
+    bare_g92 = set_position & ~given[:, :4].any(axis=1)
+    home = job.is_command('G28')
+
+    position = np.empty((len(command), 4))
+    for axis in range(4):
+        value = job.words[:, axis]
+        absolute = absolute_extrusion if axis == 3 else absolute_positioning
+        moved = move & given[:, axis]
+        is_set = (moved & absolute) | (set_position & given[:, axis]) | bare_g92
+        set_value = np.where(bare_g92, 0.0, value)
+        if axis < 3:
+            is_set |= home
+            set_value = np.where(home, 0.0, set_value)
+        # Relative moves add up from the last absolute move, G92 or G28
+        total = np.cumsum(np.where(moved & ~absolute, value, 0.0))
+        base = _forward_fill(is_set, set_value - total, start.coord[axis])
+        position[:, axis] = base + total
+    return MachineStates(position, feedrate, absolute_positioning, absolute_extrusion, start)
@@ -0,0 +1,320 @@
+import functools
+import hashlib
+import json
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+import jobarrays
+from binproto import FIXED_POINT
+from gcode import clean, format_number, to_int
+from jobfile import JobFile
+
+# ---------------------
+# COMPILED JOB CACHE
+# A G-code file is parsed once (jobarrays.load) into a compact columnar
+# file with one row per line that is not blank or a comment:
+#
+#   header    magic, rows, lines of the source file, arcs
+#   line      uint32 (rows,)     line of the source file (0-based)
+#   command   int8 (rows,)       index into jobarrays.COMMANDS, or jobarrays.UNKNOWN
+#   given     uint8 (rows,)      bit 0..7 = X, Y, Z, E, F, I, J, R given
+#   axes      int32 (rows, 4)    X, Y, Z, E in micrometres, like binproto (M100: the line count in X, not scaled)
+#   feedrate  float32 (rows,)    mm/min
+#   centre    int32 (arcs, 3)    I, J, R in micrometres, for the G2/G3 rows in order
+#
+# Compiled files are kept in CACHE_DIR under the hash of the G-code they
+# came from and memory-mapped when opened, so opening or printing the same
+# job again costs no parsing. The least recently used ones are removed
+# once the cache is larger than CACHE_SIZE:
+#
+#     with open_job('job.gcode') as job:
+#         states = jobarrays.replay(job.arrays())
+#         uploader.stream_lines(job.lines(), job.line_count)
+# ---------------------
+
+CACHE_DIR = os.path.expanduser('~/.ceratech_jobs')
+CACHE_SIZE = 1 << 30  # Bytes of compiled jobs kept
+SUFFIX = '.cjob'
+HEADER = struct.Struct('<4sQQQ')  # Magic, rows, source lines, arcs
+MAGIC = b'CJB2'
+HASHES = 'hashes.json'  # Source path -> [size, mtime (ns), hash], so unchanged files are not hashed again
+
+_M100 = jobarrays.COMMAND_INDEX['M100']
+_WITH_WORDS = [jobarrays.COMMAND_INDEX[command] for command in ('G0', 'G1', 'G92')] + jobarrays.ARCS
+_format = functools.lru_cache(maxsize=1 << 16)(format_number)  # Jobs go back to the same coordinates a lot
+
+
+def _layout(rows, arcs):
+    """(name, dtype, shape, offset) of each column of a file with `rows` rows and `arcs` arcs"""
+    columns = [('line', np.uint32, (rows,)), ('command', np.int8, (rows,)), ('given', np.uint8, (rows,)),
+               ('axes', np.int32, (rows, 4)), ('feedrate', np.float32, (rows,)), ('centre', np.int32, (arcs, 3))]
+    layout = []
+    offset = HEADER.size
+    for name, dtype, shape in columns:
+        itemsize = np.dtype(dtype).itemsize
+        offset += -offset % itemsize  # Aligned for the type
+        layout.append((name, dtype, shape, offset))
+        offset += itemsize * int(np.prod(shape))
+    return layout
+
+
+class CompiledJob:
+    """
+    A compiled job, its columns memory-mapped from the cache file.
+
+    Attributes:
+        line, command, given, axes, feedrate, centre: The columns (see above)
+        line_count: Lines of the source file
+        path: The cache file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            header = f.read(HEADER.size)
+        if len(header) < HEADER.size or not header.startswith(MAGIC):
+            raise ValueError(f"{path} is not a compiled job")
+        _, rows, self.line_count, arcs = HEADER.unpack(header)
+        self.rows = rows
+        for name, dtype, shape, offset in _layout(rows, arcs):
+            # np.memmap refuses empty arrays
+            column = np.memmap(path, dtype, 'r', offset, shape) if shape[0] else np.zeros(shape, dtype)
+            setattr(self, name, column)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Let go of the memory maps (they are unmapped once nothing else uses the columns)"""
+        self.line = self.command = self.given = self.axes = self.feedrate = self.centre = None
+
+    def __len__(self):
+        return self.rows
+
+    def arrays(self):
+        """jobarrays.JobArrays of the job, one row per line of the source file"""
+        command = np.full(self.line_count, jobarrays.BLANK, np.int8)
+        command[self.line] = self.command
+        arcs = np.isin(self.command, jobarrays.ARCS)
+        values = np.column_stack((self.axes / FIXED_POINT, self.feedrate, np.zeros((self.rows, 3))))
+        values[arcs, 5:] = self.centre / FIXED_POINT
+        given = (self.given[:, None] >> np.arange(8) & 1).astype(bool) & np.isin(self.command, _WITH_WORDS)[:, None]
+        words = np.full((self.line_count, len(jobarrays.WORDS)), np.nan)
+        words[self.line] = np.where(given, values, np.nan)
+        return jobarrays.JobArrays(command, words)
+
+    def lines(self, start=0, chunk=65536):
+        """
+        The job as G-code again, one line per line of the source file from
+        line `start` (0-based) on: comments, blank lines and lines the
+        firmware ignores are '', numbers are rounded to the micrometre
+        (like pipeline.preprocess gives them, give or take the last digit)
+        """
+        current = start
+        first = int(np.searchsorted(self.line, start))
+        arc = int(np.isin(self.command[:first], jobarrays.ARCS).sum())  # Row of `centre` the next arc is on
+        for begin in range(first, self.rows, chunk):
+            end = min(begin + chunk, self.rows)
+            arcs = np.isin(self.command[begin:end], jobarrays.ARCS)
+            centre = np.zeros((end - begin, 3))
+            centre[arcs] = self.centre[arc:arc + arcs.sum()] / FIXED_POINT
+            arc += arcs.sum()
+            rows = zip(self.line[begin:end].tolist(), self.command[begin:end].tolist(),
+                       self.given[begin:end].tolist(), (self.axes[begin:end] / FIXED_POINT).tolist(),
+                       self.feedrate[begin:end].tolist(), centre.tolist())
+            for line, command, given, axes, feedrate, centre in rows:
+                while current < line:
+                    yield ''
+                    current += 1
+                current += 1
+                yield _line(command, given, axes, feedrate, centre)
+        while current < self.line_count:
+            yield ''
+            current += 1
+
+
+def _line(command, given, axes, feedrate, centre):
+    """Text of one row"""
+    if command < 0:
+        return ''
+    name = jobarrays.COMMANDS[command]
+    if command == _M100:
+        return f"M100 S{int(axes[0] * FIXED_POINT)}" if given & 1 else name
+    if command not in _WITH_WORDS:
+        return name
+    words = [name]
+    words += [code + _format(value) for bit, (code, value) in enumerate(zip('XYZE', axes)) if given >> bit & 1]
+    if given & 0x10:
+        words.append('F' + _format(feedrate))
+    words += [code + _format(value) for bit, (code, value) in enumerate(zip('IJR', centre), 5) if given >> bit & 1]
+    return ' '.join(words)
+
+
+# ---------------------
+# COMPILING AND CACHING
+# ---------------------
+
+def compile_file(source, path):
+    """Parse a G-code file and write it compiled to `path`"""
+    job = jobarrays.load(source)
+    rows = np.flatnonzero(job.command != jobarrays.BLANK)
+    command = job.command[rows]
+    words = job.words[rows]
+    given = (~np.isnan(words) * (1 << np.arange(8))).sum(axis=1).astype(np.uint8)
+    axes = _fixed_point(words[:, :4])
+    feedrate = np.nan_to_num(words[:, 4]).astype(np.float32)
+    centre = _fixed_point(words[np.isin(command, jobarrays.ARCS), 5:])
+
+    # M100 S<lines>: the count is not one of the words jobarrays reads
+    set_lines = np.flatnonzero(command == _M100)
+    if len(set_lines):
+        with JobFile(source) as f:
+            for i in set_lines:
+                gcode = clean(f.line(int(rows[i])))
+                s_index = gcode.find('S')
+                if s_index != -1:
+                    axes[i, 0] = to_int(gcode[s_index + 1:])
+                    given[i] |= 1
+
+    columns = {'line': rows.astype(np.uint32), 'command': command, 'given': given, 'axes': axes,
+               'feedrate': feedrate, 'centre': centre}
+    # A temporary file of its own, other threads or processes may be compiling the same job
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, len(rows), len(job), len(centre)))
+            for name, dtype, _, offset in _layout(len(rows), len(centre)):
+                f.write(b'\0' * (offset - f.tell()))
+                f.write(np.ascontiguousarray(columns[name], dtype).tobytes())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _fixed_point(values):
+    """mm -> int32 micrometres, 0 where NaN"""
+    return np.clip(np.round(np.nan_to_num(values) * FIXED_POINT), -2 ** 31, 2 ** 31 - 1).astype(np.int32)
+
+
+def file_hash(path):
+    """Hash of a file's contents"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(1 << 20)
+            if not chunk:
+                return digest.hexdigest()
+            digest.update(chunk)
+
+
+def _load_hashes(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, HASHES)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_hashes(cache_dir, hashes):
+    try:
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(hashes, f)
+        os.replace(tmp_path, os.path.join(cache_dir, HASHES))
+    except OSError:
+        pass  # Only costs hashing it again next time
+
+
+def _source_hash(source, cache_dir):
+    """file_hash of the source, remembered by path, size and mtime so an unchanged file is not read"""
+    stat = os.stat(source)
+    key = os.path.abspath(source)
+    hashes = _load_hashes(cache_dir)
+    known = hashes.get(key)
+    if known and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return known[2]
+    digest = file_hash(source)
+    hashes[key] = [stat.st_size, stat.st_mtime_ns, digest]
+    _save_hashes(cache_dir, hashes)
+    return digest
+
+
+def evict(cache_dir=CACHE_DIR, cache_size=CACHE_SIZE, keep=None):
+    """
+    Remove the least recently used compiled jobs until the rest fit in
+    `cache_size` bytes, and forget the hashes of the files they came from
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(SUFFIX):
+            path = os.path.join(cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue  # Evicted by another process meanwhile
+            entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    removed = set()  # Hashes of the jobs removed
+    for _, size, path in entries:
+        if total <= cache_size:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed.add(os.path.basename(path)[:-len(SUFFIX)])
+    if removed:
+        hashes = _load_hashes(cache_dir)
+        _save_hashes(cache_dir, {key: known for key, known in hashes.items() if known[2] not in removed})
+
+
+def open_job(source, cache_dir=CACHE_DIR, cache_size=CACHE_SIZE):
+    """
+    The compiled job for a G-code file, compiled now if it is not in the cache
+
+    Raises:
+        FileNotFoundError: If the file does not exist
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, _source_hash(source, cache_dir) + SUFFIX)
+    if os.path.exists(path):
+        try:
+            job = CompiledJob(path)
+            os.utime(path)  # Most recently used
+            return job
+        except (OSError, ValueError):
+            pass  # Cut short or not ours, compile it again
+    compile_file(source, path)
+    evict(cache_dir, cache_size, keep=path)
+    return CompiledJob(path)
+
+
+def main():
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Compile G-code files into the job cache")
+    parser.add_argument('files', nargs='+')
+    args = parser.parse_args()
+
+    for source in args.files:
+        start = time.perf_counter()
+        with open_job(source) as job:
+            took = time.perf_counter() - start
+            print(f"{source}: {job.line_count} lines, {len(job)} commands, {os.path.getsize(job.path)} bytes "
+                  f"in {job.path} ({took:.2f} s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+import mmap
+import os
+import struct
+from array import array
+
+# ---------------------
+# MEMORY-MAPPED JOB FILES
+# Reads a G-code file through mmap instead of loading it, so a job of
+# hundreds of MB costs little more memory than a small one. The byte offset
+# of every line is kept in an array (8 bytes per line) that is built while
+# the file is read the first time and cached next to it as <file>.idx:
+#
+#     with JobFile('job.gcode') as job:
+#         for line in job:
+#             ...
+#             print(f"{job.percent_done():.1f}%")
+# ---------------------
+
+INDEX_SUFFIX = '.idx'
+INDEX_HEADER = struct.Struct('<4sQQ')  # Magic, file size, file mtime (ns)
+INDEX_MAGIC = b'GIX1'
+
+
+class JobFile:
+    """
+    A G-code file opened for sending.
+
+    Iterating gives the lines as str (with their line ending, like a text
+    file), one at a time. Progress is the byte offset reached, so nothing
+    has to be counted before sending starts.
+
+    Args:
+        path (str): The G-code file
+        cache_index (bool): Load the line index from <path>.idx, and save it there once built
+    """
+
+    def __init__(self, path, cache_index=True):
+        self.path = path
+        self.cache_index = cache_index
+        self._file = open(path, 'rb')
+        stat = os.fstat(self._file.fileno())
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime_ns
+        # mmap refuses empty files
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b''
+        self.position = 0  # Byte offset of the end of the last line read
+        self._index = self._load_index() if cache_index else None
+        self._partial_index = array('Q')  # Offsets of the lines read so far while the index is being built
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+    def __iter__(self):
+        return self.lines()
+
+    def __len__(self):
+        """Number of lines (builds the index if it is not known yet)"""
+        return len(self.index)
+
+    @property
+    def index(self):
+        """array('Q') of the byte offset where each line starts"""
+        if self._index is None:
+            index = array('Q')
+            find = self._map.find
+            start = 0
+            while start < self.size:
+                index.append(start)
+                end = find(b'\n', start)
+                start = self.size if end == -1 else end + 1
+            self._set_index(index)
+        return self._index
+
+    def lines(self, start=0, offset=None):
+        """
+        Yield the lines from line number `start` (0-based) on.
+
+        Reading from the start of a file that has no index yet builds the
+        index on the way.
+
+        Args:
+            offset (int): Byte offset where line `start` begins, if already known
+        """
+        if offset is None:
+            offset = self.offset_of(start) if start else 0
+        building = None
+        if self._index is None and not start:
+            building = self._partial_index = array('Q')
+        find = self._map.find
+        data = self._map
+        while offset < self.size:
+            end = find(b'\n', offset)
+            end = self.size if end == -1 else end + 1
+            if building is not None:
+                building.append(offset)
+            self.position = end
+            yield data[offset:end].decode(errors='replace')
+            offset = end
+        if building is not None and self._index is None:
+            self._set_index(building)
+
+    def offset_of(self, number):
+        """Byte offset where line `number` (0-based) starts, or the file size past the last line"""
+        if self._index is None and self._partial_index and number <= len(self._partial_index):
+            # Already read, no need to scan the file for the index
+            return self._partial_index[number] if number < len(self._partial_index) else self.position
+        index = self.index
+        return index[number] if number < len(index) else self.size
+
+    def line(self, number):
+        """Line `number` (0-based) without its line ending"""
+        start = self.index[number]
+        end = self.index[number + 1] if number + 1 < len(self.index) else self.size
+        return self._map[start:end].decode(errors='replace').rstrip('\r\n')
+
+    def line_at(self, offset):
+        """Number (0-based) of the line that byte `offset` is in"""
+        index = self.index
+        low, high = 0, len(index)
+        while high - low > 1:
+            middle = (low + high) // 2
+            if index[middle] <= offset:
+                low = middle
+            else:
+                high = middle
+        return low
+
+    def percent_done(self, current_line=None):
+        """
+        How far through the file reading has got, by bytes. current_line is
+        not needed, it only lets this be passed to the senders as total_lines.
+        """
+        return self.position / self.size * 100 if self.size else 100.0
+
+    # ---------------------
+    # INDEX CACHE
+    # ---------------------
+
+    def _index_path(self):
+        return self.path + INDEX_SUFFIX
+
+    def _load_index(self):
+        """The cached index, or None if there is none or the file has changed since"""
+        try:
+            with open(self._index_path(), 'rb') as f:
+                magic, size, mtime = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+                if magic != INDEX_MAGIC or size != self.size or mtime != self.mtime:
+                    return None
+                index = array('Q')
+                index.frombytes(f.read())
+                return index
+        except (OSError, struct.error, ValueError):
+            return None
+
+    def _set_index(self, index):
+        self._index = index
+        if not self.cache_index:
+            return
+        path = self._index_path()
+        try:
+            with open(path + '.tmp', 'wb') as f:
+                f.write(INDEX_HEADER.pack(INDEX_MAGIC, self.size, self.mtime))
+                f.write(index.tobytes())
+            os.replace(path + '.tmp', path)
+        except OSError:
+            pass  # Read-only directory, the index is just not cached
@@ -0,0 +1,281 @@
+import contextlib
+import cProfile
+import logging
+import os
+import pstats
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+# ---------------------
+# SEND-PATH INSTRUMENTATION
+# PrinterConnection records every line it writes into SendMetrics: when it
+# was written, when its reply started to arrive and when it was
+# acknowledged, and how many commands were in flight, in preallocated ring
+# buffers holding the newest lines, plus counters for firmware errors,
+# rejected records and resets. Recording is a few array stores per line,
+# so it is always on. Console output of the send path goes through the
+# 'ceratech' logger: per-line messages are DEBUG, and they, progress and
+# firmware errors are rate-limited (see RateLimitFilter).
+#
+#     uploader.start_print('job.gcode', metrics_path='job.prom', profile='job.prof')
+#     uploader.connection.metrics.summary()
+# ---------------------
+
+log = logging.getLogger('ceratech')
+
+LOG_INTERVAL = 1.0  # Seconds between two messages from the same rate-limited call
+RATE_LIMITED = {'rate_limit': True}  # extra= for messages logged once per line or event
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets a message logged with extra=RATE_LIMITED through at most once every
+    `interval` seconds for each place it is logged from (the first one
+    always passes). The next message that passes tells how many were held
+    back. Everything else passes.
+    """
+
+    def __init__(self, interval=LOG_INTERVAL):
+        super().__init__()
+        self.interval = interval
+        self._last = {}  # (file, line) -> time the last message passed
+        self._held = {}  # (file, line) -> messages held back since
+
+    def filter(self, record):
+        if not getattr(record, 'rate_limit', False):
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        if now - self._last.get(key, -self.interval) < self.interval:
+            self._held[key] = self._held.get(key, 0) + 1
+            return False
+        self._last[key] = now
+        held = self._held.pop(key, 0)
+        if held:
+            record.msg = f"{record.msg} ({held} more not shown)"
+        return True
+
+
+class _ConsoleHandler(logging.StreamHandler):
+    """Writes to whatever sys.stdout is when the message is logged (the benchmark and farm redirect it)"""
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+
+def setup_logging(level=logging.INFO, interval=LOG_INTERVAL):
+    """Print the send path's messages at `level` and above, like print() used to (done on import)"""
+    for handler in list(log.handlers):
+        if isinstance(handler, _ConsoleHandler):
+            log.removeHandler(handler)
+    handler = _ConsoleHandler()
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    handler.addFilter(RateLimitFilter(interval))
+    log.addHandler(handler)
+    log.setLevel(level)
+    log.propagate = False
+
+
+if not log.handlers:
+    setup_logging()
+
+
+class SendMetrics:
+    """
+    Per-line timings of the send path, for the newest `capacity` lines.
+
+    Times are time.perf_counter() seconds, NaN until known. A line is
+    identified by the number wrote() returns, its slot is that number
+    modulo capacity.
+
+    Attributes:
+        write_time, first_byte_time, ack_time: float64 (capacity,)
+        line: int64 (capacity,) line number within its job (0 for single commands)
+        queue_depth: int32 (capacity,) commands in flight once the line was written
+        size: int32 (capacity,) bytes written
+        count: Lines recorded so far
+        counters: {name: int} lines, bytes, acks, errors, naks, resent, resets, timeouts,
+            baud_fallbacks (baud rates given up on, see PrinterConnection.negotiate_baudrate)
+    """
+
+    COUNTERS = ('lines', 'bytes', 'acks', 'errors', 'naks', 'resent', 'resets', 'timeouts', 'baud_fallbacks')
+
+    def __init__(self, capacity=65536):
+        self.capacity = capacity
+        self.write_time = np.full(capacity, np.nan)
+        self.first_byte_time = np.full(capacity, np.nan)
+        self.ack_time = np.full(capacity, np.nan)
+        self.line = np.zeros(capacity, dtype=np.int64)
+        self.queue_depth = np.zeros(capacity, dtype=np.int32)
+        self.size = np.zeros(capacity, dtype=np.int32)
+        self.count = 0
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+
+    def wrote(self, line, size, queue_depth):
+        """Record a line that was just written. Returns its number, for first_byte() and acked()."""
+        number = self.count
+        slot = number % self.capacity
+        self.write_time[slot] = time.perf_counter()
+        self.first_byte_time[slot] = self.ack_time[slot] = np.nan
+        self.line[slot] = line
+        self.size[slot] = size
+        self.queue_depth[slot] = queue_depth
+        self.count += 1
+        self.counters['lines'] += 1
+        self.counters['bytes'] += size
+        return number
+
+    def first_byte(self, number):
+        """The first line of the reply to line `number` (or its one-byte binary reply) has arrived"""
+        if number >= self.count - self.capacity:  # Not overwritten by newer lines yet
+            self.first_byte_time[number % self.capacity] = time.perf_counter()
+
+    def acked(self, number):
+        """Line `number` was acknowledged"""
+        self.counters['acks'] += 1
+        if number >= self.count - self.capacity:
+            self.ack_time[number % self.capacity] = time.perf_counter()
+
+    def add(self, counter, n=1):
+        self.counters[counter] += n
+
+    def recent(self):
+        """
+        The lines still kept, oldest first
+
+        Returns:
+            dict: Arrays like the attributes, in order
+        """
+        kept = min(self.count, self.capacity)
+        order = np.arange(self.count - kept, self.count) % self.capacity
+        return {name: getattr(self, name)[order]
+                for name in ('line', 'write_time', 'first_byte_time', 'ack_time', 'queue_depth', 'size')}
+
+    def summary(self):
+        """
+        Returns:
+            dict: The counters, plus p50/p90/p99 of the first-byte and ack
+                latencies (seconds) and the mean queue depth of the lines kept
+        """
+        recent = self.recent()
+        summary = dict(self.counters)
+        for name, end in (('first_byte', recent['first_byte_time']), ('ack', recent['ack_time'])):
+            latency = (end - recent['write_time'])[~np.isnan(end)]
+            for p in (50, 90, 99):
+                summary[f"{name}_p{p}"] = float(np.percentile(latency, p)) if len(latency) else None
+        summary['queue_depth_mean'] = float(recent['queue_depth'].mean()) if len(recent['queue_depth']) else None
+        return summary
+
+
+def export_csv(metrics, path):
+    """One row per line kept: line, write time and the latencies in seconds, queue depth and bytes"""
+    recent = metrics.recent()
+    start = recent['write_time'][0] if len(recent['write_time']) else 0.0
+    table = np.column_stack([recent['line'], recent['write_time'] - start,
+                             recent['first_byte_time'] - recent['write_time'],
+                             recent['ack_time'] - recent['write_time'],
+                             recent['queue_depth'], recent['size']])
+    np.savetxt(path, table, delimiter=',', fmt=['%d', '%.6f', '%.6f', '%.6f', '%d', '%d'], comments='',
+               header='line,write_s,first_byte_s,ack_s,queue_depth,bytes')
+
+
+def export_prometheus(metrics, path, labels=None):
+    """
+    Write the summary in the Prometheus text format, e.g. for node_exporter's
+    textfile collector. The file is replaced in one go, so it is never read half written.
+
+    Args:
+        labels (dict): Added to every sample (e.g. {'printer': serial number})
+    """
+    label_text = ','.join(f'{key}="{value}"' for key, value in (labels or {}).items())
+    summary = metrics.summary()
+    out = []
+    for counter in metrics.COUNTERS:
+        out.append(f"# TYPE ceratech_{counter}_total counter")
+        out.append(f"ceratech_{counter}_total{{{label_text}}} {summary[counter]}")
+    for name in ('first_byte', 'ack'):
+        out.append(f"# TYPE ceratech_{name}_latency_seconds summary")
+        for p in (50, 90, 99):
+            value = summary[f"{name}_p{p}"]
+            quantile = ','.join(filter(None, [label_text, f'quantile="{p / 100}"']))
+            out.append(f"ceratech_{name}_latency_seconds{{{quantile}}} {'NaN' if value is None else value}")
+    out.append("# TYPE ceratech_queue_depth gauge")
+    depth = summary['queue_depth_mean']
+    out.append(f"ceratech_queue_depth{{{label_text}}} {'NaN' if depth is None else depth}")
+    with open(path + '.tmp', 'w') as f:
+        f.write('\n'.join(out) + '\n')
+    os.replace(path + '.tmp', path)
+
+
+def export(metrics, path, **kwargs):
+    """export_csv for *.csv, export_prometheus for anything else"""
+    if path.endswith('.csv'):
+        export_csv(metrics, path)
+    else:
+        export_prometheus(metrics, path, **kwargs)
+
+
+@contextlib.contextmanager
+def profiling(profile_path=None, trace_memory=False):
+    """
+    Profile what runs inside on this thread (cProfile, saved to
+    `profile_path` for pstats / snakeviz) and, with `trace_memory`, log where
+    the most memory was allocated meanwhile (tracemalloc, all threads).
+    Does nothing if neither is asked for.
+
+    cProfile only sees the thread it was enabled on, so this yields a
+    function that wraps a coroutine to be profiled on the thread that runs
+    it (the job is sent from uploader's event loop thread). Its stats are
+    saved together with this thread's:
+
+        with metrics.profiling('job.prof') as profiled:
+            uploader._run(profiled(connection.stream(lines)))
+    """
+    profilers = []
+
+    def profiled(coroutine):
+        return _profiled(coroutine, profilers) if profile_path else coroutine
+
+    profiler = cProfile.Profile() if profile_path else None
+    tracing = trace_memory and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    if profiler:
+        profiler.enable()
+        profilers.append(profiler)
+    try:
+        yield profiled
+    finally:
+        if profiler:
+            profiler.disable()
+            pstats.Stats(*profilers).dump_stats(profile_path)
+            log.info("Profile saved to %s", profile_path)
+        if tracing:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            log.info("Memory: %.1f MB allocated, %.1f MB peak. Top allocations:", current / 1e6, peak / 1e6)
+            for stat in snapshot.statistics('lineno')[:10]:
+                log.info("  %s", stat)
+
+
+async def _profiled(coroutine, profilers):
+    """Await `coroutine` with a profiler on this thread, which also sees the other tasks of its loop meanwhile"""
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:  # Python 3.12+: the one profiling() enabled already sees every thread
+        return await coroutine
+    profilers.append(profiler)
+    try:
+        return await coroutine
+    finally:
+        profiler.disable()
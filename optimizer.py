@@ -0,0 +1,432 @@
+import argparse
+import os
+
+import numpy as np
+
+import arcs
+import jobarrays
+from gcode import format_number
+
+# ---------------------
+# MOVE OPTIMIZER
+# Rewrites a job so the printer has less to do:
+#   - runs of (nearly) collinear G0/G1 segments with the same feedrate and
+#     extrusion rate become one segment ending where the run ended, so the
+#     E total is unchanged (G2/G3 arcs are cut into chords first, see arcs.py)
+#   - within a layer, the islands of extruding moves are visited in
+#     nearest-neighbour order to cut down the travel between them
+# Everything is worked out on the arrays from jobarrays.py. The optimized
+# job is written with absolute positions (G90/M82) and can be sent like
+# any other file:
+#
+#     python optimizer.py job.gcode            # writes job.opt.gcode
+#     uploader.start_print('job.gcode', optimize=True)
+# ---------------------
+
+DEFAULT_TOLERANCE = 0.01  # mm a merged segment may stray from the points it replaces
+E_RATE_TOLERANCE = 0.02  # Relative difference in extrusion per mm allowed between merged segments
+PRECISION = 3  # Decimals written
+OUTPUT_SUFFIX = '.opt'
+
+# Commands that are kept. The modes are written once at the top, and M100 is dropped
+# because the line count it gives no longer holds.
+_KEPT_COMMANDS = [jobarrays.COMMAND_INDEX[command] for command in ('G92', 'G28', 'M17', 'M18', 'M114')]
+
+
+class OptimizerStats:
+    """What the optimizer changed"""
+
+    def __init__(self):
+        self.moves_in = 0
+        self.moves_out = 0
+        self.segments_merged = 0
+        self.islands_reordered = 0
+        self.travel_before = 0.0  # mm of non-extruding moves
+        self.travel_after = 0.0
+
+    def summary(self):
+        saved = self.travel_before - self.travel_after
+        return (f"Optimizer: {self.moves_in} -> {self.moves_out} moves ({self.segments_merged} segments merged), "
+                f"travel {self.travel_before:.1f} -> {self.travel_after:.1f} mm ({saved:.1f} mm saved, "
+                f"{self.islands_reordered} islands reordered)")
+
+
+class Segments:
+    """
+    The moves of a job as straight segments, in the order they are printed.
+
+    Attributes:
+        start, end: float64 (segments, 4) X, Y, Z, E at each end
+        feedrate: float64 (segments,) mm/min
+        row: int64 (segments,) line of the job the segment ends on
+        error: float64 (segments,) how far merged-away points may be from the segment
+        joined: bool (segments,) nothing but this segment's own move lies between it and the next
+    """
+
+    def __init__(self, start, end, feedrate, row, error, joined):
+        self.start = start
+        self.end = end
+        self.feedrate = feedrate
+        self.row = row
+        self.error = error
+        self.joined = joined
+
+    def __len__(self):
+        return len(self.row)
+
+    def take(self, keep):
+        return Segments(self.start[keep], self.end[keep], self.feedrate[keep], self.row[keep],
+                        self.error[keep], self.joined[keep])
+
+    def extruding(self):
+        return self.end[:, 3] - self.start[:, 3] > 0
+
+    def lengths(self):
+        return np.linalg.norm(self.end[:, :3] - self.start[:, :3], axis=1)
+
+
+# ---------------------
+# COLLINEAR MERGING
+# ---------------------
+
+def _distance_to_line(point, a, b):
+    """Distance of each point from the line through a and b (XYZ)"""
+    direction = b - a
+    length = np.linalg.norm(direction, axis=1)
+    cross = np.cross(direction, point - a)
+    return np.linalg.norm(cross, axis=1) / np.where(length > 0, length, 1)
+
+
+def merge_collinear(segments, tolerance=DEFAULT_TOLERANCE):
+    """
+    Merge neighbouring segments that lie on (nearly) one line.
+
+    Every pass merges every other mergeable pair, so no segment takes part
+    in two merges at once and the error bound stays exact: a merged
+    segment's error is the distance of the dropped point from it plus the
+    larger error of the two halves.
+
+    Returns:
+        Segments: With the merged segments replaced
+    """
+    while len(segments) > 1:
+        a, p, b = segments.start[:-1, :3], segments.end[:-1, :3], segments.end[1:, :3]
+        first = p - a
+        second = b - p
+        length_first = np.linalg.norm(first, axis=1)
+        length_second = np.linalg.norm(second, axis=1)
+        de_first = segments.end[:-1, 3] - segments.start[:-1, 3]
+        de_second = segments.end[1:, 3] - segments.start[1:, 3]
+        rate_first = de_first / np.where(length_first > 0, length_first, 1)
+        rate_second = de_second / np.where(length_second > 0, length_second, 1)
+        error = np.maximum(segments.error[:-1], segments.error[1:]) + _distance_to_line(p, a, b)
+
+        mergeable = (segments.joined[:-1]
+                     & (segments.feedrate[:-1] == segments.feedrate[1:])
+                     & (length_first > 0) & (length_second > 0)
+                     & ((first * second).sum(axis=1) > 0)
+                     & (error <= tolerance)
+                     & (((de_first == 0) & (de_second == 0))
+                        | ((de_first > 0) & (de_second > 0)
+                           & (np.abs(rate_first - rate_second) <= E_RATE_TOLERANCE * np.maximum(rate_first, rate_second)))))
+        if not mergeable.any():
+            break
+
+        # In each run of mergeable pairs, take the 1st, 3rd, 5th, ...
+        index = np.arange(len(mergeable))
+        run_start = np.maximum.accumulate(np.where(mergeable & ~np.concatenate(([False], mergeable[:-1])), index, 0))
+        merge = mergeable & ((index - run_start) % 2 == 0)
+
+        k = np.flatnonzero(merge)
+        segments.end[k] = segments.end[k + 1]
+        segments.row[k] = segments.row[k + 1]
+        segments.joined[k] = segments.joined[k + 1]
+        segments.error[k] = error[k]
+        keep = np.ones(len(segments), bool)
+        keep[k + 1] = False
+        segments = segments.take(keep)
+    return segments
+
+
+# ---------------------
+# TRAVEL REORDERING
+# ---------------------
+
+def _runs(flags):
+    """(start, stop) of each run of True in flags"""
+    edges = np.diff(np.concatenate(([0], flags.astype(np.int8), [0])))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def reorder_islands(segments, stats):
+    """
+    Within each layer, print the islands (runs of extruding segments) in
+    nearest-neighbour order, starting from where the layer starts and
+    travelling back to where it originally ended. A layer is only changed
+    when that makes its travel shorter, and not at all if it retracts (E
+    going back between islands), since the retractions could not follow
+    the islands around.
+
+    Returns:
+        list: Segments objects in the new printing order, travel moves included
+    """
+    # A layer: segments in a row with nothing in between and no Z change
+    same_z = segments.start[:, 2] == segments.end[:, 2]
+    continues = np.zeros(len(segments), bool)
+    continues[1:] = segments.joined[:-1] & same_z[:-1] & same_z[1:]
+    boundaries = np.append(np.flatnonzero(~continues), len(segments))
+
+    extruding = segments.extruding()
+    retracting = segments.end[:, 3] < segments.start[:, 3]
+    island_starts = extruding & ~np.concatenate(([False], extruding[:-1] & continues[1:]))
+    islands = np.add.reduceat(island_starts, boundaries[:-1])
+    retracts = np.add.reduceat(retracting, boundaries[:-1])
+    candidates = np.flatnonzero((islands >= 2) & (retracts == 0))
+
+    parts = []
+    done = 0  # Segments up to here are in parts already
+    for block_index in candidates:
+        begin, finish = boundaries[block_index], boundaries[block_index + 1]
+        block = segments.take(slice(begin, finish))
+        starts, stops = _runs(extruding[begin:finish])
+        reordered = _reorder_block(block, starts, stops)
+        if reordered is None:
+            continue
+        stats.islands_reordered += len(starts)
+        parts.append(segments.take(slice(done, begin)))
+        parts.append(reordered)
+        done = finish
+    parts.append(segments.take(slice(done, len(segments))))
+    return parts
+
+
+def _reorder_block(block, starts, stops):
+    """Nearest-neighbour order of the islands in one layer, or None if it travels no less"""
+    travel = ~block.extruding()
+    travel_before = block.lengths()[travel].sum()
+    origin = block.start[0]
+    destination = block.end[-1]
+    island_start = block.start[starts]
+    island_end = block.end[stops - 1]
+
+    # Feedrate of the travel that led into each island, or of the first travel in the layer
+    first_travel = block.feedrate[np.flatnonzero(travel)[0]]
+    before_island = np.maximum(starts - 1, 0)
+    travel_feedrate = np.where((starts > 0) & travel[before_island], block.feedrate[before_island], first_travel)
+
+    order = []
+    position = origin[:2]
+    left = np.ones(len(starts), bool)
+    travel_after = 0.0
+    for _ in range(len(starts)):
+        distance = np.linalg.norm(island_start[:, :2] - position, axis=1)
+        distance[~left] = np.inf
+        nearest = int(np.argmin(distance))
+        travel_after += distance[nearest]
+        order.append(nearest)
+        left[nearest] = False
+        position = island_end[nearest, :2]
+    travel_after += np.linalg.norm(destination[:2] - position)
+    if travel_after >= travel_before:
+        return None
+
+    # Build the new layer, with E counted up again in the new order
+    start, end, feedrate, row = [], [], [], []
+    position = origin.copy()
+    e = origin[3]
+
+    def add(segment_start, segment_end, segment_feedrate, segment_row):
+        start.append(segment_start)
+        end.append(segment_end)
+        feedrate.append(segment_feedrate)
+        row.append(segment_row)
+
+    for i in order:
+        target = np.append(island_start[i, :3], e)
+        if np.any(target[:2] != position[:2]):
+            add(position, target, travel_feedrate[i], block.row[starts[i]])
+        island = slice(starts[i], stops[i])
+        de = np.cumsum(block.end[island, 3] - block.start[island, 3])
+        segment_start = block.start[island].copy()
+        segment_end = block.end[island].copy()
+        segment_start[:, 3] = e + np.concatenate(([0], de[:-1]))
+        segment_end[:, 3] = e + de
+        for j in range(len(de)):
+            add(segment_start[j], segment_end[j], block.feedrate[starts[i] + j], block.row[starts[i] + j])
+        e = segment_end[-1, 3]
+        position = segment_end[-1]
+    if np.any(destination[:2] != position[:2]):
+        add(position, np.append(destination[:3], e), first_travel, block.row[-1])
+
+    count = len(row)
+    return Segments(np.array(start), np.array(end), np.array(feedrate), np.array(row),
+                    np.zeros(count), np.ones(count, bool))
+
+
+# ---------------------
+# THE WHOLE JOB
+# ---------------------
+
+def job_segments(job, states):
+    """
+    The moves of a parsed job that go anywhere, as Segments.
+
+    Returns:
+        tuple: (Segments, rows of the commands that are kept)
+    """
+    before = states.before()
+    kept = np.isin(job.command, _KEPT_COMMANDS)
+    rows = np.flatnonzero(job.is_move())
+
+    # Arcs become the chords they would be sent as, in line order with the straight moves
+    chord_start, chord_end, chord_row = arcs.job_chords(job, states)
+    order = np.argsort(np.concatenate((rows, chord_row)), kind='stable')
+    start = np.concatenate((before[rows], chord_start))[order]
+    end = np.concatenate((states.position[rows], chord_end))[order]
+    rows = np.concatenate((rows, chord_row))[order]
+    # A move that goes nowhere from the assumed start still goes somewhere on a board that was not reset
+    known = _known(job, states)
+    known_before = np.where((rows > 0)[:, None], known[np.maximum(rows - 1, 0)], False)
+    moving = (end != start).any(axis=1) | (job.given()[rows, :4] & ~known_before).any(axis=1)
+    start, end, rows = start[moving], end[moving], rows[moving]
+
+    # Segments are joined when no kept command lies between them
+    kept_so_far = np.cumsum(kept)
+    joined = np.zeros(len(rows), bool)
+    joined[:-1] = kept_so_far[rows[1:]] == kept_so_far[rows[:-1]]
+
+    segments = Segments(start, end, states.feedrate[rows], rows, np.zeros(len(rows)), joined)
+    return segments, np.flatnonzero(kept)
+
+
+def _known(job, states):
+    """
+    bool (lines, 4): X, Y, Z, E after each line are where the job put them (an
+    absolute move, G92 or G28 gave them), not counted from the assumed start
+    """
+    given = job.given()[:, :4]
+    move = job.is_move() | job.is_arc()
+    set_position = job.is_command('G92')
+    absolute = np.column_stack([states.absolute_positioning] * 3 + [states.absolute_extrusion])
+    is_set = (move[:, None] & given & absolute) | (set_position[:, None] & given)
+    is_set |= (set_position & ~given.any(axis=1))[:, None]  # A bare G92 sets them all
+    is_set[:, :3] |= job.is_command('G28')[:, None]
+    return np.logical_or.accumulate(is_set, axis=0)
+
+
+def travel_length(segments):
+    return segments.lengths()[~segments.extruding()].sum()
+
+
+def optimize(job, states, tolerance=DEFAULT_TOLERANCE, reorder=True, stats=None):
+    """
+    Optimize a parsed job (see jobarrays.load / jobarrays.replay).
+
+    Returns:
+        Generator yielding the lines of the optimized job
+    """
+    if stats is None:
+        stats = OptimizerStats()
+    segments, commands = job_segments(job, states)
+    stats.moves_in = len(segments)
+    stats.travel_before = travel_length(segments)
+
+    merged = merge_collinear(segments, tolerance)
+    stats.segments_merged = len(segments) - len(merged)
+    parts = reorder_islands(merged, stats) if reorder and len(merged) else [merged]
+    stats.moves_out = sum(len(part) for part in parts)
+    stats.travel_after = sum(travel_length(part) for part in parts)
+    return _write(job, states, parts, commands)
+
+
+def _write(job, states, parts, commands):
+    """The G-code for the optimized segments, with the kept commands where they were"""
+    yield 'G90'
+    yield 'M82'
+    # Nothing is assumed about where the job starts (the board may not have been reset): an axis is
+    # written the first time the job puts it somewhere, and left out while it is only assumed to be there
+    last = [None, None, None, None]
+    assumed = [format_number(value, PRECISION) for value in states.start.coord]
+    known = _known(job, states)
+    last_feedrate = None
+    command_names = jobarrays.FIRMWARE_COMMANDS
+    next_command = 0
+
+    for part in parts:
+        extruding = part.extruding()
+        for i in range(len(part)):
+            row = part.row[i]
+            while next_command < len(commands) and commands[next_command] < row:
+                line, last = _command(job, states, commands[next_command], command_names, last)
+                yield line
+                next_command += 1
+            words = []
+            for axis, code in enumerate(jobarrays.AXES):
+                value = format_number(part.end[i, axis], PRECISION)
+                if value != last[axis] and (known[row, axis] or value != assumed[axis]):
+                    words.append(code + value)
+                    last[axis] = value
+            feedrate = format_number(part.feedrate[i], PRECISION)
+            if feedrate != last_feedrate:
+                words.append('F' + feedrate)
+                last_feedrate = feedrate
+            if words:
+                yield ('G1 ' if extruding[i] else 'G0 ') + ' '.join(words)
+
+    for row in commands[next_command:]:
+        line, last = _command(job, states, row, command_names, last)
+        yield line
+
+
+def _command(job, states, row, command_names, last):
+    """The line for a kept command, and what the position is written as after it"""
+    name = command_names[job.command[row]]
+    if name == 'G92':
+        # Only the axes it gives, the others are wherever they are (a bare G92 sets them all to 0)
+        given = ~np.isnan(job.words[row, :len(jobarrays.AXES)])
+        position = [format_number(value, PRECISION) for value in states.position[row]]
+        last = [value if given[axis] or not given.any() else last[axis] for axis, value in enumerate(position)]
+        return ' '.join(['G92'] + [code + position[axis] for axis, code in enumerate(jobarrays.AXES) if given[axis]]), last
+    if name == 'G28':
+        last = ['0', '0', '0', last[3]]
+    return name, last
+
+
+def output_path(path):
+    base, ext = os.path.splitext(path)
+    return base + OUTPUT_SUFFIX + ext
+
+
+def optimize_file(path, out_path=None, tolerance=DEFAULT_TOLERANCE, reorder=True):
+    """
+    Write an optimized copy of a G-code file.
+
+    Returns:
+        tuple: (path written, OptimizerStats)
+    """
+    out_path = out_path or output_path(path)
+    job = jobarrays.load(path)
+    states = jobarrays.replay(job)
+    stats = OptimizerStats()
+    with open(out_path, 'w') as f:
+        for line in optimize(job, states, tolerance, reorder, stats):
+            f.write(line + '\n')
+    return out_path, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge collinear moves and shorten travel in a G-code file")
+    parser.add_argument('job', help="G-code file to optimize")
+    parser.add_argument('-o', '--output', help=f"where to write it (default: <job>{OUTPUT_SUFFIX}.<ext>)")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="mm a merged segment may stray from the original path")
+    parser.add_argument('--no-reorder', action='store_true', help="keep the islands in their original order")
+    args = parser.parse_args()
+
+    out_path, stats = optimize_file(args.job, args.output, args.tolerance, not args.no_reorder)
+    print(stats.summary())
+    print(f"Written to {out_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+from arcs import ARC_TOLERANCE, arc_command, expand
+from gcode import (AXES, MAX_FEEDRATE, MIN_FEEDRATE, MOVE_COMMANDS, MachineState, clean, command_of,
+                   format_number, move_words, parse_set_position, to_float)
+
+# ---------------------
+# G-CODE PREPROCESSING
+# Every stage is a generator that takes lines and yields exactly one line
+# per input line, or '' for a line that does not need to be sent. Keeping
+# the lines in step with the file means line numbers and progress stay
+# right, and nothing is read before it is needed. The one exception is
+# expand_arcs: a G2/G3 line becomes its G1 chords, one per line of the
+# text yielded for it ('\n' between them), and the stages after it work on
+# each of those:
+#
+#     stats = PipelineStats()
+#     for line in preprocess(open('job.gcode'), stats=stats):
+#         ...
+#     print(stats.summary())
+# ---------------------
+
+DEFAULT_PRECISION = 3  # Decimals kept (the steppers move in 1/200 mm steps)
+
+
+class PipelineStats:
+    """Lines and bytes that would have been sent before and after preprocessing"""
+
+    def __init__(self):
+        self.lines_in = 0
+        self.bytes_in = 0
+        self.lines_out = 0
+        self.bytes_out = 0
+
+    def summary(self):
+        saved = (1 - self.bytes_out / self.bytes_in) * 100 if self.bytes_in else 0
+        return (f"Preprocessing: {self.lines_in} -> {self.lines_out} lines, "
+                f"{self.bytes_in} -> {self.bytes_out} bytes ({saved:.1f}% fewer bytes)")
+
+
+def count_input(lines, stats, source=None):
+    """
+    Count what the plain sender would have sent (every non-blank, non-comment
+    line), from `source` if given: the lines of the file `lines` were
+    regenerated from, read along in step
+    """
+    source = iter(source) if source is not None else None
+    for line in lines:
+        sent = (next(source, '') if source is not None else line).strip()
+        if sent and not sent.startswith(';'):
+            stats.lines_in += 1
+            stats.bytes_in += len(sent) + 1
+        yield line
+
+
+def count_output(lines, stats):
+    """Count what is actually sent"""
+    for line in lines:
+        if line:
+            stats.lines_out += line.count('\n') + 1
+            stats.bytes_out += len(line) + 1
+        yield line
+
+
+def strip_comments(lines):
+    """Drop comments, blank lines and extra spaces, and upper-case the rest"""
+    for line in lines:
+        yield ' '.join(clean(line).split())
+
+
+def shorten_numbers(lines, precision=DEFAULT_PRECISION):
+    """Round the words of G0/G1 moves to `precision` decimals and write them as short as possible"""
+    for line in lines:
+        if command_of(line) in MOVE_COMMANDS:
+            words = move_words(line)
+            line = ' '.join([line[:2]] + [code + format_number(to_float(word[1:]), precision)
+                                          for code, word in words.items()])
+        yield line
+
+
+def expand_arcs(lines, tolerance=ARC_TOLERANCE, precision=DEFAULT_PRECISION, start=None):
+    """
+    Replace G2/G3 arcs, which the firmware does not know, with G1 chords
+    that stay within `tolerance` mm of them (see arcs.py). Everything else
+    goes through unchanged; the state the firmware will be in is followed
+    along to know where each arc starts.
+
+    Args:
+        start (MachineState): The firmware's state before the first line (default: just booted)
+    """
+    state = MachineState.from_dict(start.to_dict()) if start is not None else MachineState()
+    for line in lines:
+        gcode = clean(line)
+        if arc_command(gcode) is None:
+            state.apply(gcode)
+            yield line
+            continue
+        chords = expand(gcode, state, tolerance, precision)
+        for chord in chords:
+            state.apply(chord)
+        yield '\n'.join(chords)
+
+
+def elide_modal(lines):
+    """
+    Drop everything that would not change the firmware's state: commands it
+    ignores, G90/G91/M82/M83 that are already in effect, unchanged F words,
+    axis words for where the axis already is, zero relative moves, and
+    moves that have nothing left.
+
+    Nothing is assumed about the state the job starts in, so the first
+    occurrence of each mode, feedrate and position is always sent.
+    """
+    absolute_positioning = None  # None = not known yet
+    absolute_extrusion = None
+    feedrate = None
+    coord = [None, None, None, None]  # X, Y, Z, E, None where not known exactly
+
+    def elide(line):
+        nonlocal absolute_positioning, absolute_extrusion, feedrate
+        command = command_of(line) if line else None
+        if command is None:
+            return ''
+
+        if command in ('G90', 'G91'):
+            mode = command == 'G90'
+            if absolute_positioning == mode:
+                line = ''
+            absolute_positioning = mode
+        elif command in ('M82', 'M83'):
+            mode = command == 'M82'
+            if absolute_extrusion == mode:
+                line = ''
+            absolute_extrusion = mode
+        elif command == 'G92':
+            for code, value in parse_set_position(line).items():
+                coord[AXES.index(code)] = value
+        elif command == 'G28':
+            coord[0] = coord[1] = coord[2] = 0.0
+        elif command in MOVE_COMMANDS:
+            kept = []
+            for code, word in move_words(line).items():
+                value = to_float(word[1:])
+                if code == 'F':
+                    value = min(max(value, MIN_FEEDRATE), MAX_FEEDRATE)
+                    if value == feedrate:
+                        continue
+                    feedrate = value
+                else:
+                    axis = AXES.index(code)
+                    absolute = absolute_extrusion if code == 'E' else absolute_positioning
+                    if absolute:
+                        if coord[axis] == value:
+                            continue
+                        coord[axis] = value
+                    else:
+                        if absolute is not None and value == 0:
+                            continue
+                        # The firmware adds relative moves up in single precision floats,
+                        # so the result is not known exactly on this side
+                        coord[axis] = None
+                kept.append(word)
+            line = ' '.join([command] + kept) if kept else ''
+        return line
+
+    for line in lines:
+        yield '\n'.join(filter(None, map(elide, line.split('\n')))) if '\n' in line else elide(line)
+
+
+def preprocess(lines, precision=DEFAULT_PRECISION, stats=None, start=None, arc_tolerance=ARC_TOLERANCE,
+               source=None):
+    """
+    Run every stage over `lines`.
+
+    Args:
+        lines: Iterable of raw G-code lines (e.g. an open file)
+        precision (int): Decimals to keep in move words
+        stats (PipelineStats): Filled in with the line and byte reduction as lines go by
+        start (MachineState): The firmware's state before the first line, for expand_arcs
+            (e.g. Checkpoint.state when resuming)
+        arc_tolerance (float): mm the chords of G2/G3 arcs may stray from them
+        source: The lines of the file, one per line of `lines`, when `lines` are not
+            them (jobcache.CompiledJob.lines), so stats count the input as the file has it
+
+    Returns:
+        Generator yielding one line per input line ('' where nothing needs sending,
+        several joined by newlines for an arc)
+    """
+    if stats is None:
+        stats = PipelineStats()
+    lines = count_input(lines, stats, source)
+    lines = strip_comments(lines)
+    lines = shorten_numbers(lines, precision)
+    lines = expand_arcs(lines, arc_tolerance, precision, start)
+    lines = elide_modal(lines)
+    return count_output(lines, stats)
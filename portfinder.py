@@ -1,9 +1,100 @@
+import json
+import os
+
 import serial.tools.list_ports
+
+CACHE_PATH = os.path.expanduser('~/.ceratech_ports.json')  #Last port and baud rate of each board, by USB serial number (None: no cache)
+
+def _load_cache():
+    if CACHE_PATH is None:
+        return {'boards': {}, 'last': None}
+    try:
+        with open(CACHE_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'boards': {}, 'last': None}
+
+def _remember(boards, last=None):  #boards: (port, serial number) just found, last: serial number of the one in use
+    if not boards:
+        return
+    cache = _load_cache()
+    for port, serial_number in boards:
+        for other in [other for other, device in cache['boards'].items() if device == port]:
+            del cache['boards'][other]  #Another board was on that port before
+        cache['boards'][serial_number] = port
+    cache['last'] = last or cache['last']
+    _save(cache)
+
+def _save(cache):
+    if CACHE_PATH is None:
+        return
+    try:
+        with open(CACHE_PATH, 'w') as f:
+            json.dump(cache, f)
+    except OSError:
+        pass  #Only costs a rescan next time
+
+def board_on(port):  #USB serial number of the board on a port, None if it has none (clones, emulator ptys)
+    for p in serial.tools.list_ports.comports():
+        if p.device == port:
+            return p.serial_number or None
+    return None
+
+def saved_baudrate(board):  #Baud rate a board (see board_on) last agreed to, None if it never did
+    if board is None:
+        return None
+    return _load_cache().get('baudrates', {}).get(board)
+
+def save_baudrate(board, baudrate):  #Only boards with a serial number, a port path can have another board on it next time
+    if board is None:
+        return
+    cache = _load_cache()
+    cache.setdefault('baudrates', {})[board] = baudrate
+    _save(cache)
+
 #Find USB Port
-def find_port():  #Finds which port the arduino is plugged into
+def find_port(serial_number=None, rescan=False):  #Finds which port the arduino is plugged into
+    """
+    The port a board was last found on is used again as long as the same
+    board (by USB serial number) is still on it: after boards are swapped
+    or renumbered the path can be there with another board behind it.
+
+    Args:
+        serial_number (str): USB serial number of the board, default the one found last time
+        rescan (bool): Ignore the cache
+    """
+    cache = _load_cache()
+    wanted = serial_number or cache['last']
+    cached = cache['boards'].get(wanted)
     ports = list(serial.tools.list_ports.comports())
+    if cached and not rescan:
+        for p in ports:
+            if p.device == cached and (p.serial_number or p.device) == wanted:
+                return cached
+    found = []
     for p in ports:
         print(p)
         if '0403' in p[2]: #unique to Osepp Uno (arduino clone)                
-            return p[0]
-find_port()
\ No newline at end of file
+            found.append((p.device, p.serial_number or p.device))
+    matches = [board for board in found if board[1] == wanted]
+    if serial_number is None:
+        matches = matches or found  #The board used last time if it is still plugged in, else any
+    if matches:
+        _remember([matches[0]], last=matches[0][1])
+        return matches[0][0]
+
+def find_ports():  #Finds every board plugged in (see farm.py)
+    """
+    Returns:
+        list: (port, USB serial number) of each board, by serial number so a
+            board keeps its name whichever port it comes up on
+    """
+    boards = []
+    for p in serial.tools.list_ports.comports():
+        if '0403' in p.hwid:
+            boards.append((p.device, p.serial_number or p.device))  # Clones without a serial number go by port
+    _remember(boards)
+    return sorted(boards, key=lambda board: board[1])
+
+if __name__ == '__main__':
+    find_port()
@@ -0,0 +1,151 @@
+import numpy as np
+
+import arcs
+import jobarrays
+from gcode import MAX_COORD
+from jobfile import JobFile
+
+# ---------------------
+# PREFLIGHT CHECKS
+# Finds every line of a job the firmware would complain about before any
+# of it is sent, instead of hours into the print: moves that end outside
+# max_coord in X, Y or Z (firmware.ino makes them anyway and prints "ERROR:
+# Movement exceeds boundary limits"), and commands it does not know and
+# silently skips (M104, M140, G21... are in most slicer output, so those
+# are only warnings: a job is refused for the moves). E is not checked: it
+# is no physical limit, and with absolute extrusion (M82) an ordinary job
+# passes max_coord's E within a few layers. Arcs, which are sent as chords
+# (see arcs.py), are checked at the end of every chord. The whole file is
+# checked at once on the columns jobarrays.load / jobarrays.replay give:
+#
+#     report = validate_file('job.gcode')
+#     if not report.ok:
+#         print(report.summary())
+# ---------------------
+
+BOUNDS = 'bounds'            # X, Y or Z outside 0..max_coord after a move
+UNKNOWN_COMMAND = 'unknown'  # A line the firmware ignores (a warning)
+ERRORS = (BOUNDS,)           # Kinds a job is refused for
+
+DESCRIPTIONS = {
+    BOUNDS: "move out of bounds",
+    UNKNOWN_COMMAND: "command the firmware ignores",
+}
+
+
+class PreflightReport:
+    """
+    What the firmware would complain about in a job.
+
+    Attributes:
+        issues: {kind: int64 (n,)} 0-based lines with each kind of problem
+        positions: {kind: float64 (n, 4)} X, Y, Z, E after each of those lines, or where an arc
+            first goes out (BOUNDS)
+        lines: Lines checked
+        path: The file, to quote the lines from (None for a parsed job)
+    """
+
+    def __init__(self, issues, positions, lines, path=None):
+        self.issues = issues
+        self.positions = positions
+        self.lines = lines
+        self.path = path
+
+    @property
+    def ok(self):
+        """No line goes out of bounds (lines the firmware ignores may be left, see warnings)"""
+        return not any(len(self.issues[kind]) for kind in ERRORS)
+
+    @property
+    def warnings(self):
+        """Lines the firmware ignores"""
+        return len(self.issues[UNKNOWN_COMMAND])
+
+    def count(self, kind=None):
+        """Lines with problems of one kind, or of any kind"""
+        if kind is not None:
+            return len(self.issues[kind])
+        return len(np.unique(np.concatenate(list(self.issues.values()))))
+
+    def problems(self, limit=None):
+        """
+        The problems in line order
+
+        Yields:
+            tuple: (line, kind, message), line 0-based
+        """
+        found = sorted((int(line), kind, i) for kind, lines in self.issues.items() for i, line in enumerate(lines))
+        job = JobFile(self.path, cache_index=False) if self.path is not None else None
+        try:
+            for line, kind, i in found[:limit]:
+                if kind == UNKNOWN_COMMAND:
+                    detail = repr(job.line(line).strip()) if job is not None else ""
+                else:
+                    detail = "at X{:g} Y{:g} Z{:g} E{:g}".format(*self.positions[kind][i])
+                warning = "warning: " if kind not in ERRORS else ""
+                yield line, kind, f"{warning}{DESCRIPTIONS[kind]} {detail}".rstrip()
+        finally:
+            if job is not None:
+                job.close()
+
+    def summary(self, limit=10):
+        """The counts and the first `limit` problems, with 1-based line numbers"""
+        if not self.count():
+            return f"Preflight: {self.lines} lines, no problems found"
+        counts = ', '.join(f"{len(lines)} {DESCRIPTIONS[kind]}" for kind, lines in self.issues.items() if len(lines))
+        out = [f"Preflight: {self.count()} of {self.lines} lines have problems ({counts})"]
+        out += [f"  line {line + 1}: {message}" for line, _, message in self.problems(limit)]
+        if self.count() > limit:
+            out.append(f"  ... and {self.count() - limit} more")
+        return '\n'.join(out)
+
+
+def validate(job, states=None, path=None):
+    """
+    Check a parsed job (see jobarrays.load / jobarrays.replay).
+
+    Args:
+        path (str): The file it was parsed from, for PreflightReport.problems
+
+    Returns:
+        PreflightReport
+    """
+    states = states or jobarrays.replay(job)
+    # Where every move ends, and every chord of an arc, so arcs are checked all along
+    moves = np.flatnonzero(job.is_move())
+    _, chord_end, chord_row = arcs.job_chords(job, states)
+    row = np.concatenate((moves, chord_row))
+    order = np.argsort(row, kind='stable')
+    row, position = row[order], np.concatenate((states.position[moves], chord_end))[order]
+    bad = ((position[:, :3] < 0) | (position[:, :3] > np.asarray(MAX_COORD[:3]))).any(axis=1)
+    issues, positions = {}, {}
+    issues[BOUNDS], first = np.unique(row[bad], return_index=True)  # The first place each line goes out
+    positions[BOUNDS] = position[bad][first]
+    issues[UNKNOWN_COMMAND] = np.flatnonzero(job.command == jobarrays.UNKNOWN)
+    return PreflightReport(issues, positions, len(job), path)
+
+
+def validate_file(path):
+    """PreflightReport for a G-code file"""
+    return validate(jobarrays.load(path), path=path)
+
+
+def main():
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="List the lines of a G-code file the firmware would complain about")
+    parser.add_argument('file')
+    parser.add_argument('--limit', type=int, default=20, help="problems to list")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    report = validate_file(args.file)
+    took = time.perf_counter() - start
+    print(report.summary(args.limit))
+    print(f"Checked in {took:.2f} s")
+    return 0 if report.ok else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
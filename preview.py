@@ -0,0 +1,217 @@
+import numpy as np
+
+import arcs
+import jobarrays
+
+# ---------------------
+# TOOLPATH PREVIEW
+# The moves of a job in XY, split into layers by Z, for drawing. A layer's
+# moves are joined into polylines (extruding and travel ones apart) and
+# thinned out to what can be seen at the scale they are drawn at: points
+# closer together than the tolerance are dropped, then Douglas-Peucker
+# runs on every polyline of the layer at once. The result is cached per
+# layer, so going back to a layer is free:
+#
+#     toolpath = load('job.gcode')
+#     for xy, extruding in toolpath.layer_polylines(0, tolerance=0.1):
+#         ...  # xy: float64 (points, 2)
+#     x, y, layer = toolpath.locate(line)  # Where the nozzle is after a line of the file
+# ---------------------
+
+PIECE_SIZE = 256  # Vertices Douglas-Peucker looks at together, at most (see simplify)
+
+
+class Toolpath:
+    """
+    The moves of a job that go anywhere in XY or Z, in the order they run.
+
+    Attributes:
+        start, end: float64 (moves, 2) XY at each end
+        extruding: bool (moves,) E goes up during the move
+        row: int64 (moves,) line of the file the move is on (the chords of an arc share theirs)
+        layer: int64 (moves,) index into layer_z
+        layer_z: float64 (layers,) Z of each layer, from the bottom
+        bounds: (min_x, min_y, max_x, max_y)
+    """
+
+    def __init__(self, start, end, extruding, row, layer, layer_z):
+        self.start = start
+        self.end = end
+        self.extruding = extruding
+        self.row = row
+        self.layer = layer
+        self.layer_z = layer_z
+        if len(row):
+            corners = np.concatenate((start, end))
+            self.bounds = (*corners.min(axis=0), *corners.max(axis=0))
+        else:
+            self.bounds = (0.0, 0.0, 0.0, 0.0)
+        # Moves of layer k are _order[_layer_start[k]:_layer_start[k + 1]]
+        self._order = np.argsort(layer, kind='stable')
+        self._layer_start = np.searchsorted(layer[self._order], np.arange(len(layer_z) + 1))
+        self._cache = {}  # layer -> polylines, for _cache_tolerance
+        self._cache_tolerance = None
+
+    def __len__(self):
+        return len(self.row)
+
+    @property
+    def layers(self):
+        return len(self.layer_z)
+
+    def locate(self, line):
+        """
+        Where the nozzle is once line `line` (0-based) of the file has run
+
+        Returns:
+            tuple: (x, y, layer), or None before the first move
+        """
+        move = np.searchsorted(self.row, line, side='right') - 1
+        if move < 0:
+            return None
+        return float(self.end[move, 0]), float(self.end[move, 1]), int(self.layer[move])
+
+    def layer_polylines(self, layer, tolerance=0.0):
+        """
+        The moves of one layer as polylines, thinned out so that no point
+        of the path is further than about `tolerance` (mm) from what is kept
+
+        Returns:
+            list: (xy, extruding) for each polyline, xy float64 (points, 2)
+        """
+        if tolerance != self._cache_tolerance:
+            self._cache.clear()
+            self._cache_tolerance = tolerance
+        if layer not in self._cache:
+            self._cache[layer] = self._polylines(layer, tolerance)
+        return self._cache[layer]
+
+    def _polylines(self, layer, tolerance):
+        moves = self._order[self._layer_start[layer]:self._layer_start[layer + 1]]
+        if not len(moves):
+            return []
+        start, end, extruding = self.start[moves], self.end[moves], self.extruding[moves]
+
+        # A polyline goes on while each move starts where the last one ended and does the same thing
+        continues = np.zeros(len(moves), bool)
+        continues[1:] = (start[1:] == end[:-1]).all(axis=1) & (extruding[1:] == extruding[:-1])
+        firsts = np.flatnonzero(~continues)
+        # Vertices: the start of each polyline's first move, then the end of every move
+        points = np.insert(end, firsts, start[firsts], axis=0)
+        starts = firsts + np.arange(len(firsts))
+        kinds = extruding[firsts]
+
+        if tolerance > 0:
+            keep = _drop_close(points, starts, tolerance)
+            points, starts = points[keep], np.flatnonzero(np.isin(np.flatnonzero(keep), starts))
+            keep = simplify(points, starts, tolerance)
+            points, starts = points[keep], np.flatnonzero(np.isin(np.flatnonzero(keep), starts))
+        return list(zip(np.split(points, starts[1:]), kinds.tolist()))
+
+
+def load(path):
+    """Toolpath of a G-code file"""
+    job = jobarrays.load(path)
+    return toolpath(job, jobarrays.replay(job))
+
+
+def toolpath(job, states):
+    """
+    Toolpath of a parsed job (see jobarrays.load / jobarrays.replay).
+
+    Layers are the heights extruding moves are made at (or that any move
+    is made at, for a job that does not extrude). Every move belongs to the
+    highest layer at or below where it ends, so Z hops stay with their layer.
+    """
+    before = states.before()
+    rows = np.flatnonzero(job.is_move())
+    # Arcs as the chords they are sent as, in line order with the straight moves
+    chord_start, chord_end, chord_row = arcs.job_chords(job, states)
+    order = np.argsort(np.concatenate((rows, chord_row)), kind='stable')
+    start = np.concatenate((before[rows], chord_start))[order]
+    end = np.concatenate((states.position[rows], chord_end))[order]
+    rows = np.concatenate((rows, chord_row))[order]
+    moving = (end[:, :3] != start[:, :3]).any(axis=1)
+    start, end, rows = start[moving], end[moving], rows[moving]
+    extruding = end[:, 3] > start[:, 3]
+    z = end[:, 2]
+    layer_z = np.unique(z[extruding] if extruding.any() else z)
+    layer = np.clip(np.searchsorted(layer_z, z, side='right') - 1, 0, None)
+    return Toolpath(start[:, :2].copy(), end[:, :2].copy(), extruding, rows, layer, layer_z)
+
+
+# ---------------------
+# DECIMATION
+# Both take the vertices of many polylines back to back, `starts` being
+# the index each polyline starts at, and return which vertices to keep.
+# The first and last vertex of every polyline are always kept.
+# ---------------------
+
+def _ends(starts, n):
+    return np.append(starts[1:], n) - 1
+
+
+def _drop_close(points, starts, tolerance):
+    """Drop vertices that fall in the same tolerance-sized grid cell as the one before"""
+    cell = np.floor(points / tolerance)
+    keep = np.ones(len(points), bool)
+    keep[1:] = (cell[1:] != cell[:-1]).any(axis=1)
+    keep[starts] = True
+    keep[_ends(starts, len(points))] = True
+    return keep
+
+
+def simplify(points, starts, tolerance, piece_size=PIECE_SIZE):
+    """
+    Douglas-Peucker, for all polylines at once: every round finds the
+    vertex furthest from the chord of each open stretch and splits the
+    stretch there if it is further than `tolerance`, with the vertices of
+    all stretches in one array. Polylines are cut into pieces of
+    `piece_size` vertices first (their ends are kept), so a long polyline
+    takes a few rounds over its pieces instead of one round per split.
+
+    Returns:
+        bool (points,): vertices to keep
+    """
+    n = len(points)
+    keep = np.zeros(n, bool)
+    if not n:
+        return keep
+    ends = _ends(starts, n)
+    cuts = np.zeros(n, bool)
+    cuts[starts] = cuts[ends] = True
+    cuts[::piece_size] = True
+    keep |= cuts
+    # Stretches from each kept vertex to the next, but not from the end of one polyline to the start of another
+    kept = np.flatnonzero(cuts)
+    lo, hi = kept[:-1], kept[1:]
+    within = ~np.isin(lo, ends)
+    lo, hi = lo[within], hi[within]
+    while True:
+        open_ = hi - lo > 1
+        lo, hi = lo[open_], hi[open_]
+        if not len(lo):
+            return keep
+        # Every vertex strictly inside a stretch, with the stretch it is in
+        counts = hi - lo - 1
+        stretch = np.repeat(np.arange(len(lo)), counts)
+        first = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        inside = np.arange(len(stretch)) - first[stretch] + lo[stretch] + 1
+
+        distance = _distance_to_segment(points[inside], points[lo][stretch], points[hi][stretch])
+        furthest = np.maximum.reduceat(distance, first)
+        at_max = np.flatnonzero(distance == furthest[stretch])
+        at_max = at_max[np.flatnonzero(np.diff(stretch[at_max], prepend=-1))]  # First one in each stretch
+        split = furthest > tolerance
+        middle = inside[at_max][split]
+        keep[middle] = True
+        lo, hi = np.concatenate((lo[split], middle)), np.concatenate((middle, hi[split]))
+
+
+def _distance_to_segment(point, a, b):
+    """Distance of each point from the segment a-b (XY)"""
+    direction = b - a
+    length_squared = (direction ** 2).sum(axis=1)
+    t = ((point - a) * direction).sum(axis=1) / np.where(length_squared > 0, length_squared, 1)
+    closest = a + np.clip(t, 0, 1)[:, None] * direction
+    return np.linalg.norm(point - closest, axis=1)
@@ -0,0 +1,963 @@
+import asyncio
+import re
+import secrets
+import threading
+import time
+from collections import deque, namedtuple
+
+import serial
+
+import binproto
+import estimator
+from gcode import MAX_COORD, MachineState, clean, format_number
+from metrics import RATE_LIMITED, SendMetrics, log
+
+# ---------------------
+# ASYNC PRINTER CONNECTION
+# Everything that talks to the firmware runs on one asyncio event loop:
+# the bytes it prints are read as they arrive (loop.add_reader, or a small
+# thread for ports without a file descriptor), parsed into FirmwareEvents
+# and matched with the oldest command still waiting for its "OK", while
+# writes are held back until they fit in the Arduino's receive buffer. So
+# a job can be streamed while M114 is polled, a jog is sent or errors are
+# watched for, without threads taking turns on the port:
+#
+#     async with await PrinterConnection.open('/dev/ttyACM0') as printer:  # Waits for READY
+#         job = asyncio.create_task(printer.stream(open('Gcode.txt'), 1000))
+#         while not job.done():
+#             print(await printer.query_position())
+#             await asyncio.sleep(1)
+#
+# uploader.py runs one PrinterConnection on a background event loop and
+# keeps its blocking functions as wrappers around it. Every line written is
+# timed in printer.metrics (see metrics.py), and every line acknowledged is
+# applied to printer.state, a copy of the firmware's modal state and
+# position that can be read at any time without an M114 round trip.
+# ---------------------
+
+BAUDRATE = 115200  # Must match Serial.begin() on Arduino
+RX_BUFFER_SIZE = 64  # Size of the Arduino's serial receive buffer (bytes)
+ACK_TIMEOUT = 300  # Seconds to wait for "OK" before giving up (long moves are silent)
+MAX_RESENDS = 10  # Times a binary record is sent again before giving up
+READY_BANNER = "READY"  # Printed by setup() in firmware.ino once the board has (re)started
+PING = 'M114'  # Any line is answered with "OK", this one changes nothing
+PING_AFTER = 1.0  # Seconds to wait for the banner after a reset before pinging (the bootloader eats early bytes)
+READY_TIMEOUT = 5  # Seconds the firmware has to answer after the port is opened
+JOG_WINDOW = 0.05  # Seconds jogs are collected for and added up before they are sent as one move
+POSITION_TOLERANCE = 0.01  # mm the firmware's M114 report may differ from printer.state (it prints 2 decimals)
+BAUD_TESTS = 3  # M992 echo tests a new baud rate has to pass before it is kept
+BAUD_TEST_SIZE = 40  # Hex digits in each echo test (the line must fit in RX_BUFFER_SIZE)
+BAUD_TEST_TIMEOUT = 1.0  # Seconds an echo test may take at the new rate
+BAUD_TRIAL = 2.0  # Seconds the firmware waits for M993 before going back to the old rate (BAUD_TRIAL_MS)
+BAUD_SETTLE = 0.01  # Seconds the firmware takes to reopen its port at a new rate
+
+# ---------------------
+# FIRMWARE EVENTS
+# Every line the firmware prints is turned into a FirmwareEvent
+# ---------------------
+ACK = 'ack'            # "OK"
+ECHO = 'echo'          # The command the firmware just ran, echoed back
+ERROR = 'error'        # "ERROR: ..."
+PROGRESS = 'progress'  # "Progress: N%", value is N
+POSITION = 'position'  # M114 report, value is (x, y, z, e)
+INFO = 'info'          # Anything else ("Switched to ...", "Motors enabled ...", ...)
+NAK = 'nak'            # Binary mode only: record rejected, value is the sequence number expected next
+
+FirmwareEvent = namedtuple('FirmwareEvent', ['kind', 'text', 'value'])
+
+_PROGRESS_RE = re.compile(r'Progress: (\d+)%')
+_POSITION_RE = re.compile(r'X:(\S+) Y:(\S+) Z:(\S+) E:(\S+)')
+_ECHO_RE = re.compile(r'[GM]\d')
+
+def parse_response(text):
+    """Turn one line printed by the firmware into a FirmwareEvent"""
+    if text == "OK":
+        return FirmwareEvent(ACK, text, None)
+    if text.startswith("ERROR"):
+        return FirmwareEvent(ERROR, text, None)
+    match = _PROGRESS_RE.fullmatch(text)
+    if match:
+        return FirmwareEvent(PROGRESS, text, int(match.group(1)))
+    match = _POSITION_RE.fullmatch(text)
+    if match:
+        try:
+            return FirmwareEvent(POSITION, text, tuple(float(v) for v in match.groups()))
+        except ValueError:
+            pass
+    if not text or _ECHO_RE.match(text):
+        return FirmwareEvent(ECHO, text, None)
+    return FirmwareEvent(INFO, text, None)
+
+# Replies to binary records (see binproto.py), as the events a text reply would give
+_REPLY_EVENTS = {
+    binproto.REPLY_ACK: [FirmwareEvent(ACK, "OK", None)],
+    binproto.REPLY_BOUNDS: [FirmwareEvent(ERROR, "ERROR: Movement exceeds boundary limits. Command skipped.", None),
+                            FirmwareEvent(ACK, "OK", None)],
+}
+_REJECT_REPLIES = {binproto.REPLY_NAK: "NAK", binproto.REPLY_CAN: "CAN"}  # Followed by the expected sequence number
+
+# ---------------------
+# JOB PROGRESS AND CONTROL
+# ---------------------
+
+class JobControl:
+    """
+    Lets another thread (e.g. the GUI) pause, resume or stop a job while
+    PrinterConnection.stream is sending it.
+
+    Args:
+        on_pause: Called (on a worker thread) once the job has paused and
+            every line sent so far has been acknowledged
+        on_resume: Called (on a worker thread) just before sending continues
+    """
+
+    def __init__(self, on_pause=None, on_resume=None):
+        self.on_pause = on_pause
+        self.on_resume = on_resume
+        self.stopped = False
+        self._running = threading.Event()
+        self._running.set()
+
+    @property
+    def paused(self):
+        return not self._running.is_set()
+
+    def pause(self):
+        self._running.clear()
+
+    def resume(self):
+        self._running.set()
+
+    def stop(self):
+        self.stopped = True
+        self._running.set()  # Wake up a paused job so it can finish
+
+    def wait_while_paused(self):
+        """Block until the job is resumed or stopped, running the pause hooks around it"""
+        if self.on_pause:
+            self.on_pause()
+        self._running.wait()
+        if self.on_resume and not self.stopped:
+            self.on_resume()
+
+def percent_done(current_line, total_lines):
+    """Progress in percent, from the line count or from a function of the line count that knows better"""
+    if callable(total_lines):
+        return total_lines(current_line)
+    return (current_line / total_lines) * 100
+
+def report_progress(current_line, total_lines):
+    """Log how far the job has got, with the time left if total_lines can tell (estimator.TimeEstimate)"""
+    progress = percent_done(current_line, total_lines)
+    if hasattr(total_lines, 'remaining'):
+        remaining = estimator.format_duration(total_lines.remaining(current_line))
+        log.info("Progress: %.1f%% (%s left)", progress, remaining, extra=RATE_LIMITED)  # Show 1 decimal place
+    else:
+        log.info("Progress: %.1f%%", progress, extra=RATE_LIMITED)  # Show 1 decimal place
+    return progress
+
+# ---------------------
+# CONNECTION
+# ---------------------
+
+def open_port(port_name, baudrate=BAUDRATE, reset=True):
+    """
+    Open a serial port to the Arduino.
+
+    Args:
+        reset (bool): False opens it with DTR low, so the board is not reset and
+            keeps whatever state it is in. On Linux the very first open after
+            the board is plugged in may still reset it: the kernel raises DTR
+            before the port can be configured (wait_until_ready copes with both).
+    """
+    port = serial.Serial(baudrate=baudrate, timeout=1)
+    port.port = port_name
+    if not reset:
+        port.dtr = False  # Applied as the port is opened
+    port.open()
+    return port
+
+class _Command:
+    """A line written to the firmware (or, in binary mode, waiting to be written again) that has no "OK" yet"""
+
+    __slots__ = ('line', 'size', 'opcode', 'seq', 'tries', 'sent', 'events', 'reply', 'number', 'heard')
+
+    def __init__(self, line, size, reply, opcode=None):
+        self.line = line
+        self.size = size  # Bytes it takes up in the receive buffer
+        self.opcode = opcode  # Binary record without a G-code line (binproto.OP_TEXT_MODE)
+        self.seq = None  # Sequence number of its binary record
+        self.tries = 0  # Times the binary record was written
+        self.sent = False  # On the wire and not rejected
+        self.events = []  # Everything the firmware printed for it so far
+        self.reply = reply  # Future, set to the events once it is acknowledged
+        self.number = None  # Its number in PrinterConnection.metrics
+        self.heard = False  # The firmware has started to answer it
+
+class PrinterConnection:
+    """
+    Connection to the firmware on an open serial port.
+
+    Each command written is answered by the firmware with "OK" (or, in
+    binary mode, a one-byte reply), in order, so the oldest command still
+    in flight collects everything printed up to its "OK". Commands from
+    send(), query_position() and stream() share the receive buffer: a
+    write waits until the bytes in flight plus its own fit in
+    rx_buffer_size. Every event is also handed to each events() iterator.
+
+    Args:
+        port: Open serial.Serial, or anything with read(), write() and
+            in_waiting (e.g. benchmark.py's recording wrapper)
+        binary_mode (bool): The firmware was already switched to binary on this port
+        record_seq (int): Sequence number of the next binary record, if it was
+        verbose (bool): Log what is sent and received (DEBUG), progress and firmware errors
+        metrics (SendMetrics): Where the timings of every line go (default a new one)
+        state (gcode.MachineState): The firmware's state, if known (default: just booted)
+
+    Attributes:
+        state (gcode.MachineState): The firmware's state after the last command
+            it acknowledged. Out of bounds moves count too, the firmware makes
+            them anyway and only reports them.
+        drift: mm the last M114 report was off from `state` (None before the first one).
+            `state` takes the reported position if that is more than POSITION_TOLERANCE.
+    """
+
+    QUEUE_SIZE = 1000  # Events kept for each events() iterator that falls behind
+
+    def __init__(self, port, baudrate=BAUDRATE, rx_buffer_size=RX_BUFFER_SIZE, ack_timeout=ACK_TIMEOUT,
+                 max_resends=MAX_RESENDS, binary_mode=False, record_seq=0, verbose=True, metrics=None,
+                 state=None):
+        self.port = port
+        self.baudrate = baudrate
+        self.rx_buffer_size = rx_buffer_size
+        self.ack_timeout = ack_timeout
+        self.max_resends = max_resends
+        self.verbose = verbose
+        self.metrics = SendMetrics() if metrics is None else metrics
+        self.state = state or MachineState()
+        self.drift = None
+        self._job = None  # JobControl of the job stream() is sending (True if it has none)
+        self._jog = None  # [[dx, dy, dz], future] of the jog being collected
+        self._jog_target = None  # XYZ the jogs sent or collected end at, None while there are none
+        self._jogs_pending = 0  # jog() calls that have not returned yet
+        self.binary_mode = binary_mode  # Sending binproto records instead of G-code text
+        self.record_seq = record_seq  # Sequence number of the next binary record
+        self.resent = 0  # Binary records sent again after the firmware rejected them
+        self._in_flight = deque()  # _Command, oldest first
+        self._buffered = 0  # Sum of their sizes
+        self._listeners = []  # asyncio.Queue of each events() iterator
+        self._line = bytearray()
+        self._rejected = None  # Reply byte waiting for its sequence number
+        self._going_back = None  # Sequence number to resend from once the firmware is quiet
+        self._quiet_timer = None
+        self._quiet_for = 0.0
+        self._loop = None
+        self._reader_fd = None
+        self._reader_thread = None
+        self._reading = False
+        self._room = None  # asyncio.Event, set whenever a command is answered
+        self._lost = None  # Exception that ended the connection
+
+    @classmethod
+    async def open(cls, port_name, baudrate=BAUDRATE, reset=True, **kwargs):
+        """
+        Open a serial port, start reading from it and wait until the firmware is ready
+
+        Args:
+            reset (bool): Let opening the port reset the Arduino (DTR), like the
+                Arduino IDE. False keeps a running board running (see open_port).
+        """
+        loop = asyncio.get_running_loop()
+        port = await loop.run_in_executor(None, open_port, port_name, baudrate, reset)
+        connection = cls(port, baudrate=baudrate, **kwargs)
+        await connection.start()
+        try:
+            await connection.wait_until_ready(PING_AFTER if reset else 0)
+        except Exception:
+            await connection.stop()
+            port.close()
+            raise
+        return connection
+
+    async def wait_until_ready(self, ping_after=PING_AFTER, timeout=READY_TIMEOUT):
+        """
+        Wait for the firmware to show it is running: the READY_BANNER setup()
+        prints, or the reply to a PING sent if the banner has not come within
+        `ping_after` seconds (0 pings straight away, for a board that was not reset).
+
+        Returns:
+            float: Seconds it took
+
+        Raises:
+            TimeoutError: If the firmware says nothing within `timeout` seconds
+        """
+        start = self._loop.time()
+
+        async def banner():
+            async for event in self.events():
+                if event.kind == INFO and event.text == READY_BANNER:
+                    return
+
+        waiting = [asyncio.ensure_future(banner())]
+        try:
+            done, _ = await asyncio.wait(waiting, timeout=ping_after)
+            if not done:
+                waiting.append(asyncio.ensure_future(self.send(PING, timeout)))
+            while not any(task.done() and task.exception() is None for task in waiting):
+                if self._lost is not None:
+                    raise self._lost
+                # A ping lost to a reset fails once the banner comes, keep waiting for the banner
+                pending = [task for task in waiting if not task.done()]
+                left = start + timeout - self._loop.time()
+                if not pending or left <= 0 or not (await asyncio.wait(pending, timeout=left,
+                                                                       return_when=asyncio.FIRST_COMPLETED))[0]:
+                    raise TimeoutError(f"No response from Arduino within {timeout} s of opening the port")
+        finally:
+            for task in waiting:
+                task.cancel()
+        return self._loop.time() - start
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    # ---------------------
+    # READING
+    # ---------------------
+
+    async def start(self):
+        """Start reading from the port on the running event loop"""
+        self._loop = asyncio.get_running_loop()
+        self._room = asyncio.Event()
+        self._lost = None
+        self._reading = True
+        try:
+            fd = self.port.fileno()
+            self._loop.add_reader(fd, self._on_readable)
+            self._reader_fd = fd
+        except (AttributeError, NotImplementedError, ValueError, OSError):
+            # No file descriptor to watch (Windows, a stand-in port): read on a thread
+            self._reader_thread = threading.Thread(target=self._read_forever, daemon=True)
+            self._reader_thread.start()
+
+    async def stop(self):
+        """Stop reading, without closing the port"""
+        self._reading = False
+        if self._reader_fd is not None:
+            self._loop.remove_reader(self._reader_fd)
+            self._reader_fd = None
+        if self._reader_thread is not None:
+            if hasattr(self.port, 'cancel_read'):
+                self.port.cancel_read()  # Wake up the blocking read()
+            await self._loop.run_in_executor(None, self._reader_thread.join)
+            self._reader_thread = None
+        self._connection_lost(IOError("Connection to Arduino closed"))
+
+    async def close(self):
+        """Switch the firmware back to text mode if needed, stop reading and close the port"""
+        if self.binary_mode and self._lost is None:
+            try:
+                await self.disable_binary_mode()
+            except Exception as e:
+                log.warning("Could not switch the Arduino back to text mode: %s", e)
+        await self.stop()
+        self.port.close()
+
+    def _on_readable(self):
+        try:
+            data = self.port.read(self.port.in_waiting or 1)
+        except Exception as e:
+            self._loop.remove_reader(self._reader_fd)
+            self._reader_fd = None
+            self._connection_lost(IOError(f"Connection to Arduino lost: {e}"))
+            return
+        self._received(data)
+
+    def _read_forever(self):
+        """Blocking reads on the reader thread, handed over to the event loop"""
+        while self._reading:
+            try:
+                data = self.port.read(1)  # Blocks for up to the port timeout
+                if data and self.port.in_waiting:
+                    data += self.port.read(self.port.in_waiting)
+            except Exception as e:
+                if self._reading:
+                    self._call_soon(self._connection_lost, IOError(f"Connection to Arduino lost: {e}"))
+                return
+            if data and self._reading:
+                self._call_soon(self._received, data)
+
+    def _call_soon(self, callback, *args):
+        try:
+            self._loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            self._reading = False  # The event loop is gone
+
+    def _received(self, data):
+        for byte in data:
+            if self._rejected is not None:
+                self._dispatch(FirmwareEvent(NAK, _REJECT_REPLIES[self._rejected], byte))
+                self._rejected = None
+            elif byte in _REJECT_REPLIES:
+                self._rejected = byte
+            elif byte in _REPLY_EVENTS:
+                for event in _REPLY_EVENTS[byte]:
+                    self._dispatch(event)
+            elif byte == 0x0A:  # '\n'
+                self._dispatch(parse_response(self._line.decode(errors='replace').strip()))
+                self._line.clear()
+            else:
+                self._line.append(byte)
+
+    def _dispatch(self, event):
+        if self.verbose:
+            if event.kind == ERROR:
+                log.warning("<< Arduino: %s", event.text, extra=RATE_LIMITED)
+            else:
+                log.debug("<< Arduino: %s", event.text, extra=RATE_LIMITED)
+        if event.kind == ERROR:
+            self.metrics.add('errors')
+        for queue in self._listeners:
+            if queue.full():
+                queue.get_nowait()  # Only the newest events are kept
+            queue.put_nowait(event)
+
+        if event.kind == INFO and event.text == READY_BANNER:
+            self.metrics.add('resets')
+            self._fail_in_flight(IOError("Arduino was reset"))  # Everything it had not answered is gone
+            self.binary_mode = False
+            self.state = MachineState()
+            return
+        if event.kind == POSITION:
+            self._check_position(event.value)
+        if self._going_back is not None:
+            # Let the firmware answer whatever else is still on the wire before going back
+            self._quiet_timer.cancel()
+            self._quiet_timer = self._loop.call_later(self._quiet_for, self._go_back)
+            return
+        if event.kind == NAK:
+            self.metrics.add('naks')
+            self._rejected_from(event.value)
+            return
+
+        if not self._in_flight or not self._in_flight[0].sent:
+            return  # Nobody is waiting for an answer
+        command = self._in_flight[0]
+        if not command.heard:  # The first line of its reply (or a binary reply byte)
+            command.heard = True
+            self.metrics.first_byte(command.number)
+        command.events.append(event)
+        if event.kind == ACK:
+            self._answered()
+
+    def _answered(self):
+        """The oldest command in flight is done"""
+        command = self._in_flight.popleft()
+        self._buffered -= command.size
+        self.metrics.acked(command.number)
+        if command.line is not None:
+            self.state.apply(clean(command.line))
+        if not command.reply.done():
+            command.reply.set_result(command.events)
+        self._room.set()
+
+    def _check_position(self, reported):
+        """
+        Compare an M114 report with `state`. Every command before the M114 has
+        been acknowledged by now, so they should agree up to the 2 decimals printed.
+        """
+        self.drift = max(abs(a - b) for a, b in zip(reported, self.state.coord))
+        if self.drift > POSITION_TOLERANCE:
+            log.warning("Position is %.3f mm off from what was sent, using the firmware's", self.drift)
+            self.state.coord = list(reported)
+
+    def _connection_lost(self, error):
+        if self._lost is not None:
+            return
+        self._lost = error
+        self._reading = False
+        self._fail_in_flight(error)
+        for queue in self._listeners:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(None)  # Ends the iterator
+
+    def _fail_in_flight(self, error):
+        """Give up on every command the firmware has not answered"""
+        if self._quiet_timer is not None:
+            self._quiet_timer.cancel()
+            self._quiet_timer = None
+        self._going_back = None
+        self._rejected = None
+        while self._in_flight:
+            command = self._in_flight.popleft()
+            if not command.reply.done():
+                command.reply.set_exception(error)
+                command.reply.exception()  # Nobody may be waiting for it (a ping)
+        self._buffered = 0
+        self._room.set()
+
+    async def events(self):
+        """
+        Every FirmwareEvent from now on, until the connection is closed:
+
+            async for event in printer.events():
+                if event.kind == ERROR: ...
+        """
+        queue = asyncio.Queue(self.QUEUE_SIZE)
+        self._listeners.append(queue)
+        try:
+            while self._lost is None or not queue.empty():
+                event = await queue.get()
+                if event is None:
+                    return
+                yield event
+        finally:
+            self._listeners.remove(queue)
+
+    # ---------------------
+    # WRITING
+    # ---------------------
+
+    def _command(self, line):
+        """A _Command for `line`, or None if there is nothing to send"""
+        reply = self._loop.create_future()
+        if self.binary_mode:
+            if binproto.encode(line, 0) is None:  # Blank, comment or a command the firmware ignores
+                return None
+            return _Command(line, binproto.RECORD_SIZE, reply)
+        line = line.strip()
+        if not line or line.startswith(';'):  # Skip comments and blanks
+            return None
+        return _Command(line, len((line + '\n').encode()), reply)
+
+    async def _submit(self, *commands, line_number=0):
+        """
+        Write commands as soon as they fit in the receive buffer behind the
+        ones in flight, all of them in one write
+        """
+        size = sum(command.size for command in commands)
+        while self._lost is None and self._in_flight and self._buffered + size > self.rx_buffer_size:
+            self._room.clear()
+            await self._room.wait()
+        if self._lost is not None:
+            raise self._lost
+        for command in commands:
+            self._in_flight.append(command)
+            self._buffered += command.size
+            command.number = self.metrics.wrote(line_number, command.size, len(self._in_flight))
+        if self.binary_mode:
+            for command in commands:
+                command.seq = self.record_seq % 256
+                self.record_seq += 1
+            self._pump()
+        else:
+            self._write(b''.join((command.line + '\n').encode() for command in commands))
+            for command in commands:
+                command.sent = True
+
+    def _write(self, data):
+        try:
+            self.port.write(data)
+        except Exception as e:
+            self._connection_lost(IOError(f"Connection to Arduino lost: {e}"))
+
+    def _pump(self):
+        """Write the binary records waiting to be (re)sent, in one write"""
+        if self._going_back is not None:
+            return
+        records = []
+        for command in list(self._in_flight):
+            if command.sent:
+                continue
+            if command.tries > self.max_resends:
+                self._connection_lost(IOError("Arduino keeps rejecting binary records"))
+                return
+            if command.tries:
+                self.resent += 1
+                self.metrics.add('resent')
+            command.tries += 1
+            command.sent = True
+            if command.opcode is not None:
+                records.append(binproto.pack(command.opcode, command.seq))
+            else:
+                records.append(binproto.encode(command.line, command.seq))
+        if records:
+            self._write(b''.join(records))
+
+    def _rejected_from(self, expected):
+        """The firmware rejected a record (NAK or CAN) and wants `expected` next: go back N"""
+        # Everything before the record the firmware expects has run
+        while self._in_flight and 0 < (expected - self._in_flight[0].seq) % 256 <= 128:
+            self._answered()
+        sent = sum(command.sent for command in self._in_flight)
+        for command in self._in_flight:
+            command.sent = False
+            command.events.clear()
+        self._going_back = expected
+        self._quiet_for = 0.05 + sent * binproto.RECORD_SIZE * 10 / self.baudrate
+        self._quiet_timer = self._loop.call_later(self._quiet_for, self._go_back)
+
+    def _go_back(self):
+        expected = self._going_back
+        self._going_back = None
+        self._quiet_timer = None
+        if self._in_flight and self._in_flight[0].seq != expected:
+            # Out of step with the firmware (an earlier job was cut short), renumber
+            for i, command in enumerate(self._in_flight):
+                command.seq = (expected + i) % 256
+            self.record_seq = expected + len(self._in_flight)
+        self._pump()
+
+    async def _reply(self, command, timeout=None):
+        """Wait for the firmware to answer a command, returns what it printed for it"""
+        timeout = self.ack_timeout if timeout is None else timeout
+        try:
+            return await asyncio.wait_for(asyncio.shield(command.reply), timeout)
+        except asyncio.TimeoutError:
+            self.metrics.add('timeouts')
+            raise TimeoutError(f"No response from Arduino within {timeout} s") from None
+
+    async def send(self, line, timeout=None):
+        """
+        Send one line of G-code and wait for the firmware to answer it
+
+        Returns:
+            list: The FirmwareEvents it printed for the line, ending with its ACK, or
+                None if the line is blank, a comment or (in binary mode) a command the firmware ignores
+
+        Raises:
+            TimeoutError: If there is no "OK" within `timeout` seconds (default ack_timeout)
+            IOError: If the connection is lost
+        """
+        command = self._command(line)
+        if command is None:
+            return None
+        if self.verbose:
+            log.debug(">> Sending: %s", command.line, extra=RATE_LIMITED)
+        await self._submit(command)
+        return await self._reply(command, timeout)
+
+    async def query_position(self):
+        """
+        Ask the firmware where it is (M114). `state` already knows without
+        waiting for the firmware, this is to check it (see drift).
+
+        Returns:
+            tuple: (x, y, z, e), or None if the firmware did not say
+        """
+        for event in await self.send('M114') or []:
+            if event.kind == POSITION:
+                return event.value
+        return None
+
+    async def jog(self, dx=0.0, dy=0.0, dz=0.0, feedrate=None):
+        """
+        Move X, Y and Z by an offset, while no job is being sent or the job is paused.
+
+        Jogs that come in within JOG_WINDOW of the first one are added up
+        and sent as one relative move, with the G91 and G90 around it (if
+        the firmware is in G90) in the same write, so a burst of clicks costs
+        one round trip. Jogs that would leave the firmware's bounds
+        (gcode.MAX_COORD) are refused here instead of being sent.
+
+        Args:
+            feedrate (float): mm/min, default whatever the firmware is using
+
+        Returns:
+            tuple: (dx, dy, dz) of the move that was sent, this jog included
+
+        Raises:
+            ValueError: If the jog would go out of bounds (nothing is sent)
+            RuntimeError: If a job is being sent and is not paused
+        """
+        if self._job is True or (self._job is not None and not self._job.paused):
+            raise RuntimeError("A job is being sent, pause it to jog")
+        offset = (dx, dy, dz)
+        # Checked against where the earlier jogs were planned to end, not state.coord: that moves
+        # as soon as a jog's G1 is acknowledged, before its jog() has returned
+        start = self._jog_target if self._jog_target is not None else self.state.coord[:3]
+        target = [s + d for s, d in zip(start, offset)]
+        if any(not 0 <= value <= limit for value, limit in zip(target, MAX_COORD)):
+            raise ValueError("Jog to X{:g} Y{:g} Z{:g} is out of bounds".format(*target))
+        self._jog_target = target
+        self._jogs_pending += 1
+        try:
+            return await self._collect_jog(offset, feedrate)
+        finally:
+            self._jogs_pending -= 1
+            if not self._jogs_pending:
+                self._jog_target = None  # state.coord has them all now (or the firmware's word, if one failed)
+
+    async def _collect_jog(self, offset, feedrate):
+        if self._jog is not None:  # Add it to the jog being collected
+            self._jog[0] = [a + d for a, d in zip(self._jog[0], offset)]
+            return await asyncio.shield(self._jog[1])
+
+        self._jog = jog = [list(offset), self._loop.create_future()]
+        try:
+            await asyncio.sleep(JOG_WINDOW)
+        finally:
+            self._jog = None
+        total, done = jog
+        try:
+            await self._send_jog(total, feedrate)
+        except asyncio.CancelledError:
+            done.cancel()
+            raise
+        except Exception as e:
+            done.set_exception(e)
+            done.exception()  # Nobody else may be waiting for it
+            raise
+        done.set_result(tuple(total))
+        return tuple(total)
+
+    async def _send_jog(self, offset, feedrate):
+        words = ' '.join(code + format_number(value) for code, value in zip('XYZ', offset) if value)
+        if not words:
+            return
+        if feedrate is not None:
+            words += ' F' + format_number(feedrate)
+        lines = ['G1 ' + words]
+        if self.state.absolute_positioning:
+            lines = ['G91'] + lines + ['G90']
+        commands = [self._command(line) for line in lines]
+        if self.verbose:
+            log.debug(">> Jogging: %s", ' | '.join(lines))
+        await self._submit(*commands)
+        for command in commands:
+            await self._reply(command)
+
+    async def stream(self, lines, total_lines=1, on_progress=None, control=None, on_ack=None, window=None):
+        """
+        Send lines without waiting for an "OK" after each one.
+
+        The firmware only reads the next line once it has room for it in its
+        block queue, so anything written in the meantime waits in the
+        Arduino's serial receive buffer. Lines are written as long as the
+        next one still fits behind the bytes in flight (every "OK" frees the
+        oldest line), so the link and the firmware are never left waiting
+        on a round trip, and the buffer can never overflow. In binary mode
+        each line is a binproto record, and when the firmware rejects one
+        everything it has not run yet is sent again from the record it asks
+        for (go-back-N).
+
+        Args:
+            lines: Iterable of G-code lines. A line may hold several commands separated
+                by '\\n' (an arc cut into chords, see pipeline.expand_arcs); they are sent
+                one by one but count as one line.
+            total_lines: Number of lines, for progress reporting, or a function that
+                returns the percentage done after a number of lines (e.g. estimator.TimeEstimate)
+            on_progress: Optional callback(current_line, percent, line) after each command is sent
+            control (JobControl): Optional handle to pause or stop the job from another thread.
+                Pausing or stopping lets the lines already in flight finish first.
+            on_ack: Optional callback(current_line, line) once the Arduino has acknowledged a line
+                (e.g. Checkpoint.acknowledged), called for each of its commands once all
+                of them have been acknowledged
+            window (int): Bytes of this job allowed in flight (default rx_buffer_size,
+                0 waits for the "OK" of every line before writing the next)
+
+        Returns:
+            dict: Line/byte counts and elapsed time (see uploader.print_throughput),
+                plus the records resent in binary mode
+        """
+        window = self.rx_buffer_size if window is None else window
+        self._job = control or True
+        try:
+            return await self._stream(lines, total_lines, on_progress, control, on_ack, window)
+        finally:
+            self._job = None
+
+    async def _stream(self, lines, total_lines, on_progress, control, on_ack, window):
+        job_start = time.time()
+        resent_before = self.resent
+        pending = deque()  # (_Command, line number, last command of the line) not acknowledged yet
+        held = []  # Commands of a line acknowledged before its last one (for on_ack)
+        buffered = 0  # Sum of their sizes
+        current_line = 0
+        lines_sent = 0
+        bytes_sent = 0
+        stopped = False
+
+        async def wait_for_oldest():
+            nonlocal buffered
+            command, number, last = pending.popleft()
+            buffered -= command.size
+            await self._reply(command)
+            if on_ack:
+                held.append(command.line)
+                if last:
+                    for line in held:
+                        on_ack(number, line)
+                    held.clear()
+
+        for line in lines:
+            if control is not None:
+                if control.paused:
+                    while pending:
+                        await wait_for_oldest()
+                    await self._loop.run_in_executor(None, control.wait_while_paused)
+                if control.stopped:
+                    stopped = True
+                    break
+
+            current_line += 1
+            commands = [command for command in map(self._command, line.split('\n')) if command is not None] \
+                if '\n' in line else [self._command(line)]
+            for i, command in enumerate(commands):
+                if command is None:
+                    continue
+
+                # Wait for room in this job's window. A line longer than the whole
+                # window is only sent once everything before it has been acknowledged.
+                while pending and buffered + command.size > window:
+                    await wait_for_oldest()
+
+                if self.verbose:
+                    log.debug(">> Sending: %s", command.line, extra=RATE_LIMITED)
+                await self._submit(command, line_number=current_line)
+                pending.append((command, current_line, i == len(commands) - 1))
+                buffered += command.size
+                lines_sent += 1
+                bytes_sent += command.size
+
+                progress = report_progress(current_line, total_lines) if self.verbose \
+                    else percent_done(current_line, total_lines)
+                if on_progress:
+                    on_progress(current_line, progress, command.line)
+
+        # Wait for the last lines to finish
+        while pending:
+            await wait_for_oldest()
+
+        stats = {'lines': lines_sent, 'bytes': bytes_sent, 'elapsed': time.time() - job_start, 'stopped': stopped}
+        if self.binary_mode:
+            stats['resent'] = self.resent - resent_before
+        return stats
+
+    # ---------------------
+    # BINARY PROTOCOL
+    # ---------------------
+
+    async def enable_binary_mode(self):
+        """
+        Ask the firmware to switch to the binary protocol (binproto.py).
+        Firmware that does not know M990 just echoes it, and the connection stays in text mode.
+        Call it while nothing else is being sent.
+
+        Returns:
+            bool: True if the firmware switched to binary
+        """
+        if self.binary_mode:
+            return True
+        events = await self.send('M990')
+        supported = any(event.kind == INFO and event.text == "BINARY" for event in events)
+        self.binary_mode = supported
+        self.record_seq = 0
+        if self.verbose:
+            log.info("Using the binary protocol." if supported
+                     else "Firmware has no binary protocol, using G-code text.")
+        return supported
+
+    async def disable_binary_mode(self):
+        """Switch the firmware back to G-code text"""
+        if not self.binary_mode:
+            return
+        command = _Command(None, binproto.RECORD_SIZE, self._loop.create_future(), opcode=binproto.OP_TEXT_MODE)
+        await self._submit(command)
+        await self._reply(command)
+        self.binary_mode = False
+
+    # ---------------------
+    # BAUD RATE
+    # The firmware starts at BAUDRATE. M991 B<rate> has it answer at the
+    # old rate and switch, then M992 lines are echoed back with their CRC
+    # (binproto.crc16) until the host is satisfied the link is clean and
+    # sends M993 to keep the rate. Firmware that hears no M993 within
+    # BAUD_TRIAL goes back to the old rate by itself, so a rate at which
+    # nothing gets through cannot strand the board.
+    # ---------------------
+
+    async def negotiate_baudrate(self, rates):
+        """
+        Switch to the first of `rates` that passes the echo tests, falling back
+        to the next one (and in the end to the rate in use) on any error.
+        Firmware that does not know M991 just echoes it, and the rate stays as it is.
+        Call it in text mode while nothing else is being sent.
+
+        Returns:
+            int: The baud rate in use now
+        """
+        for rate in rates:
+            if rate == self.baudrate:
+                break  # Already there, and anything further down the list is slower
+            switched = await self._try_baudrate(rate)
+            if switched or switched is None:  # Got there, or the firmware cannot switch at all
+                break
+        if self.verbose:
+            log.info("Talking to the Arduino at %d baud.", self.baudrate)
+        return self.baudrate
+
+    async def _try_baudrate(self, rate):
+        """
+        Switch to `rate` and test it, or go back to the old rate
+
+        Returns:
+            bool: True if the firmware is now at `rate`, False if it refused it or
+                the tests failed, None if it has no M991
+        """
+        old = self.baudrate
+        events = await self.send(f'M991 B{rate}')
+        if any(event.kind == ERROR for event in events):
+            return False
+        if not any(event.kind == INFO and event.text == f"BAUD {rate}" for event in events):
+            return None
+        self.set_baudrate(rate)
+        await asyncio.sleep(BAUD_SETTLE)
+        try:
+            for _ in range(BAUD_TESTS):
+                payload = secrets.token_hex(BAUD_TEST_SIZE // 2).upper()
+                events = await self.send(f'M992 {payload}', BAUD_TEST_TIMEOUT)
+                check = f"CHECK {binproto.crc16(payload.encode()):X}"
+                if [event.text for event in events if event.kind != ACK] != [check, f'M992 {payload}']:
+                    raise IOError(f"Echo test garbled at {rate} baud")
+            await self.send('M993', BAUD_TEST_TIMEOUT)
+            return True
+        except (IOError, TimeoutError) as e:
+            if self._lost is not None:
+                raise
+            self.metrics.add('baud_fallbacks')
+            log.warning("%s, going back to %d baud", e, old)
+            await self._fall_back(old, rate)
+            return False
+
+    async def _fall_back(self, old, new):
+        """Get back in touch at the old rate after a failed test at the new one"""
+        self.set_baudrate(old)
+        await asyncio.sleep(BAUD_TRIAL)  # The firmware goes back by itself, unless it heard M993
+        try:
+            await self.send(PING, BAUD_TEST_TIMEOUT)
+            return
+        except TimeoutError:
+            pass
+        # M993 got through but its "OK" did not: the firmware kept the new rate, ask it to go back
+        self.set_baudrate(new)
+        events = await self.send(f'M991 B{old}', BAUD_TEST_TIMEOUT)
+        if not any(event.kind == INFO and event.text == f"BAUD {old}" for event in events):
+            log.warning("Arduino cannot go back to %d baud, staying at %d", old, new)
+            return
+        self.set_baudrate(old)
+        await asyncio.sleep(BAUD_SETTLE)
+        await self.send('M993', BAUD_TEST_TIMEOUT)
+
+    def set_baudrate(self, rate):
+        """
+        Reopen our end of the link at `rate`, dropping whatever was on the way at
+        the old one. The firmware has to be at `rate` already (see negotiate_baudrate).
+        """
+        self._fail_in_flight(IOError("Baud rate changed"))
+        self._line.clear()
+        self.port.baudrate = rate
+        self.baudrate = rate
@@ -0,0 +1,681 @@
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import queue
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+from collections import deque
+
+import estimator
+import jobarrays
+import jobcache
+import pipeline
+import portfinder
+import uploader
+from checkpoint import Checkpoint
+from jobfile import JobFile
+from metrics import log
+from preflight import validate
+
+# ---------------------
+# PRINT SERVER
+# A long-running process that keeps the printer connection open (through
+# uploader.py, so the board is not reset between jobs) and takes jobs from
+# any number of clients over a Unix socket. Jobs wait in one queue, highest
+# priority first and in the order they came otherwise, and are sent one at
+# a time. Every change of a job and the progress of the one printing go out
+# to every client listening for events:
+#
+#     python printserver.py serve               # The board portfinder finds
+#     python printserver.py serve --emulate     # A virtual printer (emulator.py)
+#     python printserver.py submit job.gcode
+#     python printserver.py events              # Follow along
+#
+#     client = PrintClient()
+#     job = client.submit('job.gcode')
+#     for event in client.events():
+#         ...
+#
+# The protocol is one JSON object per line each way: {"op": "submit", "path": ...}
+# is answered by {"ok": true, ...} or {"ok": false, "error": ...}, and
+# {"op": "events"} turns the connection into a stream of events (see
+# PrintServer.publish). GUI.py sends its jobs here when a server is running.
+# ---------------------
+
+SOCKET_PATH = os.path.expanduser('~/.ceratech.sock')
+PROGRESS_INTERVAL = 0.1  # Seconds between progress events of the job printing
+EVENT_BACKLOG = 1000  # Events kept for each client that falls behind, older ones are dropped
+HISTORY = 100  # Finished jobs kept for status()
+
+# Job states
+QUEUED = 'queued'
+PRINTING = 'printing'
+PAUSED = 'paused'
+DONE = 'done'
+CANCELLED = 'cancelled'  # Taken out of the queue, or stopped while printing
+FAILED = 'failed'  # Refused by the firmware or the connection, a resubmit with resume=True carries on
+FINISHED = (DONE, CANCELLED, FAILED)
+
+
+class PrintServer:
+    """
+    The job queue and the printer connection behind the socket.
+
+    Every job is a dict (what status() and the events carry): id, path, state,
+    priority, resume, percent, remaining (seconds), line (the last
+    one sent), file_line (0-based line of the file), error, stats (see
+    uploader.print_throughput) and the submitted/started/finished times.
+
+    Args:
+        connect (bool): Connect to the printer straight away, instead of with the first job
+    """
+
+    def __init__(self, connect=True):
+        self._ids = itertools.count(1)
+        self._jobs = {}  # id -> job
+        self._queue = []  # ids of the queued jobs, in the order they will print
+        self._history = deque()  # ids of the finished jobs, oldest first
+        self._current = None  # id of the job printing
+        self._control = None  # uploader.JobControl of the job printing
+        self._changed = threading.Condition()
+        self._listeners = []  # queue.Queue of each client listening for events
+        self._publishing = threading.Lock()  # Dropping the oldest event of a full queue and adding one is one step
+        self._stopping = False
+        self._worker = threading.Thread(target=self._work, daemon=True)
+        if connect:
+            self._connect()
+        self._worker.start()
+
+    # ---------------------
+    # JOBS
+    # ---------------------
+
+    def submit(self, path, priority=0, resume=False, preflight=None):
+        """
+        Queue a G-code file, after checking it (see preflight.py)
+
+        Args:
+            priority (int): Jobs with a higher priority go before the ones queued already
+            resume (bool): Carry on from the checkpoint of an earlier run (see checkpoint.py)
+            preflight (bool): Refuse the file if a move goes out of bounds (default uploader.PREFLIGHT)
+
+        Returns:
+            dict: The job
+
+        Raises:
+            FileNotFoundError: If the file does not exist
+            ValueError: If the preflight check fails (nothing is queued)
+        """
+        path = os.path.abspath(path)
+        if uploader.PREFLIGHT if preflight is None else preflight:
+            if uploader.JOB_CACHE:
+                with jobcache.open_job(path) as compiled:
+                    parsed = compiled.arrays()
+            else:
+                parsed = jobarrays.load(path)
+            report = validate(parsed, jobarrays.replay(parsed), path)
+            if not report.ok:
+                raise ValueError(report.summary())
+            if report.warnings:
+                log.warning(report.summary())
+        elif not os.path.exists(path):
+            raise FileNotFoundError(f"No such file: '{path}'")
+
+        with self._changed:
+            job = {'id': next(self._ids), 'path': path, 'state': QUEUED, 'priority': priority, 'resume': resume,
+                   'percent': None, 'remaining': None, 'line': None, 'file_line': None, 'error': None,
+                   'stats': None, 'submitted': time.time(), 'started': None, 'finished': None}
+            self._jobs[job['id']] = job
+            # Behind every queued job with the same priority or a higher one
+            at = next((i for i, other in enumerate(self._queue) if self._jobs[other]['priority'] < priority),
+                      len(self._queue))
+            self._queue.insert(at, job['id'])
+            self._changed.notify_all()
+        self._job_changed(job)
+        return dict(job)
+
+    def cancel(self, job_id):
+        """
+        Take a job out of the queue, or stop it if it is printing (the lines
+        in flight finish first, and its checkpoint is kept)
+
+        Returns:
+            dict: The job
+
+        Raises:
+            KeyError: If there is no such job
+            ValueError: If it has finished already
+        """
+        with self._changed:
+            job = self._job(job_id)
+            if job['state'] in FINISHED:
+                raise ValueError(f"Job {job_id} has already {job['state']}")
+            if job['state'] == QUEUED:
+                self._queue.remove(job_id)
+                self._finish(job, CANCELLED)
+            else:
+                self._control.stop()
+            changed = dict(job)
+        self.publish({'event': 'job', 'job': changed})
+        return changed
+
+    def pause(self, job_id=None):
+        """
+        Pause the job printing once the lines in flight are done (the motors
+        are switched off, M18, and back on when it resumes)
+
+        Args:
+            job_id (int): Only if it is this one
+
+        Returns:
+            dict: The job
+
+        Raises:
+            RuntimeError: If no job (or not that one) is printing
+        """
+        return self._pause_or_resume(job_id, PRINTING, PAUSED)
+
+    def resume(self, job_id=None):
+        """Resume the paused job, see pause()"""
+        return self._pause_or_resume(job_id, PAUSED, PRINTING)
+
+    def _pause_or_resume(self, job_id, before, after):
+        with self._changed:
+            job = self._jobs.get(self._current)
+            if job is None or job['state'] != before or self._control.stopped:
+                raise RuntimeError(f"No job is {before}")
+            if job_id is not None and job['id'] != job_id:
+                raise RuntimeError(f"Job {job_id} is not {before}")
+            if after == PAUSED:
+                self._control.pause()
+            else:
+                self._control.resume()
+            job['state'] = after
+        self._job_changed(job)
+        return dict(job)
+
+    def jog(self, dx=0.0, dy=0.0, dz=0.0):
+        """
+        Move X, Y and Z by an offset while no job is printing or it is paused (see uploader.jog)
+
+        Returns:
+            tuple: (dx, dy, dz) of the move sent
+
+        Raises:
+            IOError: If the printer is not connected
+        """
+        if not uploader.is_connected() and not self._connect():
+            raise IOError("Printer is not connected")
+        return uploader.jog(dx, dy, dz)
+
+    def status(self):
+        """
+        Returns:
+            dict: printer (connected, position, baudrate), current (the job
+                printing or paused, or None) and jobs (every job queued, then
+                the finished ones kept, newest first)
+        """
+        with self._changed:
+            jobs = [dict(self._jobs[i]) for i in itertools.chain(self._queue, reversed(self._history))]
+            current = dict(self._jobs[self._current]) if self._current is not None else None
+        return {'printer': self._printer(), 'current': current, 'jobs': jobs}
+
+    def _job(self, job_id):
+        try:
+            return self._jobs[job_id]
+        except KeyError:
+            raise KeyError(f"No job {job_id}") from None
+
+    def _finish(self, job, state, error=None, stats=None):
+        """Move a job to the history (with self._changed held)"""
+        job.update(state=state, error=error, stats=stats, finished=time.time())
+        self._history.append(job['id'])
+        while len(self._history) > HISTORY:
+            del self._jobs[self._history.popleft()]
+
+    # ---------------------
+    # PRINTING
+    # On the worker thread, one job after another
+    # ---------------------
+
+    def _connect(self):
+        connected = uploader.is_connected() or uploader.connect_arduino()
+        self.publish(dict(self._printer(), event='printer'))
+        return connected
+
+    def _printer(self):
+        connection = uploader.connection
+        return {'connected': uploader.is_connected(), 'position': uploader.machine_position(),
+                'baudrate': connection.baudrate if connection is not None else None}
+
+    def _work(self):
+        while True:
+            with self._changed:
+                self._changed.wait_for(lambda: self._queue or self._stopping)
+                if self._stopping:
+                    return
+                job = self._jobs[self._queue.pop(0)]
+                self._current = job['id']
+                self._control = uploader.JobControl(on_pause=lambda: uploader.send_gcode('M18'),
+                                                    on_resume=lambda: uploader.send_gcode('M17'))
+                job.update(state=PRINTING, started=time.time(), percent=0.0)
+            self._job_changed(job)
+
+            state, error, stats = DONE, None, None
+            try:
+                if not uploader.is_connected() and not self._connect():
+                    raise IOError("Could not connect to the printer")
+                stats = self._print(job, self._control)
+                if stats['stopped']:
+                    state = CANCELLED
+            except Exception as e:
+                log.error("Job %d failed: %s", job['id'], e)
+                state, error = FAILED, str(e)
+                if isinstance(e, (TimeoutError, IOError)):
+                    uploader.close_connection()  # Connected again for the next job
+                    self.publish(dict(self._printer(), event='printer'))
+            with self._changed:
+                self._finish(job, state, error, stats)
+                self._current = self._control = None
+            self._job_changed(job)
+
+    def _print(self, job, control):
+        """Send one job, like uploader.start_print. Returns the sender's stats."""
+        # Compiled when it was checked
+        with JobFile(job['path']) as f, \
+                (jobcache.open_job(job['path']) if uploader.JOB_CACHE else contextlib.nullcontext()) as compiled:
+            checkpoint = (Checkpoint.load(f) if job['resume'] else None) or Checkpoint(f)
+            for gcode in checkpoint.preamble():
+                uploader.send_gcode(gcode)
+            if compiled is not None:
+                estimate = estimator.estimate(compiled.arrays()).starting_at(checkpoint.line)
+                lines = compiled.lines(checkpoint.line)
+            else:
+                estimate = estimator.estimate_file(job['path']).starting_at(checkpoint.line)
+                lines = checkpoint.lines()
+            lines = pipeline.preprocess(lines, start=checkpoint.state)
+            last_update = 0
+
+            def on_progress(current_line, percent, line):
+                nonlocal last_update
+                now = time.monotonic()
+                if now - last_update >= PROGRESS_INTERVAL:
+                    last_update = now
+                    with self._changed:
+                        job.update(percent=percent, remaining=estimate.remaining(current_line), line=line,
+                                   file_line=estimate.first_line + current_line - 1)
+                    self.publish({'event': 'progress', 'job': job['id'], 'percent': percent,
+                                   'remaining': job['remaining'], 'line': line, 'file_line': job['file_line'],
+                                   'position': uploader.machine_position()})
+
+            try:
+                stats = uploader.stream_lines(lines, estimate, on_progress, control, on_ack=checkpoint.acknowledged)
+            finally:
+                checkpoint.save()  # Kept if the job was stopped or failed, removed below if it finished
+            if not stats['stopped']:
+                checkpoint.remove()
+                with self._changed:
+                    job.update(percent=100.0, remaining=0.0)
+        uploader.print_throughput(stats)
+        return stats
+
+    def stop(self):
+        """Stop the job printing (see cancel), give up on the queue and close the connection"""
+        with self._changed:
+            self._stopping = True
+            if self._control is not None:
+                self._control.stop()
+            for job_id in self._queue:
+                self._finish(self._jobs[job_id], CANCELLED)
+            self._queue.clear()
+            self._changed.notify_all()
+        self._worker.join()
+        uploader.close_connection()
+        self._deliver(None)  # Ends every stream
+
+    # ---------------------
+    # EVENTS
+    # ---------------------
+
+    def _job_changed(self, job):
+        with self._changed:
+            changed = dict(job)
+        self.publish({'event': 'job', 'job': changed})
+
+    def publish(self, event):
+        """
+        Hand an event to every client listening. Events are dicts with an
+        'event' key: 'job' (a job was queued or changed state, 'job' holds it),
+        'progress' (job, percent, remaining, line, file_line, position) or
+        'printer' (connected, position, baudrate)
+        """
+        self._deliver(event)
+
+    def _deliver(self, event):
+        # Published from the worker thread and the handlers' at once: a slow client loses its oldest
+        # events, it never makes put_nowait raise in the middle of a job
+        with self._publishing:
+            for listener in self._listeners:
+                if listener.full():
+                    try:
+                        listener.get_nowait()  # Only the newest events are kept
+                    except queue.Empty:
+                        pass  # Its client just took one
+                listener.put_nowait(event)
+
+    def listen(self):
+        """A queue.Queue that gets every event from now on, until unlisten() (None once the server stops)"""
+        listener = queue.Queue(EVENT_BACKLOG)
+        with self._publishing:
+            self._listeners.append(listener)
+        return listener
+
+    def unlisten(self, listener):
+        with self._publishing:
+            self._listeners.remove(listener)
+
+
+# ---------------------
+# SOCKET API
+# ---------------------
+
+class _Handler(socketserver.StreamRequestHandler):
+    """One client: a request per line, answered in order (on a thread of its own)"""
+
+    def handle(self):
+        server = self.server.print_server
+        for raw in self.rfile:
+            try:
+                request = json.loads(raw)
+                op = request.pop('op')
+                if op == 'events':
+                    self._stream_events(server)
+                    return
+                reply = {'ok': True, **self._call(server, op, request)}
+            except (KeyError, ValueError, TypeError, RuntimeError, OSError) as e:
+                reply = {'ok': False, 'error': e.args[0] if isinstance(e, KeyError) and e.args else str(e)}
+            if not self._send(reply):
+                return
+
+    @staticmethod
+    def _call(server, op, request):
+        if op == 'submit':
+            return {'job': server.submit(request['path'], int(request.get('priority', 0)),
+                                         bool(request.get('resume', False)), request.get('preflight'))}
+        if op == 'cancel':
+            return {'job': server.cancel(int(request['job']))}
+        if op in ('pause', 'resume'):
+            job_id = request.get('job')
+            return {'job': getattr(server, op)(None if job_id is None else int(job_id))}
+        if op == 'jog':
+            return {'moved': server.jog(*(float(request.get(axis, 0.0)) for axis in ('dx', 'dy', 'dz')))}
+        if op == 'status':
+            return server.status()
+        raise ValueError(f"Unknown op '{op}'")
+
+    def _stream_events(self, server):
+        listener = server.listen()
+        try:
+            if self._send({'ok': True}):
+                while True:
+                    event = listener.get()
+                    if event is None or not self._send(event):
+                        return
+        finally:
+            server.unlisten(listener)
+
+    def _send(self, message):
+        """Write one line, False once the client has gone"""
+        try:
+            self.wfile.write((json.dumps(message) + '\n').encode())
+            return True
+        except OSError:
+            return False
+
+
+class _SocketServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(print_server, path=SOCKET_PATH):
+    """
+    Answer clients on a Unix socket at `path` until interrupted
+
+    Raises:
+        RuntimeError: If another server is answering there already
+    """
+    if os.path.exists(path):
+        try:
+            PrintClient(path).status()
+        except OSError:
+            os.remove(path)  # Left behind by a server that did not stop cleanly
+        else:
+            raise RuntimeError(f"A print server is already running on {path}")
+    server = _SocketServer(path, _Handler)
+    server.print_server = print_server
+    os.chmod(path, 0o600)  # Only this user prints
+    log.info("Print server listening on %s", path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
+# ---------------------
+# CLIENT
+# ---------------------
+
+class PrintClient:
+    """
+    Talks to a running PrintServer. Every call opens its own connection, so
+    a client can be used from any thread.
+
+    Raises (every method):
+        OSError: If no server is running at `path`
+        RuntimeError: With the server's message if it refused the request
+    """
+
+    def __init__(self, path=SOCKET_PATH, timeout=None):
+        self.path = path
+        self.timeout = timeout
+
+    def _open(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def request(self, op, **fields):
+        """Send one request, returns the server's reply"""
+        with self._open() as sock, sock.makefile('rwb') as f:
+            f.write((json.dumps({'op': op, **fields}) + '\n').encode())
+            f.flush()
+            line = f.readline()
+        if not line:
+            raise OSError("Print server closed the connection")
+        reply = json.loads(line)
+        if not reply.pop('ok'):
+            raise RuntimeError(reply['error'])
+        return reply
+
+    def submit(self, path, priority=0, resume=False, preflight=None):
+        """Queue a file (the path is resolved here, the server may run elsewhere). Returns the job."""
+        return self.request('submit', path=os.path.abspath(path), priority=priority, resume=resume,
+                            preflight=preflight)['job']
+
+    def cancel(self, job_id):
+        return self.request('cancel', job=job_id)['job']
+
+    def pause(self, job_id=None):
+        return self.request('pause', job=job_id)['job']
+
+    def resume(self, job_id=None):
+        return self.request('resume', job=job_id)['job']
+
+    def jog(self, dx=0.0, dy=0.0, dz=0.0):
+        return tuple(self.request('jog', dx=dx, dy=dy, dz=dz)['moved'])
+
+    def status(self):
+        return self.request('status')
+
+    def events(self):
+        """
+        Every event from the call on (see PrintServer.publish), until the server
+        stops. Listening starts before this returns, so a job submitted next
+        cannot change state unseen.
+
+        Returns:
+            _EventStream: Iterator of event dicts, to close() (or use in a with block) when done
+        """
+        sock = self._open()
+        f = sock.makefile('rwb')
+        try:
+            f.write(b'{"op": "events"}\n')
+            f.flush()
+            f.readline()  # {"ok": true}
+        except OSError:
+            f.close()
+            sock.close()
+            raise
+        return _EventStream(sock, f)
+
+
+class _EventStream:
+    """The events PrintClient.events() is subscribed to, open until closed or the server stops"""
+
+    def __init__(self, sock, f):
+        self._sock = sock
+        self._file = f
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self._file.readline() if not self._file.closed else b''
+        if not line:
+            self.close()
+            raise StopIteration
+        return json.loads(line)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+
+def running(path=SOCKET_PATH):
+    """A PrintClient if a server answers at `path`, otherwise None"""
+    client = PrintClient(path, timeout=1)
+    try:
+        client.status()
+    except (OSError, ValueError):
+        return None
+    client.timeout = None
+    return client
+
+
+# ---------------------
+# COMMAND LINE
+# ---------------------
+
+def _describe(job):
+    doing = f"{job['percent']:.1f}%" if job['percent'] is not None and job['state'] not in FINISHED else ''
+    if job['remaining'] and job['state'] in (PRINTING, PAUSED):
+        doing += f" ({estimator.format_duration(job['remaining'])} left)"
+    if job['error']:
+        doing = job['error'].splitlines()[0]
+    return f"{job['id']:>4} {job['state']:<10} {job['path']}  {doing}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keep the printer connected and print jobs sent over a socket")
+    parser.add_argument('--socket', default=SOCKET_PATH, help="Unix socket to serve or talk to")
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve_parser = commands.add_parser('serve', help="run the server")
+    serve_parser.add_argument('--emulate', action='store_true', help="print on a virtual printer (emulator.py)")
+    serve_parser.add_argument('--motion', action='store_true', help="with --emulate: take as long as the moves would")
+    submit_parser = commands.add_parser('submit', help="queue G-code files")
+    submit_parser.add_argument('files', nargs='+')
+    submit_parser.add_argument('--priority', type=int, default=0, help="go before queued jobs of lower priority")
+    submit_parser.add_argument('--resume', action='store_true', help="carry on from where the last run stopped")
+    submit_parser.add_argument('--no-preflight', action='store_true', help="send it even if the check fails")
+    cancel_parser = commands.add_parser('cancel', help="take a job out of the queue or stop it")
+    cancel_parser.add_argument('job', type=int)
+    commands.add_parser('pause', help="pause the job printing")
+    commands.add_parser('resume', help="resume the paused job")
+    commands.add_parser('status', help="show the printer and the jobs")
+    commands.add_parser('events', help="print events as they happen")
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        if running(args.socket):
+            print(f"A print server is already running on {args.socket}")  # And has the printer open
+            return
+        printer = None
+        if args.emulate:
+            import emulator
+            printer = emulator.VirtualPrinter(simulate_motion=args.motion)
+            uploader.PORT = printer.start()
+            uploader.RESET_ON_CONNECT = False  # It cannot be reset, pinging it is quicker
+            portfinder.CACHE_PATH = None  # Nothing to remember about a pty
+        print_server = PrintServer()
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit())  # Stopped like with Ctrl+C
+        try:
+            serve(print_server, args.socket)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            print_server.stop()
+            if printer is not None:
+                printer.stop()
+        return
+
+    client = PrintClient(args.socket)
+    try:
+        if args.command == 'submit':
+            for path in args.files:
+                print(_describe(client.submit(path, args.priority, args.resume,
+                                              False if args.no_preflight else None)))
+        elif args.command == 'cancel':
+            print(_describe(client.cancel(args.job)))
+        elif args.command in ('pause', 'resume'):
+            print(_describe(getattr(client, args.command)()))
+        elif args.command == 'status':
+            status = client.status()
+            printer = status['printer']
+            if printer['connected']:
+                print("Printer: connected at {} baud, X {:.2f}  Y {:.2f}  Z {:.2f}  E {:.2f}".format(
+                    printer['baudrate'], *printer['position']))
+            else:
+                print("Printer: not connected")
+            for job in ([status['current']] if status['current'] else []) + status['jobs']:
+                print(_describe(job))
+        else:
+            for event in client.events():
+                print(json.dumps(event))
+    except OSError as e:
+        print(f"No print server at {args.socket}: {e}")
+    except RuntimeError as e:
+        print(f"Refused: {e}")
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#ifndef STEPPER_H
+#define STEPPER_H
+
+#include <math.h>
+#include <stdint.h>
+
+#include "blockqueue.h"
+
+// ---------------------
+// STEP GENERATOR
+// Runs the A, B, Z and E motors of a block together along a straight line
+// (Bresenham / DDA): the motor with the most steps steps on every tick,
+// the others when their error term overflows. The ticks follow a
+// trapezoidal speed profile, accelerating from startSpeed to the feedrate,
+// cruising, and slowing down to startSpeed again by the end of the block.
+// Nothing here touches the hardware: firmware.ino sets the pins for the
+// motors step() returns and waits the interval it gives, so the same code
+// builds on Linux to record pulse timelines.
+// ---------------------
+
+#define MOTOR_A 0  // CoreXY motor A = X + Y
+#define MOTOR_B 1  // CoreXY motor B = X - Y
+#define MOTOR_Z 2
+#define MOTOR_E 3
+
+// Fills in a move block from the axis steps (X, Y, Z, E) and the length of
+// the move in mm. Speeds are in mm/s, acceleration in mm/s^2.
+inline void planMove(Block *block, const int32_t axisSteps[4], float length,
+                     float speed, float startSpeed, float acceleration) {
+  block->type = BLOCK_MOVE;
+  block->steps[MOTOR_A] = axisSteps[0] + axisSteps[1];
+  block->steps[MOTOR_B] = axisSteps[0] - axisSteps[1];
+  block->steps[MOTOR_Z] = axisSteps[2];
+  block->steps[MOTOR_E] = axisSteps[3];
+
+  uint32_t stepCount = 0;
+  for (uint8_t m = 0; m < 4; m++) {
+    uint32_t steps = block->steps[m] < 0 ? -block->steps[m] : block->steps[m];
+    if (steps > stepCount) stepCount = steps;
+  }
+  block->stepCount = stepCount;
+  if (!stepCount || length <= 0) {
+    block->nominalRate = block->initialRate = block->acceleration = 0;
+    block->accelerateUntil = block->decelerateAfter = 0;
+    return;
+  }
+
+  // Everything below is in steps of the motor that moves most
+  float stepsPerMm = stepCount / length;
+  if (startSpeed > speed) startSpeed = speed;
+  block->nominalRate = speed * stepsPerMm;
+  block->initialRate = startSpeed * stepsPerMm;
+  block->acceleration = acceleration * stepsPerMm;
+
+  float rampSteps = (block->nominalRate * block->nominalRate - block->initialRate * block->initialRate)
+                    / (2 * block->acceleration);
+  uint32_t accelerateSteps = (uint32_t)ceil(rampSteps);
+  uint32_t decelerateAfter = stepCount - accelerateSteps;
+  if (2 * accelerateSteps > stepCount) {
+    // Never reaches the feedrate: a triangle, slowing down from the peak on
+    // (an odd middle step would otherwise run at the feedrate)
+    accelerateSteps = decelerateAfter = stepCount / 2;
+  }
+  block->accelerateUntil = accelerateSteps;
+  block->decelerateAfter = decelerateAfter;
+}
+
+struct StepGenerator {
+  const Block *block;
+  uint32_t stepsDone;
+  uint32_t motorSteps[4];  // Steps each motor takes, without the direction
+  uint32_t error[4];       // Bresenham error terms
+
+  void begin(const Block *b) {
+    block = b;
+    stepsDone = 0;
+    for (uint8_t m = 0; m < 4; m++) {
+      motorSteps[m] = b->steps[m] < 0 ? -b->steps[m] : b->steps[m];
+      error[m] = b->stepCount / 2;
+    }
+  }
+
+  bool done() const { return stepsDone >= block->stepCount; }
+
+  // Speed (steps/s) on the way from tick `step` to the next one
+  float rate(uint32_t step) const {
+    float v0 = block->initialRate;
+    float rate;
+    if (step < block->accelerateUntil) {
+      rate = sqrt(v0 * v0 + 2 * block->acceleration * step);
+    } else if (step >= block->decelerateAfter) {
+      rate = sqrt(v0 * v0 + 2 * block->acceleration * (block->stepCount - 1 - step));
+    } else {
+      return block->nominalRate;
+    }
+    return rate < block->nominalRate ? rate : block->nominalRate;
+  }
+
+  // The motors to step on this tick (bit 0..3 = MOTOR_*), and in *interval
+  // the microseconds until the next tick
+  uint8_t step(uint32_t *interval) {
+    uint8_t motors = 0;
+    for (uint8_t m = 0; m < 4; m++) {
+      error[m] += motorSteps[m];
+      if (error[m] >= block->stepCount) {
+        error[m] -= block->stepCount;
+        motors |= 1 << m;
+      }
+    }
+    *interval = (uint32_t)(1000000.0 / rate(stepsDone) + 0.5);
+    stepsDone++;
+    return motors;
+  }
+};
+
+#endif
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules are scripts at the top of the repository, not a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,123 @@
+#ifndef ARDUINO_H
+#define ARDUINO_H
+
+#include <math.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+#include <string>
+#include <vector>
+
+// ---------------------
+// ARDUINO STUB
+// Just enough of the Arduino core for firmware.ino to build and run on
+// Linux: the clock is fakeMicros, which the test moves forward by hand,
+// pin writes are recorded in pinWrites, and Serial reads from a string
+// the test feeds it and writes to another one:
+//
+//     Serial.input += "G1 X10\n";
+//     for (int i = 0; i < 1000; i++) { fakeMicros += 10; loop(); }
+//     Serial.output  // "G1 X10\r\nOK\r\n"
+// ---------------------
+
+#define HIGH 1
+#define LOW 0
+#define OUTPUT 1
+#define HEX 16
+#define constrain(x, low, high) ((x) < (low) ? (low) : ((x) > (high) ? (high) : (x)))
+
+struct PinWrite {
+  unsigned long micros;
+  uint8_t pin;
+  uint8_t level;
+};
+
+static unsigned long fakeMicros = 0;
+static std::vector<PinWrite> pinWrites;
+
+inline unsigned long micros() { return fakeMicros; }
+inline unsigned long millis() { return fakeMicros / 1000; }
+inline void pinMode(uint8_t, uint8_t) {}
+inline void digitalWrite(uint8_t pin, uint8_t level) { pinWrites.push_back({fakeMicros, pin, level}); }
+
+class String {
+ public:
+  String() {}
+  String(const char *s) : s_(s) {}
+  String(const std::string &s) : s_(s) {}
+
+  unsigned int length() const { return s_.size(); }
+  const char *c_str() const { return s_.c_str(); }
+  char charAt(unsigned int i) const { return i < s_.size() ? s_[i] : 0; }
+  bool startsWith(const char *prefix) const { return s_.compare(0, strlen(prefix), prefix) == 0; }
+  int indexOf(char c) const {
+    size_t i = s_.find(c);
+    return i == std::string::npos ? -1 : (int)i;
+  }
+  String substring(unsigned int from) const { return from < s_.size() ? String(s_.substr(from)) : String(); }
+  String substring(unsigned int from, unsigned int to) const {
+    return from < s_.size() ? String(s_.substr(from, to - from)) : String();
+  }
+  void remove(unsigned int from) { if (from < s_.size()) s_.erase(from); }
+  void remove(unsigned int from, unsigned int count) { if (from < s_.size()) s_.erase(from, count); }
+  void trim() {
+    size_t start = s_.find_first_not_of(" \t\r\n");
+    size_t end = s_.find_last_not_of(" \t\r\n");
+    s_ = start == std::string::npos ? "" : s_.substr(start, end - start + 1);
+  }
+  void toUpperCase() { for (char &c : s_) c = toupper(c); }
+  long toInt() const { return atol(s_.c_str()); }
+  float toFloat() const { return atof(s_.c_str()); }
+
+ private:
+  std::string s_;
+};
+
+class FakeSerial {
+ public:
+  std::string input;   // Bytes the host has sent and the firmware has not read yet
+  std::string output;  // Everything the firmware wrote
+  long baud = 0;
+
+  void begin(long rate) { baud = rate; }
+  void end() { baud = 0; }
+  void flush() {}
+  int available() const { return input.size(); }
+  int read() {
+    if (input.empty()) return -1;
+    uint8_t c = input[0];
+    input.erase(0, 1);
+    return c;
+  }
+  size_t write(uint8_t b) { output += (char)b; return 1; }
+
+  void print(const char *s) { output += s; }
+  void print(const String &s) { output += s.c_str(); }
+  void print(char c) { output += c; }
+  void print(int n) { print((long)n); }
+  void print(unsigned int n) { print((unsigned long)n); }
+  void print(long n) { output += std::to_string(n); }
+  void print(unsigned long n) { output += std::to_string(n); }
+  void print(double x) {  // Two decimals, like Print::print(double)
+    char buf[32];
+    snprintf(buf, sizeof(buf), "%.2f", x);
+    output += buf;
+  }
+  void print(unsigned long n, int base) {
+    char buf[32];
+    snprintf(buf, sizeof(buf), base == HEX ? "%lX" : "%lu", n);
+    output += buf;
+  }
+  void print(unsigned int n, int base) { print((unsigned long)n, base); }
+  void print(int n, int base) { print((unsigned long)n, base); }
+
+  template <typename T> void println(T value) { print(value); output += "\r\n"; }
+  template <typename T> void println(T value, int base) { print(value, base); output += "\r\n"; }
+  void println() { output += "\r\n"; }
+};
+
+static FakeSerial Serial;
+
+#endif
@@ -0,0 +1,27 @@
+#ifndef CHECK_H
+#define CHECK_H
+
+#include <stdio.h>
+
+// ---------------------
+// The host-side firmware tests are plain programs: CHECK() prints every
+// failure with its line, and main() returns checkFailures() so the exit
+// status says whether they all passed (see tests/test_firmware.py).
+// ---------------------
+
+static int failures = 0;
+
+#define CHECK(condition)                                                  \
+  do {                                                                    \
+    if (!(condition)) {                                                   \
+      fprintf(stderr, "%s:%d: CHECK(%s) failed\n", __FILE__, __LINE__, #condition); \
+      failures++;                                                         \
+    }                                                                     \
+  } while (0)
+
+inline int checkFailures() {
+  if (failures) fprintf(stderr, "%d checks failed\n", failures);
+  return failures ? 1 : 0;
+}
+
+#endif
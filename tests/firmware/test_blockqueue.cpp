@@ -0,0 +1,107 @@
+// ---------------------
+// BLOCK QUEUE TESTS
+// The ring buffer on its own, then firmware.ino (built against the
+// Arduino.h stub next to this file) only reading lines while it has a
+// free slot:
+//
+//     g++ -std=c++11 -I tests/firmware -x c++ tests/firmware/test_blockqueue.cpp -o /tmp/test_blockqueue && /tmp/test_blockqueue
+// ---------------------
+
+#include "Arduino.h"
+#include "check.h"
+#include "../../firmware.ino"
+
+static int count(const std::string &text, const std::string &what) {
+  int n = 0;
+  for (size_t i = text.find(what); i != std::string::npos; i = text.find(what, i + 1)) n++;
+  return n;
+}
+
+static void runFor(unsigned long us) {
+  for (unsigned long end = fakeMicros + us; fakeMicros < end; fakeMicros += 5) loop();
+}
+
+static void testEmptyAndFull() {
+  BlockQueue queue;
+  queue.clear();
+  CHECK(queue.empty());
+  CHECK(!queue.full());
+  CHECK(queue.peek() == 0);
+  queue.pop();  // Nothing to pop
+  CHECK(queue.empty());
+
+  for (int i = 0; i < BLOCK_QUEUE_SIZE; i++) {
+    CHECK(!queue.full());
+    queue.next()->stepCount = i;
+    queue.push();
+  }
+  CHECK(queue.full());
+  CHECK(queue.count == 8);
+  Block *oldest = queue.peek();
+  queue.push();  // No ninth slot
+  CHECK(queue.count == 8);
+  CHECK(queue.peek() == oldest);
+  CHECK(queue.peek()->stepCount == 0);
+  CHECK(queue.next() == oldest);  // Why the firmware only plans a line while !full()
+}
+
+static void testWraparound() {
+  BlockQueue queue;
+  queue.clear();
+  uint32_t pushed = 0, popped = 0;
+  // Head goes round the 8 slots several times, with 0 to 5 blocks waiting
+  for (int round = 0; round < 40; round++) {
+    int add = round % 6;
+    for (int i = 0; i < add && !queue.full(); i++) {
+      queue.next()->stepCount = pushed++;
+      queue.push();
+    }
+    while (queue.count > (uint8_t)(round % 3)) {
+      CHECK(queue.peek()->stepCount == popped);  // First in, first out
+      CHECK(queue.peek() == &queue.blocks[queue.head]);
+      queue.pop();
+      popped++;
+    }
+    CHECK(queue.head < BLOCK_QUEUE_SIZE);
+  }
+  CHECK(pushed > 3 * BLOCK_QUEUE_SIZE);
+  while (!queue.empty()) {
+    CHECK(queue.peek()->stepCount == popped++);
+    queue.pop();
+  }
+  CHECK(popped == pushed);
+}
+
+static void testFirmwareWaitsForAFreeSlot() {
+  setup();
+  CHECK(Serial.output == "READY\r\n");
+  Serial.output.clear();
+
+  // 12 moves of 10 mm: the first 8 fill the queue, the rest wait in the serial buffer
+  for (int i = 0; i < 12; i++) Serial.input += i % 2 ? "G1 X0 F3000\n" : "G1 X10 F3000\n";
+  runFor(10000);
+  CHECK(blocks.full());
+  CHECK(count(Serial.output, "OK\r\n") == 8);
+  CHECK(Serial.available() > 0);
+
+  // Each move takes about 0.2 s, so after 3 s all of them have run
+  runFor(3000000);
+  CHECK(count(Serial.output, "OK\r\n") == 12);
+  CHECK(blocks.empty());
+  CHECK(Serial.available() == 0);
+  CHECK(coord[0] == 0);
+
+  // M17 / M18 take a slot, and a move that goes nowhere does not
+  Serial.output.clear();
+  Serial.input += "G1 X0\nM18\n";
+  runFor(1000);
+  CHECK(count(Serial.output, "OK\r\n") == 2);
+  CHECK(!motorsEnabled);
+}
+
+int main() {
+  testEmptyAndFull();
+  testWraparound();
+  testFirmwareWaitsForAFreeSlot();
+  return checkFailures();
+}
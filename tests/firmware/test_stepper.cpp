@@ -0,0 +1,140 @@
+// ---------------------
+// STEP GENERATOR TESTS
+// planMove() and StepGenerator on their own, then the step pulses
+// firmware.ino writes on the fake clock of the Arduino.h stub, with a
+// stall in the middle of a move:
+//
+//     g++ -std=c++11 -I tests/firmware -x c++ tests/firmware/test_stepper.cpp -o /tmp/test_stepper && /tmp/test_stepper
+// ---------------------
+
+#include "Arduino.h"
+#include "check.h"
+#include "../../firmware.ino"
+
+static Block plan(int32_t x, int32_t y, int32_t z, int32_t e, float length, float speed) {
+  Block block;
+  int32_t steps[4] = {x, y, z, e};
+  planMove(&block, steps, length, speed, 5.0, 1000.0);
+  return block;
+}
+
+static void testPlanMove() {
+  // CoreXY: A = X + Y, B = X - Y
+  Block block = plan(2000, 1000, 0, -300, 11.18, 50.0);
+  CHECK(block.type == BLOCK_MOVE);
+  CHECK(block.steps[MOTOR_A] == 3000);
+  CHECK(block.steps[MOTOR_B] == 1000);
+  CHECK(block.steps[MOTOR_E] == -300);
+  CHECK(block.stepCount == 3000);
+  CHECK(block.accelerateUntil == block.stepCount - block.decelerateAfter);  // Symmetric
+  CHECK(block.accelerateUntil < block.decelerateAfter);  // Reaches the feedrate
+
+  // Too short to reach 100 mm/s: speeds up for half of it, slows down for the rest
+  Block triangle = plan(400, 0, 0, 0, 2.0, 100.0);
+  CHECK(triangle.accelerateUntil == 200);
+  CHECK(triangle.decelerateAfter == 200);
+
+  // With an odd number of steps the middle one starts slowing down from the peak
+  Block odd = plan(401, 0, 0, 0, 2.005, 100.0);
+  CHECK(odd.accelerateUntil == 200);
+  CHECK(odd.decelerateAfter == 200);
+
+  Block nothing = plan(0, 0, 0, 0, 0.0, 50.0);
+  CHECK(nothing.stepCount == 0);
+}
+
+static void testStepGenerator() {
+  Block block = plan(2000, 1000, 0, -300, 11.18, 50.0);
+  StepGenerator generator;
+  generator.begin(&block);
+  uint32_t motorSteps[4] = {0, 0, 0, 0};
+  uint32_t interval, previous = 0xFFFFFFFF, fastest = 0xFFFFFFFF;
+  double seconds = 0;
+  for (uint32_t tick = 0; !generator.done(); tick++) {
+    uint8_t motors = generator.step(&interval);
+    CHECK(motors & (1 << MOTOR_A));  // The motor that moves most steps on every tick
+    for (uint8_t m = 0; m < 4; m++) {
+      if (motors & (1 << m)) motorSteps[m]++;
+    }
+    if (tick < block.accelerateUntil) CHECK(interval <= previous);  // Speeding up
+    if (tick > block.decelerateAfter) CHECK(interval >= previous);  // Slowing down
+    if (interval < fastest) fastest = interval;
+    previous = interval;
+    seconds += interval / 1e6;
+  }
+  CHECK(motorSteps[MOTOR_A] == 3000);
+  CHECK(motorSteps[MOTOR_B] == 1000);
+  CHECK(motorSteps[MOTOR_Z] == 0);
+  CHECK(motorSteps[MOTOR_E] == 300);
+  CHECK(fabs(fastest - 1e6 / block.nominalRate) <= 1);  // Never faster than the feedrate
+
+  // The trapezoid's time: ramps from 5 to 50 mm/s at 1000 mm/s^2 and the cruise in between
+  double ramp = (50.0 - 5.0) / 1000.0;
+  double rampLength = (50.0 * 50.0 - 5.0 * 5.0) / (2 * 1000.0);
+  double expected = 2 * ramp + (11.18 - 2 * rampLength) / 50.0;
+  CHECK(fabs(seconds - expected) < 0.01 * expected);
+}
+
+static void testTriangleHasNoSpeedJump() {
+  // 2 mm at F6000 never gets near 100 mm/s; 400 and 401 steps both peak in the middle
+  for (uint32_t steps = 400; steps <= 401; steps++) {
+    Block block = plan(steps, 0, 0, 0, steps / 200.0, 100.0);
+    StepGenerator generator;
+    generator.begin(&block);
+    float peak = 0;
+    for (uint32_t tick = 1; tick < steps; tick++) {
+      // v^2 changes by at most 2a from one step to the next
+      float change = generator.rate(tick) * generator.rate(tick) - generator.rate(tick - 1) * generator.rate(tick - 1);
+      CHECK(fabs(change) <= 2 * block.acceleration * 1.01);
+      if (generator.rate(tick) > peak) peak = generator.rate(tick);
+    }
+    CHECK(peak < block.nominalRate / 2);
+  }
+}
+
+// Times (us) of the A motor's step pulses while firmware.ino runs for `us`,
+// the loop going round every 5 us, with the clock jumping `stall` us at `stallAt`
+static std::vector<unsigned long> stepTimes(unsigned long us, unsigned long stallAt, unsigned long stall) {
+  std::vector<unsigned long> times;
+  size_t seen = pinWrites.size();
+  bool stalled = false;
+  for (unsigned long end = fakeMicros + us; fakeMicros < end; fakeMicros += 5) {
+    if (!stalled && fakeMicros >= stallAt) {
+      fakeMicros += stall;  // Serial.println blocking on a full buffer, a slow parse...
+      stalled = true;
+    }
+    loop();
+    for (; seen < pinWrites.size(); seen++) {
+      if (pinWrites[seen].pin == A_STP && pinWrites[seen].level == HIGH) times.push_back(pinWrites[seen].micros);
+    }
+  }
+  return times;
+}
+
+static void testStallDoesNotBurst() {
+  setup();
+  fakeMicros = 1000;
+  // 50 mm at 50 mm/s: 10000 steps/s at the feedrate, 100 us apart
+  Serial.input += "G1 X50 F3000\n";
+  loop();
+  Block *block = blocks.peek();
+  CHECK(block != 0);
+  float fastest = 1e6 / block->nominalRate;
+  std::vector<unsigned long> times = stepTimes(1200000, fakeMicros + 300000, 20000);
+
+  CHECK(times.size() == 10000);  // Every step, the stall only delays them
+  size_t tooClose = 0;
+  for (size_t i = 1; i < times.size(); i++) {
+    if (times[i] - times[i - 1] < fastest - 6) tooClose++;  // The 5 us loop adds some jitter
+  }
+  CHECK(tooClose == 0);
+  CHECK(blocks.empty());
+}
+
+int main() {
+  testPlanMove();
+  testStepGenerator();
+  testTriangleHasNoSpeedJump();
+  testStallDoesNotBurst();
+  return checkFailures();
+}
@@ -0,0 +1,115 @@
+import numpy as np
+
+import arcs
+import pipeline
+from gcode import parse_move
+
+# ---------------------
+# ARC TESTS
+# Chords from arcs.chords / arcs.expand checked against the arc itself:
+# they end exactly where it does, every point lies on its circle, and
+# there are as few of them as ARC_TOLERANCE allows
+#
+#     python -m pytest tests/test_arcs.py
+# ---------------------
+
+
+def cut(start, end, offset, clockwise):
+    """The chord ends of one arc, with its start in front"""
+    start, end = np.array([start], float), np.array([end], float)
+    points, _ = arcs.chords(start, end, np.array([offset], float), np.array([clockwise]))
+    return np.vstack((start, points))
+
+
+def radii(points, centre):
+    return np.hypot(points[:, 0] - centre[0], points[:, 1] - centre[1])
+
+
+def sweep(points, centre):
+    """Angle turned through (radians, counter-clockwise positive)"""
+    angles = np.unwrap(np.arctan2(points[:, 1] - centre[1], points[:, 0] - centre[0]))
+    return angles[-1] - angles[0]
+
+
+def test_direction():
+    # Half a circle from (0, 0) to (10, 0) round (5, 0): G2 goes over the top, G3 underneath
+    for clockwise, side in ((True, 1), (False, -1)):
+        points = cut((0, 0, 0, 0), (10, 0, 0, 0), (5, 0), clockwise)
+        assert tuple(points[-1]) == (10, 0, 0, 0)  # Exactly
+        assert np.allclose(radii(points, (5, 0)), 5)
+        assert (np.sign(points[1:-1, 1]) == side).all()
+        assert np.isclose(sweep(points, (5, 0)), -side * np.pi)
+
+
+def test_full_circle():
+    # Start == end is a whole circle, not nothing
+    for clockwise in (True, False):
+        points = cut((0, 0, 0, 0), (0, 0, 0, 0), (5, 0), clockwise)
+        assert tuple(points[-1]) == (0, 0, 0, 0)
+        assert np.allclose(radii(points, (5, 0)), 5)
+        assert np.isclose(sweep(points, (5, 0)), -2 * np.pi if clockwise else 2 * np.pi)
+        assert np.isclose(points[:, 0].max(), 10, atol=arcs.ARC_TOLERANCE)  # All the way round
+
+
+def test_radius_form():
+    start, end = np.array([[0.0, 0.0]]), np.array([[10.0, 0.0]])
+    for radius, clockwise in ((10, True), (10, False), (-10, True), (-10, False)):
+        offset = arcs.centre_offsets(start, end, np.array([radius], float), np.array([clockwise]))[0]
+        assert np.isclose(np.hypot(*offset), 10)
+        assert np.isclose(np.hypot(*(start[0] + offset - end[0])), 10)  # The end is on the circle too
+
+        points = cut((0, 0, 0, 0), (10, 0, 0, 0), offset, clockwise)
+        assert tuple(points[-1]) == (10, 0, 0, 0)
+        assert np.allclose(radii(points, offset), 10)
+        turned = sweep(points, offset)
+        assert np.sign(turned) == (-1 if clockwise else 1)
+        # A negative radius takes the long way round
+        assert (abs(turned) > np.pi) == (radius < 0)
+
+
+def test_chord_count_keeps_to_the_tolerance():
+    for radius in (0.5, 5, 50, 500):
+        points = cut((0, 0, 0, 0), (2 * radius, 0, 0, 0), (radius, 0), True)
+        count = len(points) - 1
+        # Each chord's middle is where it strays furthest from the arc
+        middles = (points[1:, :2] + points[:-1, :2]) / 2
+        assert (radius - radii(middles, (radius, 0)) <= arcs.ARC_TOLERANCE + 1e-9).all()
+        # And one chord fewer would stray further
+        assert radius * (1 - np.cos(np.pi / (count - 1) / 2)) > arcs.ARC_TOLERANCE
+
+
+def test_no_chord_shorter_than_a_step():
+    points = cut((0, 0, 0, 0), (0.02, 0, 0, 0), (0.01, 0), False)
+    lengths = np.hypot(*np.diff(points[:, :2], axis=0).T)
+    assert (lengths >= arcs.RESOLUTION - 1e-12).all()
+    assert tuple(points[-1]) == (0.02, 0, 0, 0)
+
+
+def test_helix_spreads_z_and_e():
+    points = cut((0, 0, 1, 2), (10, 0, 3, 6), (5, 0), False)
+    assert tuple(points[-1]) == (10, 0, 3, 6)
+    travelled = np.concatenate(([0], np.cumsum(np.hypot(*np.diff(points[:, :2], axis=0).T))))
+    share = travelled / travelled[-1]
+    # Along the arc, equal chords: Z and E go up with the distance round it
+    assert np.allclose(points[:, 2], 1 + 2 * share)
+    assert np.allclose(points[:, 3], 2 + 4 * share)
+
+
+def test_expand_arcs():
+    lines = ["G90", "M83", "G1 X10 Y10 F1500", "G2 X20 Y10 I5 J0 E1 F600", "G91", "G3 X-10 Y0 R5", "G1 X1"]
+    out = list(pipeline.expand_arcs(lines))
+    assert out[:3] == lines[:3] and out[4] == lines[4] and out[6] == lines[6]
+
+    # Absolute: every chord ends on the circle round (15, 10), the last one at the end
+    chords = [parse_move(chord) for chord in out[3].split('\n')]
+    assert (chords[-1]['X'], chords[-1]['Y']) == (20, 10)
+    ends = np.array([(chord['X'], chord['Y']) for chord in chords])
+    assert np.allclose(radii(ends, (15, 10)), 5, atol=1e-3)  # Written to 3 decimals
+    assert np.isclose(sum(chord['E'] for chord in chords), 1)  # Relative E spread over the chords
+    assert chords[0]['F'] == 600 and all('F' not in chord for chord in chords[1:])
+
+    # Relative from (20, 10): the steps add up to the whole move and follow the circle
+    steps = np.array([(chord['X'], chord['Y']) for chord in map(parse_move, out[5].split('\n'))])
+    assert np.allclose(steps.sum(axis=0), (-10, 0))
+    ends = (20, 10) + np.cumsum(steps, axis=0)
+    assert np.allclose(radii(ends, (15, 10)), 5, atol=1e-2)
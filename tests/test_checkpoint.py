@@ -0,0 +1,53 @@
+from checkpoint import QUEUE_DEPTH, Checkpoint
+from jobfile import JobFile
+
+# ---------------------
+# CHECKPOINT TESTS
+#
+#     python -m pytest tests/test_checkpoint.py
+# ---------------------
+
+
+def write_job(path, moves):
+    with open(path, 'w') as f:
+        f.write('G90\n')
+        for i in range(moves):
+            f.write(f"G1 X{i + 1} F1500\n")
+    return str(path)
+
+
+def test_lags_by_the_queue_depth(tmp_path):
+    with JobFile(write_job(tmp_path / 'job.gcode', 20), cache_index=False) as job:
+        checkpoint = Checkpoint(job)
+        lines = list(job.lines())
+        for number, line in enumerate(lines[:QUEUE_DEPTH], 1):
+            checkpoint.acknowledged(number, line)
+        assert checkpoint.line == 0  # All of them may still be in the firmware's queue
+        assert checkpoint.preamble() == []
+
+        for number, line in enumerate(lines[QUEUE_DEPTH:], QUEUE_DEPTH + 1):
+            checkpoint.acknowledged(number, line)
+        assert checkpoint.line == len(lines) - QUEUE_DEPTH
+        assert checkpoint.state.coord[0] == checkpoint.line - 1  # After 'G1 X<line - 1>'
+
+        checkpoint.save()
+        resumed = Checkpoint.load(job)
+        assert resumed.line == checkpoint.line
+        assert next(iter(resumed.lines())) == lines[checkpoint.line]
+
+
+def test_line_of_several_commands(tmp_path):
+    # An arc cut into chords is one line of the job, sent as several commands
+    with JobFile(write_job(tmp_path / 'job.gcode', 3), cache_index=False) as job:
+        checkpoint = Checkpoint(job)
+        checkpoint.acknowledged(1, 'G90')
+        chords = [f"G1 X{x}" for x in range(1, QUEUE_DEPTH + 2)]
+        for chord in chords:
+            checkpoint.acknowledged(2, chord)
+        assert checkpoint.line == 1  # Some of the chords have run, not all
+        assert checkpoint.state.coord[0] == 0
+
+        for _ in range(QUEUE_DEPTH):
+            checkpoint.acknowledged(3, 'G1 X0')
+        assert checkpoint.line == 2
+        assert checkpoint.state.coord[0] == QUEUE_DEPTH + 1
@@ -0,0 +1,74 @@
+import time
+
+import pytest
+
+import emulator
+from farm import IDLE, OFFLINE, PRINTING, PrinterFarm
+
+# ---------------------
+# PRINTER FARM TESTS
+# A PrinterFarm on several emulator.VirtualPrinters that take as long as
+# the moves would, so a job is still printing when a worker is killed:
+#
+#     python -m pytest tests/test_farm.py
+# ---------------------
+
+PRINTERS = 3
+WAIT_TIMEOUT = 60  # Seconds for a farm to finish its jobs
+
+
+def write_job(path, moves, feedrate=6000):
+    """A job going back and forth along X, 5 mm per move (0.05 s each at F6000)"""
+    with open(path, 'w') as f:
+        f.write('G90\nG92 X0 Y0 Z0 E0\n')
+        for i in range(moves):
+            f.write(f"G1 X{5 if i % 2 == 0 else 0} F{feedrate}\n")
+    return str(path)
+
+
+@pytest.fixture
+def farm():
+    printers = [emulator.VirtualPrinter(simulate_motion=True) for _ in range(PRINTERS)]
+    farm = PrinterFarm({f"emulator-{i + 1}": printer.start() for i, printer in enumerate(printers)},
+                       reset=False, port_cache=None)
+    yield farm
+    farm.stop()
+    for printer in printers:
+        printer.stop()
+
+
+def test_jobs_spread_over_printers(farm, tmp_path):
+    jobs = [write_job(tmp_path / f"job{i}.gcode", 20) for i in range(2 * PRINTERS)]
+    for path in jobs:
+        farm.submit(path)
+    assert farm.wait(WAIT_TIMEOUT)
+
+    assert sorted(path for path, _, _ in farm.finished) == sorted(jobs)
+    assert farm.failed == []
+    status = farm.status()
+    assert all(s['state'] == IDLE for s in status.values())
+    assert sum(s['jobs_done'] for s in status.values()) == len(jobs)
+    assert len({name for _, name, _ in farm.finished}) > 1
+
+
+def test_dead_worker_hands_its_job_on(farm, tmp_path):
+    jobs = [write_job(tmp_path / f"job{i}.gcode", 40) for i in range(PRINTERS)]
+    for path in jobs:
+        farm.submit(path)
+    deadline = time.monotonic() + WAIT_TIMEOUT
+    while True:
+        printing = [name for name, s in farm.status().items() if s['state'] == PRINTING]
+        if printing:
+            break
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+    victim = printing[0]
+    farm._workers[victim].kill()  # Dies without a word, like a segfault or the OOM killer
+
+    assert farm.wait(WAIT_TIMEOUT)  # Does not wait for the dead printer forever
+    assert sorted(path for path, _, _ in farm.finished) == sorted(jobs)
+    assert all(name != victim for _, name, _ in farm.finished)
+    assert farm.failed == []
+    status = farm.status()[victim]
+    assert status['state'] == OFFLINE
+    assert "died" in status['error']
@@ -0,0 +1,30 @@
+import glob
+import os
+import shutil
+import subprocess
+
+import pytest
+
+# ---------------------
+# FIRMWARE TESTS
+# Builds every tests/firmware/test_*.cpp with the host's C++ compiler,
+# against the Arduino.h stub there, and runs it (see the command at the
+# top of each file to run one by hand):
+#
+#     python -m pytest tests/test_firmware.py
+# ---------------------
+
+FIRMWARE_TESTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'firmware')
+COMPILER = os.environ.get('CXX') or shutil.which('g++') or shutil.which('clang++')
+
+
+@pytest.mark.skipif(COMPILER is None, reason="no C++ compiler")
+@pytest.mark.parametrize('source', sorted(glob.glob(os.path.join(FIRMWARE_TESTS, 'test_*.cpp'))),
+                         ids=os.path.basename)
+def test_firmware(source, tmp_path):
+    binary = str(tmp_path / 'test')
+    build = subprocess.run([COMPILER, '-std=c++11', '-Wall', '-I', FIRMWARE_TESTS, '-x', 'c++', source, '-o', binary],
+                           capture_output=True, text=True)
+    assert build.returncode == 0, build.stderr
+    run = subprocess.run([binary], capture_output=True, text=True, timeout=120)
+    assert run.returncode == 0, run.stderr
@@ -0,0 +1,33 @@
+import numpy as np
+
+import jobarrays
+from gcode import to_float
+
+# ---------------------
+# JOB PARSER TESTS
+#
+#     python -m pytest tests/test_jobarrays.py
+# ---------------------
+
+
+def test_numbers_parse_like_to_float():
+    rng = np.random.default_rng(0)
+    numbers = [f"{x:.{decimals}f}" for x, decimals in zip(rng.uniform(-500, 500, 5000), rng.integers(0, 7, 5000))]
+    numbers += ['0', '-0', '+5', '.5', '-.5', '5.', '007', '1e3', '12abc', '1.2.3', '', '-',
+                '123456789012345', '1.23456789012345678', '-0.000001']
+    job = jobarrays.parse(''.join(f"G1 X{number} F1500\n" for number in numbers).encode())
+    assert np.array_equal(job.words[:, 0], [to_float(number) for number in numbers])
+
+
+def test_words():
+    job = jobarrays.parse(b"G1 X1 X2 Y-3.5 ; X9\nG1X10 E-.25\ng92 e0\nG2 X10 Y0 I5 J0\nM104 S200\n\n")
+    assert list(job.command) == [jobarrays.COMMAND_INDEX['G1'], jobarrays.COMMAND_INDEX['G1'],
+                                 jobarrays.COMMAND_INDEX['G92'], jobarrays.COMMAND_INDEX['G2'],
+                                 jobarrays.UNKNOWN, jobarrays.BLANK]
+    x, y, e, i, j = (jobarrays.WORDS.index(code) for code in 'XYEIJ')
+    assert job.words[0, x] == 2.0  # The last X on the line
+    assert job.words[0, y] == -3.5
+    assert job.words[1, x] == 10.0 and job.words[1, e] == -0.25
+    assert job.words[2, e] == 0.0
+    assert (job.words[3, i], job.words[3, j]) == (5.0, 0.0)
+    assert np.isnan(job.words[4:]).all()
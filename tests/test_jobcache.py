@@ -0,0 +1,71 @@
+import json
+import os
+import threading
+
+import jobcache
+import pipeline
+from jobfile import JobFile
+
+# ---------------------
+# JOB CACHE TESTS
+#
+#     python -m pytest tests/test_jobcache.py
+# ---------------------
+
+
+def write_job(path, moves):
+    with open(path, 'w') as f:
+        f.write('G90\n')
+        for i in range(moves):
+            f.write(f"G1 X{i % 100} Y{i // 100} F1500\n")
+    return str(path)
+
+
+def test_concurrent_compiles(tmp_path):
+    source = write_job(tmp_path / 'job.gcode', 20000)
+    cache_dir = str(tmp_path / 'cache')
+    errors, line_counts = [], []
+
+    def open_it():
+        try:
+            with jobcache.open_job(source, cache_dir) as job:
+                line_counts.append(job.line_count)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=open_it) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert line_counts == [20001] * 8
+    assert [name for name in os.listdir(cache_dir) if name.endswith('.tmp')] == []
+
+
+def test_evict_forgets_hashes(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    sources = [write_job(tmp_path / f"job{i}.gcode", 1000) for i in range(3)]
+    for source in sources:
+        jobcache.open_job(source, cache_dir).close()
+    with open(os.path.join(cache_dir, jobcache.HASHES)) as f:
+        assert len(json.load(f)) == 3
+
+    jobcache.evict(cache_dir, cache_size=0, keep=None)
+    assert [name for name in os.listdir(cache_dir) if name.endswith(jobcache.SUFFIX)] == []
+    with open(os.path.join(cache_dir, jobcache.HASHES)) as f:
+        assert json.load(f) == {}
+
+
+def test_preprocess_counts_the_source(tmp_path):
+    source = tmp_path / 'job.gcode'
+    source.write_text('; sliced\nG90\n\nG1 X10.0000 Y5.5000 F1500.0 ; first move\nG1   X20   Y5.5\nM104 S200\n')
+    plain = pipeline.PipelineStats()
+    with JobFile(str(source)) as job:
+        sent = list(pipeline.preprocess(job.lines(), stats=plain))
+
+    cached = pipeline.PipelineStats()
+    with jobcache.open_job(str(source), str(tmp_path / 'cache')) as compiled, JobFile(str(source)) as job:
+        assert list(pipeline.preprocess(compiled.lines(), stats=cached, source=job.lines())) == sent
+    assert (cached.lines_in, cached.bytes_in) == (plain.lines_in, plain.bytes_in)
+    assert (cached.lines_out, cached.bytes_out) == (plain.lines_out, plain.bytes_out)
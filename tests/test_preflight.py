@@ -0,0 +1,41 @@
+import preflight
+from gcode import MAX_COORD
+
+# ---------------------
+# PREFLIGHT TESTS
+#
+#     python -m pytest tests/test_preflight.py
+# ---------------------
+
+
+def write_job(path, layers, extra=()):
+    """Slicer-like output: a square perimeter per layer, with absolute E counting up the whole job"""
+    with open(path, 'w') as f:
+        f.write('M104 S200\nG21\nG90\nM82\nG28\nG92 E0\n')
+        e = 0.0
+        for layer in range(layers):
+            f.write(f"G1 Z{0.2 * (layer + 1):.1f} F600\n")
+            for x, y in ((10, 10), (110, 10), (110, 110), (10, 110), (10, 10)):
+                e += 4.0
+                f.write(f"G1 X{x} Y{y} E{e:.3f} F1800\n")
+        f.writelines(line + '\n' for line in extra)
+    return str(path)
+
+
+def test_multi_layer_job_passes(tmp_path):
+    path = write_job(tmp_path / 'job.gcode', 50)
+    report = preflight.validate_file(path)
+    assert report.ok
+    assert report.count(preflight.BOUNDS) == 0
+    assert report.warnings == 2  # M104 and G21, which the firmware ignores
+
+
+def test_moves_out_of_bounds_are_refused(tmp_path):
+    past = MAX_COORD[0] + 1
+    path = write_job(tmp_path / 'job.gcode', 2, [f"G1 X{past} Y10", "G1 X10 Y10", "G3 X10 Y10 I0 J-20"])
+    report = preflight.validate_file(path)
+    assert not report.ok
+    lines = 6 + 2 * 6
+    assert list(report.issues[preflight.BOUNDS]) == [lines, lines + 2]  # The arc dips below Y0
+    problems = list(report.problems())
+    assert problems[-2][2] == f"move out of bounds at X{past:g} Y10 Z0.4 E40"
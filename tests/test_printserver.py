@@ -0,0 +1,132 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import printserver
+from printserver import CANCELLED, DONE, PAUSED, PRINTING, QUEUED
+
+# ---------------------
+# PRINT SERVER TESTS
+# Runs `printserver.py serve --emulate --motion` (a PrintServer on an
+# emulator.VirtualPrinter that takes as long as the moves would) with HOME
+# in a temporary directory, and drives it through PrintClient:
+#
+#     python -m pytest tests/test_printserver.py
+# ---------------------
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'printserver.py')
+START_TIMEOUT = 20  # Seconds for the server to connect to the emulator and answer
+EVENT_TIMEOUT = 30  # Seconds without an event before a test gives up
+
+
+def write_job(path, moves, feedrate=6000):
+    """A job going back and forth along X, 5 mm per move (0.05 s each at F6000)"""
+    with open(path, 'w') as f:
+        f.write('G90\nG92 X0 Y0 Z0 E0\n')
+        for i in range(moves):
+            f.write(f"G1 X{5 if i % 2 == 0 else 0} F{feedrate}\n")
+    return str(path)
+
+
+@pytest.fixture
+def client(tmp_path):
+    path = str(tmp_path / 'printserver.sock')
+    server = subprocess.Popen([sys.executable, SERVER, '--socket', path, 'serve', '--emulate', '--motion'],
+                              cwd=tmp_path, env=dict(os.environ, HOME=str(tmp_path)),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + START_TIMEOUT
+    while printserver.running(path) is None:
+        assert server.poll() is None, "the print server exited"
+        assert time.monotonic() < deadline, "the print server did not answer"
+        time.sleep(0.1)
+    yield printserver.PrintClient(path, timeout=EVENT_TIMEOUT)
+    server.terminate()
+    assert server.wait(START_TIMEOUT) == 0
+    assert not os.path.exists(path)  # Removed on SIGTERM
+
+
+def wait_for(events, job_id, states):
+    """The job as the first event that has it in one of `states` gives it"""
+    for event in events:
+        if event['event'] == 'job' and event['job']['id'] == job_id and event['job']['state'] in states:
+            return event['job']
+    raise AssertionError("the print server stopped")
+
+
+def test_status_without_jobs(client):
+    status = client.status()
+    assert status['printer']['connected']
+    assert status['current'] is None
+    assert status['jobs'] == []
+
+
+def test_jobs_print_by_priority(client, tmp_path):
+    first = write_job(tmp_path / 'first.gcode', 20)
+    with client.events() as events:
+        running = client.submit(first)
+        low = client.submit(write_job(tmp_path / 'low.gcode', 4))
+        high = client.submit(write_job(tmp_path / 'high.gcode', 4), priority=5)
+        cancelled = client.submit(write_job(tmp_path / 'cancelled.gcode', 4))
+
+        assert client.cancel(cancelled['id'])['state'] == CANCELLED
+        queued = [job['id'] for job in client.status()['jobs'] if job['state'] == QUEUED]
+        assert queued == [high['id'], low['id']]
+
+        started, progress = [], []
+        for event in events:
+            if event['event'] == 'progress':
+                progress.append(event['job'])
+            elif event['event'] == 'job' and event['job']['state'] == PRINTING:
+                started.append(event['job']['id'])
+            elif event['event'] == 'job' and event['job']['id'] == low['id'] and event['job']['state'] == DONE:
+                break
+
+    assert started == [running['id'], high['id'], low['id']]
+    assert running['id'] in progress
+    states = {job['id']: job['state'] for job in client.status()['jobs']}
+    assert states == {running['id']: DONE, high['id']: DONE, low['id']: DONE, cancelled['id']: CANCELLED}
+    done = next(job for job in client.status()['jobs'] if job['id'] == running['id'])
+    assert done['percent'] == 100.0 and done['stats']['lines'] > 0
+
+
+def test_pause_resume_cancel(client, tmp_path):
+    path = write_job(tmp_path / 'long.gcode', 400)
+    with client.events() as events:
+        job = client.submit(path)
+        wait_for(events, job['id'], (PRINTING,))
+
+        assert client.pause(job['id'])['state'] == PAUSED
+        with pytest.raises(RuntimeError):
+            client.pause()  # Already paused
+        assert client.status()['current']['state'] == PAUSED
+        time.sleep(0.2)  # A line already past the pause check still goes out
+        line = client.status()['current']['line']
+        time.sleep(0.5)
+        assert client.status()['current']['line'] == line  # Nothing sent while paused
+
+        assert client.resume()['state'] == PRINTING
+        with pytest.raises(RuntimeError):
+            client.jog(dx=1)  # Not while printing
+        client.cancel(job['id'])
+        stopped = wait_for(events, job['id'], (CANCELLED, DONE))
+
+    assert stopped['state'] == CANCELLED
+    assert stopped['stats']['stopped']
+    assert os.path.exists(path + '.checkpoint')  # Kept, a resubmit with resume=True carries on
+    assert client.status()['current'] is None
+    assert client.jog(dx=1) == (1.0, 0.0, 0.0)
+
+
+def test_refuses_bad_files(client, tmp_path):
+    with pytest.raises(RuntimeError):
+        client.submit(str(tmp_path / 'missing.gcode'))
+    outside = tmp_path / 'outside.gcode'
+    outside.write_text('G90\nG1 X99999 F600\n')
+    with pytest.raises(RuntimeError, match="out of bounds"):
+        client.submit(str(outside))
+    with pytest.raises(RuntimeError):
+        client.cancel(12345)
+    assert client.status()['jobs'] == []
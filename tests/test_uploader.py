@@ -0,0 +1,83 @@
+import functools
+import pstats
+
+import pytest
+
+import emulator
+import jobcache
+import portfinder
+import uploader
+
+# ---------------------
+# UPLOADER TESTS
+# uploader.start_print on an emulator.VirtualPrinter, with the job cache in
+# a temporary directory. The printer keeps the position after every move it
+# runs, so what arrived can be checked line by line:
+#
+#     python -m pytest tests/test_uploader.py
+# ---------------------
+
+
+def write_job(path, moves):
+    with open(path, 'w') as f:
+        f.write('G90 ; absolute\nG92 X0 Y0 Z0 E0\n')
+        for i in range(moves):
+            f.write(f"G1 X{i % 50} Y{i % 7} F3000 ; move {i}\n")
+    return str(path)
+
+
+class RecordingPrinter(emulator.VirtualPrinter):
+    def __init__(self, *args, **kwargs):
+        self.positions = []  # X, Y, Z, E after every move run, in order
+        super().__init__(*args, **kwargs)
+
+    def _execute_move(self, words, output):
+        in_bounds = super()._execute_move(words, output)
+        self.positions.append(tuple(self.coord))
+        return in_bounds
+
+
+@pytest.fixture
+def printer(monkeypatch, tmp_path):
+    printer = RecordingPrinter()
+    monkeypatch.setattr(uploader, 'PORT', printer.start())
+    monkeypatch.setattr(uploader, 'RESET_ON_CONNECT', False)
+    monkeypatch.setattr(uploader, 'FAST_BAUDRATES', ())
+    monkeypatch.setattr(portfinder, 'CACHE_PATH', None)
+    monkeypatch.setattr(jobcache, 'open_job', functools.partial(jobcache.open_job, cache_dir=str(tmp_path / 'cache')))
+    yield printer
+    uploader.close_connection()
+    printer.stop()
+
+
+def test_profile_sees_the_send_path(printer, tmp_path):
+    job = write_job(tmp_path / 'job.gcode', 200)
+    profile = str(tmp_path / 'job.prof')
+    uploader.start_print(job, profile=profile)
+    assert printer.lines_received >= 200
+
+    functions = {name for _, _, name in pstats.Stats(profile).stats}
+    assert '_stream' in functions  # The event loop thread's
+    assert 'estimate' in functions  # And this thread's
+
+
+def test_binary_records_survive_noise(printer, monkeypatch, tmp_path):
+    # Enough records for the sequence number to wrap round (it is one byte) a few times
+    moves = 1000
+    job = write_job(tmp_path / 'job.gcode', moves)
+    monkeypatch.setattr(uploader, 'BINARY_PROTOCOL', True)
+    assert uploader.connect_arduino()
+    assert uploader.connection.binary_mode
+
+    # Flip a bit in about one record of every 40 from here on
+    printer.noise = {printer.link_baud: 1e-3}
+    uploader.start_print(job, keep_open=True)
+    printer.noise = {}
+
+    counters = uploader.connection.metrics.counters
+    assert counters['lines'] > 3 * 256
+    assert printer.corrupted_bytes > 0
+    assert counters['naks'] > 0  # Rejected by the CRC (or skipped, and then out of sequence)
+    assert counters['resent'] > 0
+    # Every move ran once, in order, despite the records sent again
+    assert printer.positions == [(float(i % 50), float(i % 7), 0.0, 0.0) for i in range(moves)]
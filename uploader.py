@@ -1,84 +1,329 @@
-import serial
-import time
+import asyncio
+import contextlib
+import threading
 
-# Global variable to store the Arduino connection
+import estimator
+import jobarrays
+import jobcache
+import metrics
+import optimizer
+import pipeline
+import portfinder
+from checkpoint import Checkpoint
+from jobfile import JobFile
+from metrics import log
+from preflight import validate
+# Firmware events, progress and job control live with the connection (printer.py)
+from printer import (ACK, ECHO, ERROR, PROGRESS, POSITION, INFO, NAK, PING_AFTER, FirmwareEvent, JobControl,
+                     PrinterConnection, open_port, parse_response, percent_done, report_progress)
+
+# Global variables to store the Arduino connection and the event loop running it
 arduino = None
+connection = None  # printer.PrinterConnection on arduino
+_loop = None
+binary_mode = False  # The firmware reads binproto records (kept while detached)
+record_seq = 0  # Sequence number of the next binary record
+machine_state = None  # gcode.MachineState of the firmware (kept while detached, None if unknown)
 
 # Configuration constants
-PORT = '/dev/cu.usbmodem101'  # <-- Change to your Arduino's port
+PORT = None  # <-- Your Arduino's port (e.g. '/dev/cu.usbmodem101'), None finds it (portfinder.find_port)
 BAUDRATE = 115200  # Must match Serial.begin() on Arduino
+FAST_BAUDRATES = (1000000, 500000, 250000)  # Tried in turn after connecting, the first that passes its echo test is kept. () stays at BAUDRATE
+RX_BUFFER_SIZE = 64  # Size of the Arduino's serial receive buffer (bytes)
+ACK_TIMEOUT = 300  # Seconds to wait for "OK" before giving up (long moves are silent)
+BINARY_PROTOCOL = False  # Ask the firmware for the binary protocol when connecting (see binproto.py)
+MAX_RESENDS = 10  # Times a binary record is sent again before giving up
+RESET_ON_CONNECT = True  # Opening the port resets the Arduino (DTR). False leaves a running board as it is
+KEEP_OPEN = False  # Leave the connection open after start_print, so the next job starts straight away
+PREFLIGHT = True  # Check the whole file before sending it, and refuse it if a move goes out of bounds
+JOB_CACHE = True  # Parse each file once and keep it compiled (see jobcache.py), instead of parsing it every print
+
+# ---------------------
+# BLOCKING WRAPPERS
+# The functions below keep the connection in a PrinterConnection running on
+# an event loop in a background thread, and wait for its coroutines. Code
+# that wants several things going on at once (a job, M114 polling, jogs)
+# can await the same connection from that loop instead (see printer.py).
+# ---------------------
+
+def _schedule(coroutine):
+    """Start a coroutine on the background event loop, returns a concurrent.futures.Future of its result"""
+    global _loop
+    if _loop is None:
+        _loop = asyncio.new_event_loop()
+        threading.Thread(target=_loop.run_forever, daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coroutine, _loop)
+
+def _run(coroutine):
+    """Run a coroutine on the background event loop and wait for its result"""
+    return _schedule(coroutine).result()
 
 def connect_arduino():
     """Establish connection to Arduino"""
-    global arduino
+    global arduino, binary_mode, machine_state
     
     if arduino is not None:
-        print("Arduino already connected.")
+        log.info("Arduino already connected.")
         return True
     
     try:
-        print("Connecting to Arduino...")
-        arduino = serial.Serial(PORT, baudrate=BAUDRATE, timeout=1)
-        time.sleep(2)  # Wait for Arduino to reset
-        print("Connected.")
+        log.info("Connecting to Arduino...")
+        port_name = PORT or portfinder.find_port()
+        board = portfinder.board_on(port_name)
+        saved = portfinder.saved_baudrate(board)
+        # A board that is not reset is still at the rate it was left at, unless it was unplugged since
+        port = open_port(port_name, BAUDRATE if RESET_ON_CONNECT or not saved else saved, reset=RESET_ON_CONNECT)
+        binary_mode = False  # A reset puts the firmware back in text mode, and close_connection leaves it there
+        if RESET_ON_CONNECT:
+            machine_state = None  # And back where it boots
+        attach(port)
+        try:
+            try:
+                # Returns as soon as the firmware has started, instead of sleeping through the reset
+                took = _run(connection.wait_until_ready(PING_AFTER if RESET_ON_CONNECT else 0))
+            except TimeoutError:
+                if port.baudrate == BAUDRATE:
+                    raise
+                # Restarted since it was left at the saved rate, so back at BAUDRATE
+                detach()
+                port.baudrate = BAUDRATE
+                attach(port)
+                took = _run(connection.wait_until_ready(0))
+        except Exception:
+            detach()
+            port.close()
+            raise
+        log.info("Connected in %.2f s.", took)
+        if FAST_BAUDRATES:
+            negotiate_baudrate(board, saved)
+        if not RESET_ON_CONNECT:
+            check_position()  # The board kept running, pick up where it is
+        if BINARY_PROTOCOL:
+            enable_binary_mode()
         return True
     except Exception as e:
-        print(f'Could not connect to arduino: {e}')
+        log.error("Could not connect to arduino: %s", e)
+        close_connection()  # Or a link left half negotiated would count as connected from now on
         return False
 
-def start_print(filename='Gcode.txt'):
+def negotiate_baudrate(board, saved=None):
+    """
+    Move the connection to the fastest of FAST_BAUDRATES the link carries
+    cleanly (see PrinterConnection.negotiate_baudrate), trying the rate the
+    board agreed to last time first, and remember the result for the board.
+    A board that managed none of them (or has no M991) is not asked again,
+    until its saved rate is cleared with portfinder.save_baudrate(board, None).
+
+    Returns:
+        int: The baud rate in use now
+    """
+    if saved == BAUDRATE:
+        return BAUDRATE
+    rates = sorted({saved, *FAST_BAUDRATES} - {None, BAUDRATE}, reverse=True)
+    if saved in rates:
+        rates.remove(saved)
+        rates.insert(0, saved)  # Known to work, no need to fail at the faster ones again
+    rate = _run(connection.negotiate_baudrate(rates))
+    if rate != saved:
+        portfinder.save_baudrate(board, rate)
+    return rate
+
+def attach(port):
+    """Use an already open serial port as the Arduino connection and start reading from it"""
+    global arduino, connection
+    arduino = port
+    connection = PrinterConnection(port, baudrate=getattr(port, 'baudrate', BAUDRATE),
+                                   rx_buffer_size=RX_BUFFER_SIZE, ack_timeout=ACK_TIMEOUT, max_resends=MAX_RESENDS,
+                                   binary_mode=binary_mode, record_seq=record_seq, state=machine_state)
+    _run(connection.start())
+
+def detach():
+    """
+    Stop reading from the Arduino connection without closing it
+    
+    Returns:
+        The serial port, or None if not connected
+    """
+    global arduino, connection, binary_mode, record_seq, machine_state
+    port = arduino
+    if connection is not None:
+        _run(connection.stop())
+        binary_mode, record_seq, machine_state = connection.binary_mode, connection.record_seq, connection.state
+    arduino = None
+    connection = None
+    return port
+
+def start_print(filename='Gcode.txt', stream=True, preprocess=True, resume=False, optimize=False,
+                keep_open=None, metrics_path=None, profile=None, trace_memory=False, preflight=None,
+                cached=None):
+    """
+    Send a G-code file to the Arduino.
+    
+    Args:
+        filename (str): Path of the G-code file to send
+        stream (bool): Keep several lines in flight at once (see stream_lines).
+            Pass False to fall back to waiting for "OK" after every line.
+        preprocess (bool): Strip comments and redundant words before sending (see pipeline.py).
+            G2/G3 arcs are cut into G1 chords either way (ARC_TOLERANCE in arcs.py).
+        resume (bool): Carry on from where the last run of this file stopped, if it was
+            cut short (see checkpoint.py). Otherwise start from the beginning.
+        optimize (bool): Merge collinear moves and shorten travel first, and send
+            the optimized copy (<file>.opt.<ext>, see optimizer.py)
+        keep_open (bool): Stay connected when the job is done, so the next one
+            does not wait for a reconnect and reset (default KEEP_OPEN)
+        metrics_path (str): Save the timings of the lines sent (connection.metrics) here once
+            the job ends, as CSV for *.csv, otherwise as a Prometheus text file (see metrics.export)
+        profile (str): Profile the job with cProfile and save the stats here
+        trace_memory (bool): Log where the most memory was allocated during the job (tracemalloc)
+        preflight (bool): Check the file first (see preflight.py) and do not send it if any line
+            goes out of bounds; commands the firmware ignores are only logged (default PREFLIGHT)
+        cached (bool): Check, estimate and send the file from its compiled copy in the job
+            cache, compiling it if it is not there yet (default JOB_CACHE, see jobcache.py)
+    """
     global arduino
     
+    if optimize:
+        try:
+            filename, optimizer_stats = optimizer.optimize_file(filename)
+        except FileNotFoundError:
+            log.error("Error: File '%s' not found.", filename)
+            return
+        log.info(optimizer_stats.summary())
+    
+    # Parsed once, for the preflight check and the time estimate
+    cached = JOB_CACHE if cached is None else cached
+    try:
+        if cached:
+            with jobcache.open_job(filename) as compiled:
+                parsed = compiled.arrays()
+        else:
+            parsed = jobarrays.load(filename)
+    except FileNotFoundError:
+        log.error("Error: File '%s' not found.", filename)
+        return
+    states = jobarrays.replay(parsed)
+    
+    if PREFLIGHT if preflight is None else preflight:
+        report = validate(parsed, states, filename)
+        if not report.ok:
+            log.error(report.summary())
+            log.error("Not sending '%s', start_print(..., preflight=False) sends it anyway", filename)
+            return
+        if report.warnings:
+            log.warning(report.summary())
+    
     # Auto-connect if not connected
     if arduino is None:
         if not connect_arduino():
             return
         
     # ---------------------
-    # SEND GCODE FILE LINE BY LINE
+    # SEND GCODE FILE
     # ---------------------
     try:
-        with open(filename, 'r') as file:
-            start_time = time.time()
-            # Get total lines for progress tracking
-            total_lines = sum(1 for _ in file)
-            file.seek(0)  # Reset file pointer to start
-            current_line = 0
+        with metrics.profiling(profile, trace_memory) as profiled, JobFile(filename) as job, \
+                (jobcache.open_job(filename) if cached else contextlib.nullcontext()) as compiled:
+            checkpoint = (Checkpoint.load(job) if resume else None) or Checkpoint(job)
+            if checkpoint.line:
+                log.info("Resuming from line %d", checkpoint.line + 1)
+                for gcode in checkpoint.preamble():
+                    send_gcode(gcode)
             
-            for line in file:
-                line = line.strip()
-                if not line or line.startswith(';'):  # Skip comments and blanks
-                    current_line += 1
-                    continue
-                
-                print(f">> Sending: {line}")
-                arduino.write((line + '\n').encode())
-                
-                # Calculate and print progress percentage
-                current_line += 1
-                progress = (current_line / total_lines) * 100
-                print(f"Progress: {progress:.1f}%")  # Show 1 decimal place
-                
-                # Wait for Arduino to respond with "OK"
-                while True:
-                    if arduino.in_waiting:
-                        response = arduino.readline().decode().strip()
-                        print(f"<< Arduino: {response}")
-                        print(f"Parse Time = {time.time() - start_time}")
-                        start_time = time.time()
-                        if response == "OK":
-                            break
+            # Progress and time left come from the predicted run time of each line
+            progress = estimator.estimate(parsed, states).starting_at(checkpoint.line)
+            log.info("Estimated print time: %s", estimator.format_duration(progress.remaining(0)))
+            lines = compiled.lines(checkpoint.line) if compiled is not None else checkpoint.lines()
+            if preprocess:
+                pipeline_stats = pipeline.PipelineStats()
+                lines = pipeline.preprocess(lines, stats=pipeline_stats, start=checkpoint.state,
+                                            source=checkpoint.lines() if compiled is not None else None)
+            else:
+                lines = pipeline.expand_arcs(lines, start=checkpoint.state)  # The firmware has no G2/G3
+            
+            try:
+                # Like stream_lines / send_lines_blocking, profiled on the loop thread that sends it
+                stats = _run(profiled(connection.stream(lines, progress, on_ack=checkpoint.acknowledged,
+                                                        window=None if stream else 0)))
+            except (TimeoutError, IOError):
+                checkpoint.save()
+                log.error("Stopped after line %d, start_print('%s', resume=True) carries on", checkpoint.line, filename)
+                raise
+            finally:
+                if metrics_path:
+                    metrics.export(connection.metrics, metrics_path)
+            checkpoint.remove()
                             
     except FileNotFoundError:
-        print(f"Error: File '{filename}' not found.")
+        log.error("Error: File '%s' not found.", filename)
         return
+    except (TimeoutError, IOError) as e:
+        log.error("Error: %s", e)
+        close_connection()
+        return
+    
+    print_throughput(stats)
+    if preprocess:
+        log.info(pipeline_stats.summary())
     
     # ---------------------
     # CLEANUP
     # ---------------------
-    arduino.close()
-    arduino = None
-    print("Done sending G-code.")
+    if not (KEEP_OPEN if keep_open is None else keep_open):
+        close_connection()
+    log.info("Done sending G-code.")
+
+def send_lines_blocking(lines, total_lines, on_progress=None, control=None, on_ack=None):
+    """
+    Send lines one at a time, waiting for "OK" before writing the next one.
+    
+    Args:
+        lines: Iterable of G-code lines
+        total_lines: Number of lines, for progress reporting, or a function that
+            returns the percentage done after a number of lines (e.g. estimator.TimeEstimate)
+        on_progress: Optional callback(current_line, percent, line) after each line is sent
+        control (JobControl): Optional handle to pause or stop the job from another thread
+        on_ack: Optional callback(current_line, line) once the Arduino has acknowledged a line
+            (e.g. Checkpoint.acknowledged)
+    
+    The callbacks run on the connection's event loop thread.
+    
+    Returns:
+        dict: Line/byte counts and elapsed time (see print_throughput)
+    """
+    return _run(connection.stream(lines, total_lines, on_progress, control, on_ack, window=0))
+
+def stream_lines(lines, total_lines, on_progress=None, control=None, on_ack=None):
+    """
+    Send lines without waiting for an "OK" after each one, keeping as many
+    in flight as fit in the Arduino's receive buffer (see PrinterConnection.stream).
+    
+    Takes the same arguments as send_lines_blocking. Pausing or stopping
+    lets the lines already in flight finish first.
+    
+    Returns:
+        dict: Line/byte counts and elapsed time (see print_throughput)
+    """
+    return _run(connection.stream(lines, total_lines, on_progress, control, on_ack))
+
+def enable_binary_mode():
+    """
+    Ask the firmware to switch to the binary protocol (binproto.py).
+    Firmware that does not know M990 just echoes it, and the connection stays in text mode.
+    
+    Returns:
+        bool: True if the firmware switched to binary
+    """
+    return _run(connection.enable_binary_mode())
+
+def disable_binary_mode():
+    """Switch the firmware back to G-code text"""
+    _run(connection.disable_binary_mode())
+
+def print_throughput(stats):
+    """Log lines/sec and bytes/sec for a finished job"""
+    elapsed = max(stats['elapsed'], 1e-9)
+    log.info("Sent %d lines (%d bytes) in %.2f s: %.1f lines/sec, %.0f bytes/sec", stats['lines'], stats['bytes'],
+             stats['elapsed'], stats['lines'] / elapsed, stats['bytes'] / elapsed)
 
 def send_gcode(gcode):
     """
@@ -101,31 +346,84 @@ def send_gcode(gcode):
     # Skip empty lines and comments
     gcode = gcode.strip()
     if not gcode or gcode.startswith(';'):
-        print("Skipping empty line or comment")
+        log.debug("Skipping empty line or comment")
         return None
     
     try:
-        print(f">> Sending: {gcode}")
-        arduino.write((gcode + '\n').encode())
-        
-        # Wait for Arduino to respond
-        while True:
-            if arduino.in_waiting:
-                response = arduino.readline().decode().strip()
-                print(f"<< Arduino: {response}")
-                return response
+        events = _run(connection.send(gcode))
+        if events is None:
+            log.debug("Skipping command the firmware does not run")
+            return None
+        return events[0].text if events else None
                 
     except Exception as e:
-        print(f"Error sending G-code: {e}")
+        log.error("Error sending G-code: %s", e)
+        return None
+
+def jog(dx=0.0, dy=0.0, dz=0.0, wait=True):
+    """
+    Move X, Y and Z by an offset, while no job is being sent or it is paused.
+    Jogs that follow each other closely are sent as one move, and jogs out
+    of bounds are refused before anything is sent (see PrinterConnection.jog).
+    
+    Args:
+        wait (bool): False returns straight away with a concurrent.futures.Future
+            of the result, for callers that must not block (the GUI)
+    
+    Returns:
+        tuple: (dx, dy, dz) of the move sent, or None if not connected
+    
+    Raises:
+        ValueError: If the jog would go out of bounds
+        RuntimeError: If a job is being sent and is not paused
+    """
+    if connection is None:
+        return None
+    future = _schedule(connection.jog(dx, dy, dz))
+    return future.result() if wait else future
+
+def machine_position():
+    """
+    Where the firmware is once the commands it has acknowledged have run,
+    without asking it (see PrinterConnection.state), so it can be read as
+    often as the display wants
+    
+    Returns:
+        tuple: (x, y, z, e), or None if not connected
+    """
+    if connection is None:
+        return None
+    return tuple(connection.state.coord)
+
+def check_position():
+    """
+    Ask the firmware where it is (M114), and take its position if
+    machine_position() has drifted from it. Waits behind the lines in flight.
+    
+    Returns:
+        float: mm machine_position() was off, or None if the firmware could not be asked
+    """
+    if connection is None:
+        return None
+    try:
+        if _run(connection.query_position()) is None:
+            return None
+    except Exception as e:
+        log.error("Could not check the position: %s", e)
         return None
+    return connection.drift
 
 def close_connection():
     """Close the Arduino connection"""
-    global arduino
-    if arduino:
-        arduino.close()
-        arduino = None
-        print("Arduino connection closed.")
+    if connection is not None and connection.binary_mode:
+        try:
+            disable_binary_mode()
+        except Exception as e:
+            log.warning("Could not switch the Arduino back to text mode: %s", e)
+    port = detach()
+    if port:
+        port.close()
+        log.info("Arduino connection closed.")
 
 def is_connected():
     """Check if Arduino is connected"""